@@ -1,5 +1,5 @@
 # Import necessary modules and libraries
-from flask import Flask, render_template, redirect, url_for, session, flash, request, send_file, abort
+from flask import Flask, render_template, redirect, url_for, session, flash, request, send_file, abort, jsonify, g, has_request_context
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, DateField, PasswordField, SelectField, TextAreaField, RadioField, IntegerField
 from wtforms.validators import DataRequired, Length, EqualTo, Optional, ValidationError
@@ -10,17 +10,47 @@ import numpy as np
 import datetime
 from datetime import date
 import re
+import json
+import base64
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
 from io import BytesIO
-import pandas as pd
+import tempfile
+import threading
+import time
+import queue
+import weakref
+import bisect
+import heapq
+from collections import Counter
+from collections import OrderedDict
+from scipy.sparse import vstack
+from scipy.sparse import csr_matrix
 from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
 
 # Create a Flask application instance
 app = Flask(__name__, static_folder="/Users/poojagada/VS Code Projects/Lily Library NEA/static")
 # Set a secret key to prevent CSRF (Cross-Site Request Forgery) attacks 
 app.config["SECRET_KEY"] = "afreiluo4389" 
+# Set the maximum number of open connections to the SQLite database, and the number of seconds a request waits for a free connection before failing
+app.config["DATABASE_POOL_SIZE"] = 10
+app.config["DATABASE_POOL_TIMEOUT"] = 5
+# Set the SQLite pragmas applied to every new database connection
+# WAL journaling lets readers and a writer use the database at the same time, and busy_timeout makes a connection wait for a lock instead of failing with "database is locked"
+app.config["SQLITE_PRAGMAS"] = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -16000,
+    "mmap_size": 268435456,
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,
+}
+# Set the number of prepared statements each database connection keeps in its statement cache, so that the statements built by QueryBuilder are compiled once and reused
+app.config["SQLITE_CACHED_STATEMENTS"] = 256
+# Set the number of seconds the background notification scheduler waits between checking whether the daily loan notification sweep is due, and whether it runs at all
+app.config["NOTIFICATION_SCHEDULER_ENABLED"] = True
+app.config["NOTIFICATION_SCHEDULER_INTERVAL"] = 3600
 
 # Define program constants
 
@@ -34,24 +64,171 @@ BINKEY = "000101001100"
 # Defines an admin code for the system. Will be used to check if a reader has admin permissions and will determine what tasks they can perform on the system.
 ADMINCODE = "57493"
 
+# Defines the escalation tiers for overdue loans, in days overdue. A reader is sent a notification about an overdue loan when it reaches each tier
+OVERDUETIERS = [1, 7, 14, 30]
+# Defines how long in seconds the list of overdue loans is cached for
+OVERDUECACHETTL = 300
+
+# Defines the number of days of loans the Popular bookshelf is based on and the number of books on the Popular and Trending bookshelves
+# Also defines how long in seconds popular and trending books are cached for
+POPULARSHELFDAYS = 30
+POPULARSHELFSIZE = 15
+POPULARITYCACHETTL = 300
+
+# Defines the number of readers shown on the monthly leaderboard on the home page, and how long in seconds the leaderboard is cached for
+LEADERBOARDSIZE = 10
+LEADERBOARDCACHETTL = 300
+
+# Defines the number of days a book is loaned for, used to estimate when reserved books will be available
+LOANPERIODDAYS = 14
+
+# Defines the number of books shown on a reader's recommendations shelf
+RECOMMENDATIONSHELFSIZE = 15
+
+# Defines how strongly a reader's recent loans and highly rated reviews count towards their recommendations. A review's weight is also scaled by its rating out of 5
+LOANSEEDWEIGHT = 1.0
+REVIEWSEEDWEIGHT = 1.5
+
+# Defines how long in seconds a reader's cached recommendations are kept, and the maximum number of readers whose recommendations are cached at once
+RECOMMENDATIONCACHETTL = 600
+RECOMMENDATIONCACHESIZE = 1000
+
+# Defines how long in seconds a reader's cached number of unread notifications is kept, and the maximum number of readers whose count is cached at once
+NOTIFICATIONCOUNTCACHETTL = 30
+NOTIFICATIONCOUNTCACHESIZE = 1000
+
+# Defines the maximum number of suggestions returned by the autocomplete endpoint, and the minimum fraction of the typed text's trigrams a suggestion must contain to be offered when no title or author starts with the typed text
+AUTOCOMPLETELIMIT = 8
+AUTOCOMPLETEMINSIMILARITY = 0.5
+
+# Defines how long in seconds the bookshelves shared by every reader (New, Popular and genre shelves) are cached, and the number of genre shelves shown
+SHELFCACHETTL = 60
+GENRESHELFCOUNT = 3
+
+# Defines the number of search results shown on each page of book and reader search results, and the largest number of results that can be requested on one page
+SEARCHPAGESIZE = 20
+MAXSEARCHPAGESIZE = 50
+
+# Defines the smallest and largest integers SQLite can store, as a search cursor holding an integer outside this range cannot be bound to a query
+SQLITEMININTEGER = -2 ** 63
+SQLITEMAXINTEGER = 2 ** 63 - 1
+
+# Defines the font used in PDF reports, and the height below which a report continues on a new page
+PDFFONT = "Helvetica"
+PDFFONTSIZE = 12
+PDFBOTTOMMARGIN = 50
+
+# Defines the number of bytes of a PDF report kept in memory before it is written to a temporary file, and the number of bytes copied into the database at a time
+PDFSPOOLSIZE = 1048576
+PDFCHUNKSIZE = 65536
+
+# Defines the number of rows fetched from the database at a time when writing a report
+REPORTBATCHSIZE = 500
+
+# Defines the number of bytes the similarities calculated together in one matrix multiplication may use, which sets how many books are compared at a time based on the size of the library
+SIMILARITYMEMORYBUDGET = 67108864
+
+# Defines a ConnectionPool class that keeps a bounded number of open connections to an SQLite database so that they can be reused across requests
+class ConnectionPool():
+
+    # Constructor for the ConnectionPool class
+    # Takes the filename of the SQLite database file, the maximum number of connections, the number of seconds to wait for a free connection, a dictionary of pragmas to apply to each connection and the size of each connection's statement cache as parameters
+    def __init__(self, dbName, maxSize, timeout, pragmas, cachedStatements):
+        self.dbName = dbName
+        self.timeout = timeout
+        self.pragmas = pragmas
+        self.cachedStatements = cachedStatements
+        # Connections that are open but not currently checked out, the most recently used is reused first
+        self.idleConnections = queue.LifoQueue()
+        # Semaphore that limits the number of connections that can be checked out at once
+        self.slots = threading.BoundedSemaphore(maxSize)
+
+    # Method to open a new connection to the SQLite database and apply the configured pragmas to it
+    # check_same_thread is disabled as a connection may be used by different threads, but only by one thread at a time
+    def createConnection(self):
+        busyTimeout = self.pragmas.get("busy_timeout", 5000)
+        con = sqlite3.connect(self.dbName, timeout=busyTimeout / 1000, check_same_thread=False, cached_statements=self.cachedStatements)
+        for pragma, value in self.pragmas.items():
+            con.execute(f"PRAGMA {pragma} = {value}")
+        return con
+
+    # Method to check out a connection, reusing an idle connection if there is one
+    # Raises an OperationalError if no connection becomes free within the timeout
+    def acquire(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise sqlite3.OperationalError("Timed out waiting for a free database connection.")
+        try:
+            return self.idleConnections.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self.createConnection()
+        except Exception:
+            self.slots.release()
+            raise
+
+    # Method to return a checked out connection to the pool
+    # Any uncommitted changes are rolled back, in the same way as they would be if the connection was closed
+    def release(self, con):
+        try:
+            if con.in_transaction:
+                con.rollback()
+            self.idleConnections.put(con)
+        finally:
+            self.slots.release()
+
 # Defines a Database class to contain operations that are performed on the database
+# Each thread checks out its own connection from a shared ConnectionPool, so requests running at the same time never share a cursor
 class Database():
+
+    # Class variables storing one connection pool for each database file and every Database instance that has been created
+    pools = {}
+    poolsLock = threading.Lock()
+    instances = weakref.WeakSet()
     
     # Constructor for the Database class
     # Takes the filename of the SQLite database file as a parameter
+    # Initialises thread-local storage to hold the connection and cursor of the current thread
     def __init__(self, dbName):
         self.dbName = dbName
+        self.local = threading.local()
+        Database.instances.add(self)
+
+    # Property to get the connection checked out by the current thread
+    @property
+    def con(self):
+        return getattr(self.local, "con", None)
+
+    # Property to get the cursor of the connection checked out by the current thread
+    @property
+    def cur(self):
+        return getattr(self.local, "cur", None)
+
+    # Method to get the connection pool for the database file, creating it the first time it is needed using the pool and pragma settings in the app config
+    def getPool(self):
+        with Database.poolsLock:
+            if self.dbName not in Database.pools:
+                Database.pools[self.dbName] = ConnectionPool(self.dbName, app.config["DATABASE_POOL_SIZE"], app.config["DATABASE_POOL_TIMEOUT"], app.config["SQLITE_PRAGMAS"], app.config["SQLITE_CACHED_STATEMENTS"])
+            return Database.pools[self.dbName]
     
     # Method to establish a connection to the SQLite database
+    # Checks out a connection from the pool for the current thread, returning any connection the thread already had first
     # Creates a cursor object to allow the execution of SQL queries
     def connect(self):
-        self.con = sqlite3.connect(self.dbName)
-        self.cur = self.con.cursor()
+        if self.con is not None:
+            self.close()
+        self.local.con = self.getPool().acquire()
+        self.local.cur = self.local.con.cursor()
     
     # Method to execute parameterised SQL queries
     # Takes the query to execute and optional parameters to pass to the query as parameters
     def execute(self, query, params=()):
         self.cur.execute(query, params)
+
+    # Method to execute a parameterised SQL query once for each set of parameters
+    # Takes the query to execute and a list of tuples of parameters as parameters
+    def executeMany(self, query, paramsList):
+        self.cur.executemany(query, paramsList)
         
     # Method to fetch a single row from the result of the last query execution
     # Returns a tuple containing the result
@@ -68,18 +245,354 @@ class Database():
     # Returns a list of tuples containing results
     def fetchMany(self, size):
         return self.cur.fetchmany(size)
+
+    # Method to iterate over the rows from the result of the last query execution, fetching a batch of rows at a time so that only one batch is held in memory
+    # Takes the number of rows to fetch at a time as a parameter
+    def iterateRows(self, batchSize):
+        while True:
+            rows = self.cur.fetchmany(batchSize)
+            if not rows:
+                return
+            yield from rows
     
     # Method to get the ID/Primary Key value of the last inserted row
     def getLastRowID(self):
         return self.cur.lastrowid
+
+    # Method to get the number of rows changed by the last query execution
+    def getRowCount(self):
+        return self.cur.rowcount
+
+    # Method to check whether BLOBs can be opened to be written a part at a time, which needs Python 3.11 or later
+    def canOpenBlob(self):
+        return hasattr(self.con, "blobopen")
+
+    # Method to open a BLOB in a row of a table so that it can be written a part at a time instead of all at once
+    def openBlob(self, table, column, rowID):
+        return self.con.blobopen(table, column, rowID)
     
+    # Method to start a transaction that takes the database write lock straight away, so that the statements in it run as one atomic unit
+    def begin(self):
+        self.cur.execute("BEGIN IMMEDIATE")
+
     # Method to commit changes to the database
     def commit(self):
         self.con.commit()
+
+    # Method to undo all the changes made since the last commit
+    def rollback(self):
+        self.con.rollback()
     
     # Method to close the connection to the SQLite database
+    # The connection is returned to the pool to be reused instead of being closed
     def close(self):
-        self.con.close()
+        con = self.con
+        if con is None:
+            return
+        self.local.cur.close()
+        self.local.con = None
+        self.local.cur = None
+        self.getPool().release(con)
+
+    # Method to return every connection the current thread still has checked out to the pool
+    # Called at the end of every request so a method that did not close its connection cannot use up the pool
+    @classmethod
+    def releaseConnections(cls):
+        for database in list(cls.instances):
+            database.close()
+
+# Defines the query that copies books into the BookSearch full-text index, one row per book with all its authors' names, whose rowid is the BookID
+BOOKSEARCHINSERT = """INSERT INTO BookSearch (rowid, Title, Genre, AuthorFirstNames, AuthorLastNames, ISBN, Blurb) SELECT Book.BookID, Book.Title, Book.Genre, GROUP_CONCAT(Author.AuthorFirstName, ' '), GROUP_CONCAT(Author.AuthorLastName, ' '), Book.ISBN, Book.Blurb FROM Book LEFT JOIN AuthorBook ON Book.BookID = AuthorBook.BookID LEFT JOIN Author ON AuthorBook.AuthorID = Author.AuthorID"""
+
+# Defines the query that recalculates the BookAvailability row of books from their copies, replacing any existing row
+# It is run for a single book, in the same transaction as any change to that book's copies, by adding a WHERE clause on Book.BookID
+# The number of pending reservations is kept up to date by ReservationScheduler as reservations join and leave the queue, so it is kept from the existing row, and only counted for a book that does not have a row yet
+BOOKAVAILABILITYREFRESH = """INSERT OR REPLACE INTO BookAvailability (BookID, AvailableCopies, OnLoanCopies, Decommissioned, PendingReservations) SELECT Book.BookID,
+    (SELECT COUNT(*) FROM BookCopy WHERE BookCopy.BookID = Book.BookID AND BookCopy.Status = 'Available'),
+    (SELECT COUNT(*) FROM BookCopy WHERE BookCopy.BookID = Book.BookID AND BookCopy.Status = 'On Loan'),
+    EXISTS (SELECT 1 FROM BookCopy WHERE BookCopy.BookID = Book.BookID AND BookCopy.Status = 'Decommissioned'),
+    IFNULL((SELECT PendingReservations FROM BookAvailability WHERE BookAvailability.BookID = Book.BookID), (SELECT COUNT(*) FROM Reservation WHERE Reservation.BookID = Book.BookID AND Reservation.ReservationStatus = 'Pending'))
+FROM Book"""
+
+# Defines the query that retrieves the loanID, readerID, bookID, reader's full name, year group label, houseroom, loan start date, loan end date, book title and days overdue of loans, which is completed by adding a WHERE clause and an ORDER BY clause
+# The date to count the days overdue up to is passed as the first parameter
+OVERDUELOANSELECT = """SELECT Loan.LoanID, Loan.ReaderID, Loan.BookID, Reader.FirstName || ' ' || Reader.LastName AS FullName, CASE 
+          WHEN Reader.YearGroup = 0 THEN 'Staff'
+          WHEN Reader.YearGroup = 1 THEN 'Librarian'
+          ELSE 'Year ' || CAST(Reader.YearGroup AS TEXT)
+      END AS YearGroupLabel, Reader.Houseroom, Loan.LoanStartDate, Loan.LoanEndDate, Book.Title, CAST(julianday(?) - julianday(Loan.LoanEndDate) AS INTEGER) AS DaysOverdue FROM Loan INNER JOIN Reader ON Reader.ReaderID = Loan.ReaderID INNER JOIN Book ON Loan.BookID = Book.BookID"""
+
+# Defines the order of the reservation queue for a book, which is by priority and then by when each reservation was made, with the reservationID deciding between reservations made in the same second
+# A reservation's position in the queue is not stored, it is worked out from this order when it is shown, so no reservation has to be renumbered when the queue changes
+RESERVATIONQUEUEORDER = "Priority, ReservationTimestamp, ReservationID"
+
+# Defines the schema migrations applied to the database after it has been created by database.py
+# Each migration is a tuple of its version number, a description and the list of SQL statements it runs. Migrations are applied in order and a migration is never edited once added, a new one is added instead
+MIGRATIONS = [
+    (1, "Add indexes for the most frequently used query predicates", [
+        # Used by the loan allowance check in loanBook and by getLoans
+        "CREATE INDEX IF NOT EXISTS LoanReaderStatusIndex ON Loan (ReaderID, LoanStatus)",
+        # Used to count and retrieve a reader's unread notifications on every page
+        "CREATE INDEX IF NOT EXISTS NotificationReaderViewedIndex ON Notification (ReaderID, Viewed)",
+        # Used to find the reservation queue for a copy of a book
+        "CREATE INDEX IF NOT EXISTS ReservationBookCopyStatusIndex ON Reservation (BookID, CopyID, ReservationStatus)",
+        # Used by the available and decommissioned copy checks in every bookshelf query
+        "CREATE INDEX IF NOT EXISTS BookCopyBookStatusIndex ON BookCopy (BookID, Status)",
+        # Used to retrieve and count the reviews of a book
+        "CREATE INDEX IF NOT EXISTS ReviewBookIndex ON Review (BookID)",
+        # Used to retrieve the newest books in the library
+        "CREATE INDEX IF NOT EXISTS BookDateAddedIndex ON Book (DateAdded)",
+        "ANALYZE",
+    ]),
+    (2, "Add the BookSearch full-text index over book titles, genres, author names, ISBNs and blurbs", [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS BookSearch USING fts5(Title, Genre, AuthorFirstNames, AuthorLastNames, ISBN, Blurb, tokenize = 'unicode61 remove_diacritics 2')",
+        "DELETE FROM BookSearch",
+        BOOKSEARCHINSERT + " WHERE Book.BookID NOT IN (SELECT BookID FROM BookCopy WHERE Status = 'Decommissioned') GROUP BY Book.BookID",
+    ]),
+    (3, "Add the BookAvailability table, which stores one row per book with its number of available and on loan copies, whether it has been decommissioned and its number of pending reservations", [
+        """CREATE TABLE IF NOT EXISTS BookAvailability (
+            BookID INTEGER PRIMARY KEY REFERENCES Book (BookID),
+            AvailableCopies INTEGER NOT NULL DEFAULT 0,
+            OnLoanCopies INTEGER NOT NULL DEFAULT 0,
+            Decommissioned INTEGER NOT NULL DEFAULT 0,
+            PendingReservations INTEGER NOT NULL DEFAULT 0
+        )""",
+        BOOKAVAILABILITYREFRESH,
+    ]),
+    (4, "Add an index for finding where a new reservation goes in the queue for a copy, which replaces the index on the reservation queue for a copy", [
+        "CREATE INDEX IF NOT EXISTS ReservationQueueIndex ON Reservation (BookID, CopyID, ReservationStatus, Priority)",
+        "DROP INDEX IF EXISTS ReservationBookCopyStatusIndex",
+    ]),
+    (5, "Queue reservations for a book instead of for a copy of the book, and renumber the queue positions of pending reservations for each book", [
+        "CREATE INDEX IF NOT EXISTS ReservationBookQueueIndex ON Reservation (BookID, ReservationStatus, Priority, QueuePosition)",
+        "DROP INDEX IF EXISTS ReservationQueueIndex",
+        """UPDATE Reservation SET QueuePosition = Ranked.QueuePosition FROM (
+            SELECT ReservationID, ROW_NUMBER() OVER (PARTITION BY BookID ORDER BY Priority, QueuePosition, ReservationTimestamp, ReservationID) AS QueuePosition
+            FROM Reservation
+            WHERE ReservationStatus = 'Pending'
+        ) AS Ranked WHERE Reservation.ReservationID = Ranked.ReservationID""",
+    ]),
+    (6, "Add a unique key to notifications created by the daily loan notification sweep, so the same notification is never inserted twice", [
+        "ALTER TABLE Notification ADD COLUMN NotificationKey TEXT",
+        "CREATE UNIQUE INDEX IF NOT EXISTS NotificationKeyIndex ON Notification (NotificationKey)",
+    ]),
+    (7, "Add an index for finding active loans by their end date, used to find overdue loans and loans due back tomorrow", [
+        "CREATE INDEX IF NOT EXISTS LoanStatusEndDateIndex ON Loan (LoanStatus, LoanEndDate)",
+    ]),
+    (8, "Add the ReaderMonthlyLoans table, which stores the number of loans each reader has taken out in each month, for the monthly leaderboard", [
+        """CREATE TABLE IF NOT EXISTS ReaderMonthlyLoans (
+            ReaderID INTEGER NOT NULL REFERENCES Reader (ReaderID),
+            YearMonth TEXT NOT NULL,
+            LoanCount INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (ReaderID, YearMonth)
+        ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS ReaderMonthlyLoansRankIndex ON ReaderMonthlyLoans (YearMonth, LoanCount DESC)",
+        "INSERT OR REPLACE INTO ReaderMonthlyLoans (ReaderID, YearMonth, LoanCount) SELECT ReaderID, strftime('%Y-%m', LoanStartDate), COUNT(*) FROM Loan GROUP BY ReaderID, strftime('%Y-%m', LoanStartDate)",
+    ]),
+    (9, "Add the BookDailyLoans table, which stores the number of loans of each book on each day, for popular and trending books", [
+        """CREATE TABLE IF NOT EXISTS BookDailyLoans (
+            BookID INTEGER NOT NULL REFERENCES Book (BookID),
+            LoanDate DATE NOT NULL,
+            LoanCount INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (BookID, LoanDate)
+        ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS BookDailyLoansDateIndex ON BookDailyLoans (LoanDate, BookID, LoanCount)",
+        "INSERT OR REPLACE INTO BookDailyLoans (BookID, LoanDate, LoanCount) SELECT BookID, DATE(LoanStartDate), COUNT(*) FROM Loan GROUP BY BookID, DATE(LoanStartDate)",
+    ]),
+    (10, "Drop the Book(DateAdded) index, as the New bookshelf is built from the catalogue query, which reads every book, so no query filters on DateAdded", [
+        "DROP INDEX IF EXISTS BookDateAddedIndex",
+    ]),
+    (11, "Order the reservation queue for each book by priority and reservation time instead of storing the queue position of each reservation, so that reserving, cancelling and fulfilling a reservation never renumber the rest of the queue, and recount the pending reservations of each book, which are counted as they change from now on", [
+        "CREATE INDEX IF NOT EXISTS ReservationBookOrderIndex ON Reservation (BookID, ReservationStatus, Priority, ReservationTimestamp, ReservationID)",
+        "DROP INDEX IF EXISTS ReservationBookQueueIndex",
+        "ALTER TABLE Reservation DROP COLUMN QueuePosition",
+        "UPDATE BookAvailability SET PendingReservations = (SELECT COUNT(*) FROM Reservation WHERE Reservation.BookID = BookAvailability.BookID AND Reservation.ReservationStatus = 'Pending')",
+    ]),
+]
+
+# Defines a SchemaMigrator class that brings the database schema up to date by applying any migrations it has not had yet
+# The version of the schema is stored in the database file using SQLite's user_version pragma
+class SchemaMigrator():
+
+    # Constructor for the SchemaMigrator class
+    # Takes the list of migrations and the filename of the SQLite database file as parameters
+    def __init__(self, migrations, dbName):
+        self.migrations = sorted(migrations, key=lambda migration: migration[0])
+        self.db = Database(dbName)
+
+    # Method to get the version of the database schema
+    def getVersion(self):
+        self.db.connect()
+        self.db.execute("PRAGMA user_version")
+        version = self.db.fetchOne()[0]
+        self.db.close()
+        return version
+
+    # Method to apply every migration with a higher version than the database schema, in one transaction, so that the schema is either fully migrated or left unchanged
+    # Returns the list of versions that were applied
+    def migrate(self):
+        self.db.connect()
+        self.db.begin()
+        self.db.execute("PRAGMA user_version")
+        currentVersion = self.db.fetchOne()[0]
+        applied = []
+        try:
+            for version, description, statements in self.migrations:
+                if version <= currentVersion:
+                    continue
+                for statement in statements:
+                    self.db.execute(statement)
+                self.db.execute(f"PRAGMA user_version = {int(version)}")
+                applied.append(version)
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            raise
+        finally:
+            self.db.close()
+        return applied
+
+# Defines a TTLCache class that stores values in memory for a limited time
+# When the cache is full the least recently used value is removed to make space for a new one
+class TTLCache():
+
+    # Constructor for the TTLCache class
+    # Takes the maximum number of values to store and the number of seconds each value is kept for as parameters
+    def __init__(self, maxSize, ttl):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        # Ordered dictionary mapping each key to a tuple of its expiry time and value, least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Method to retrieve a value from the cache
+    # Returns None if there is no value for the key or if the value has expired
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    # Method to store a value in the cache, removing the least recently used value if the cache is full
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+    # Method to remove the value for a key, so that it is recalculated the next time it is needed
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    # Method to remove every value from the cache
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+# Defines a QueryBuilder class that builds the SQL statements for a query that can be sorted by a field and direction chosen by the user
+# Only the sort fields in its dictionary and the directions ASC and DESC can be used, so user input is never put into the SQL itself
+# Each sort field and direction always gives the same statement text, with every value passed as a named parameter, so there are only a few statements and each is compiled once and reused from the connection's statement cache
+class QueryBuilder():
+
+    # Constructor for the QueryBuilder class
+    # Takes the columns to return, the query that finds the rows, a dictionary of the sort fields that can be chosen to the SQL expressions they sort by, and the sort field used when none or an unknown one is chosen as parameters
+    # The query must select {sortKey} AS SortKey and a column that is unique for each row AS UniqueKey, which is used to order rows with the same sort value
+    def __init__(self, columns, query, sortKeys, defaultSortField):
+        self.columns = columns
+        self.query = query
+        self.sortKeys = sortKeys
+        self.defaultSortField = defaultSortField
+        # Dictionary mapping each sort field, direction and keyset flag to its statement, shared by every request so it is only changed while holding the lock
+        self.statements = {}
+        self.lock = threading.Lock()
+
+    # Method to return the sort field if it can be chosen, otherwise the default sort field
+    def getSortField(self, sortField):
+        if sortField in self.sortKeys:
+            return sortField
+        return self.defaultSortField
+
+    # Method to return DESC if it is the chosen direction, otherwise ASC
+    def getSortDirection(self, sortDirection):
+        if sortDirection == "DESC":
+            return "DESC"
+        return "ASC"
+
+    # Method to retrieve the statement for a sort field and direction, building it the first time it is needed
+    # If keyset is True the statement also returns the sort value and unique key of each row and only returns rows after those passed as the :afterSortKey and :afterUniqueKey parameters, if they are not NULL
+    # The number of rows returned is limited by the :limit parameter
+    def build(self, sortField, sortDirection, keyset=True):
+        sortField = self.getSortField(sortField)
+        sortDirection = self.getSortDirection(sortDirection)
+        key = (sortField, sortDirection, keyset)
+        with self.lock:
+            statement = self.statements.get(key)
+            if statement is None:
+                query = self.query.format(sortKey=self.sortKeys[sortField])
+                if keyset:
+                    comparison = "<" if sortDirection == "DESC" else ">"
+                    statement = f"SELECT {self.columns}, SortKey, UniqueKey FROM ({query}) AS Results WHERE :afterSortKey IS NULL OR (SortKey, UniqueKey) {comparison} (:afterSortKey, :afterUniqueKey) ORDER BY SortKey {sortDirection}, UniqueKey {sortDirection} LIMIT :limit"
+                else:
+                    statement = f"SELECT {self.columns} FROM ({query}) AS Results ORDER BY SortKey {sortDirection}, UniqueKey {sortDirection} LIMIT :limit"
+                self.statements[key] = statement
+        return statement
+
+    # Method to add the cursor, which is a list of the sort value and unique key of the row to start after or None, and the limit to a dictionary of parameters for the statement
+    def getParams(self, params, cursor, limit):
+        params = dict(params)
+        params["afterSortKey"], params["afterUniqueKey"] = cursor if cursor else (None, None)
+        params["limit"] = limit
+        return params
+
+# Defines a SearchCursor class that converts the sort values of the last result on a page of search results to and from a token that can be put in a URL
+# The next page is found by seeking past these values in the index order rather than using OFFSET, so each page costs the same however far into the results it is
+class SearchCursor():
+
+    # Method to encode a list of sort values as a URL safe token
+    def encode(self, values):
+        return base64.urlsafe_b64encode(json.dumps(list(values)).encode()).decode()
+
+    # Method to decode a token back into a list of sort values
+    # Each sort value must be a number, a string or None, as those are the only values a sort column can hold, and booleans are rejected even though they are ints in Python
+    # Integers must also be within the range SQLite can store
+    # Returns None if there is no token or the token is not valid, so that the first page of results is shown
+    def decode(self, token, length):
+        if not token:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+        except (ValueError, UnicodeError):
+            return None
+        if not isinstance(values, list) or len(values) != length:
+            return None
+        for value in values:
+            if isinstance(value, bool) or not (value is None or isinstance(value, (int, float, str))):
+                return None
+            if isinstance(value, int) and not SQLITEMININTEGER <= value <= SQLITEMAXINTEGER:
+                return None
+        return values
+
+    # Method to limit the page size requested to between 1 and MAXSEARCHPAGESIZE
+    def getPageSize(self, pageSize):
+        if not pageSize:
+            return SEARCHPAGESIZE
+        return max(1, min(pageSize, MAXSEARCHPAGESIZE))
+
+    # Method to split the rows fetched for a page, of which one more than the page size are fetched, into the page of results and the token for the next page
+    # The last sortLength values of each row are its sort values
+    # Returns the page of results and the token for the next page, or None if this is the last page
+    def getPage(self, rows, pageSize, sortLength):
+        if len(rows) <= pageSize:
+            return rows, None
+        rows = rows[:pageSize]
+        return rows, self.encode(rows[-1][-sortLength:])
 
 # Defines a User class
 class User():
@@ -235,10 +748,14 @@ class Reader(User):
     # Constructor for Reader class, inherits the constructor of the User class
     # Takes the filename of the SQLite database file as a parameter
     # Initialises a class variable readerID to 0, which will be overwritten later
+    # Initialises an instance of SearchCursor to page through search results
     def __init__(self, dbName):
         super().__init__()
         self.db = Database(dbName)
         self.readerID = 0
+        self.searchCursor = SearchCursor()
+        # Readers are searched by name, and are ordered by last name and then first name
+        self.searchQuery = QueryBuilder("ReaderID, FirstName, LastName, YearGroup, Houseroom", """SELECT ReaderID, FirstName, LastName, YearGroup, Houseroom, {sortKey} AS SortKey, ReaderID AS UniqueKey FROM Reader WHERE FirstName || ' ' || LastName LIKE '%' || :name || '%'""", {"Name": "IFNULL(LastName, '') || ' ' || IFNULL(FirstName, '')"}, "Name")
     
     # Method that gets a readerID based on the session['username'] once a reader has logged in, and sets the class variable self.readerID to this value
     def setAndGetReaderID(self, username):
@@ -350,32 +867,20 @@ class Reader(User):
         self.db.commit()
         self.db.close()
         
-    # Method to retrieve information from Reader and Loan tables in order to create a leaderboard
-    def getLeaderboard(self):
-        # Retrieves readers with the most loans taken out that month, and orders them in descending order of number of loans
-        self.db.connect()
-        query = """SELECT Reader.ReaderUsername, CASE 
-          WHEN Reader.YearGroup = 0 THEN 'Staff'
-          WHEN Reader.YearGroup = 1 THEN 'Librarian'
-          ELSE 'Year ' || CAST(Reader.YearGroup AS TEXT)
-      END AS YearGroupLabel, COUNT(Loan.LoanID) AS LoanCount FROM Loan INNER JOIN Reader ON Loan.ReaderID = Reader.ReaderID WHERE strftime('%m', Loan.LoanStartDate) = strftime('%m', 'now') GROUP BY Loan.ReaderID ORDER BY LoanCount DESC"""
-        params = ()
-        self.db.execute(query, params)
-        # Returns list of tuples containing the readers' username, year group and number of loans
-        leaderboard = self.db.fetchAll()
-        self.db.close()
-        return leaderboard
-    
     # Method to allow librarians to search for a reader based on just a name string
-    def searchReader(self, name):
+    # The results are ordered by last name and first name and returned one page at a time, starting after the reader in the cursor token if one is given
+    # Returns the page of readers and the cursor token for the next page, or None if this is the last page
+    def searchReader(self, name, after=None, pageSize=None):
+        pageSize = self.searchCursor.getPageSize(pageSize)
+        cursor = self.searchCursor.decode(after, 2)
         self.db.connect()
         # The reader's first and last names are concatenated and are checked to see if they contain the entered string
-        query = """SELECT ReaderID, FirstName, LastName, YearGroup, Houseroom FROM Reader WHERE FirstName || ' ' || LastName LIKE '%' || ? || '%'"""
-        params = (name, )
+        query = self.searchQuery.build("Name", "ASC")
+        params = self.searchQuery.getParams({"name": name}, cursor, pageSize + 1)
         self.db.execute(query, params)
         readers = self.db.fetchAll()
         self.db.close()
-        return readers
+        return self.searchCursor.getPage(readers, pageSize, 2)
     
     # Method to allow librarian to delete a reader from the database
     # Takes the ID of the reader to be deleted as a parameter
@@ -472,8 +977,10 @@ class ReadingList():
 class Review():
     
     # Constructor for the Review class
+    # Takes an instance of the TTLCache class that stores readers' recommendations as a parameter
     # Takes the filename of the SQLite database file as a parameter
-    def __init__(self, dbName):
+    def __init__(self, recommendationCache, dbName):
+        self.recommendationCache = recommendationCache
         self.db = Database(dbName)
     
     # Method to retrieve all the reviews left by a reader
@@ -501,6 +1008,7 @@ class Review():
         # bookReviews contains the review text, rating, date reviewed, reader's first name, and last name.
         bookReviews = self.db.fetchAll()
         if len(bookReviews) == 0:
+            self.db.close()
             return [], {}
         
         # The dictionary ratingsCount contains the percentage distribution of ratings for that book, created by counting the number of reviews of 1, 2, 3, 4, and 5 stars and dividing it by the total number of reviews
@@ -520,6 +1028,370 @@ class Review():
         self.db.execute(query2, params2)
         self.db.commit()
         self.db.close()
+        # The reader's reviews have changed so their cached recommendations are removed
+        self.recommendationCache.invalidate(readerID)
+
+# Defines a SimilarityEngine class that finds the most similar vectors to a set of query vectors without building the full similarity matrix
+class SimilarityEngine():
+
+    # Constructor for the SimilarityEngine class
+    # Initialises an empty sparse matrix of vectors
+    def __init__(self):
+        self.vectors = None
+
+    # Method to set the vectors that queries are compared against
+    # Each row is normalised to unit length so that a dot product between two rows is their cosine similarity
+    def setVectors(self, vectors):
+        self.vectors = normalize(vectors.tocsr().astype(np.float64))
+
+    # Method to add new vectors to the end of the matrix
+    def appendVectors(self, vectors):
+        self.vectors = vstack([self.vectors, normalize(vectors.tocsr().astype(np.float64))]).tocsr()
+
+    # Method to remove the vectors in the given rows from the matrix
+    def removeRows(self, rows):
+        rows = set(rows)
+        keepRows = [i for i in range(self.getSize()) if i not in rows]
+        self.vectors = self.vectors[keepRows]
+
+    # Method to get the number of vectors in the matrix
+    def getSize(self):
+        if self.vectors is None:
+            return 0
+        return self.vectors.shape[0]
+
+    # Method to get the number of rows whose similarities can be calculated together within SIMILARITYMEMORYBUDGET
+    # Each similarity in the sparse result uses at most 12 bytes (an 8 byte value and a 4 byte column index), and a row can have a similarity for every vector in the matrix
+    def getBatchSize(self):
+        return max(1, SIMILARITYMEMORYBUDGET // (12 * max(1, self.getSize())))
+
+    # Method to get the rows of the matrix as a sparse matrix of vectors, which can be combined into query vectors
+    def getRows(self, rows):
+        return self.vectors[rows]
+
+    # Method to find the k vectors in the matrix most similar to each of the given query vectors, excluding the given rows
+    # Takes a sparse matrix with one query vector in each row, so that several queries are answered with one matrix multiplication
+    # The similarities are kept sparse, so only the vectors that share a word with a query are candidates, and argpartition selects the top k of those without sorting them all
+    # Returns a list containing a list of (row, similarity) tuples for each query, most similar first
+    def getTopK(self, queries, k, excludeRows=()):
+        results = []
+        excludeRows = np.array(sorted(excludeRows), dtype=np.int64)
+        batchSize = self.getBatchSize()
+        for start in range(0, queries.shape[0], batchSize):
+            similarities = (queries[start:start + batchSize] @ self.vectors.T).tocsr()
+            similarities.sort_indices()
+            for i in range(similarities.shape[0]):
+                columns = similarities.indices[similarities.indptr[i]:similarities.indptr[i + 1]]
+                values = similarities.data[similarities.indptr[i]:similarities.indptr[i + 1]]
+                keep = ~np.isin(columns, excludeRows)
+                columns, values = columns[keep], values[keep]
+                results.append([(int(columns[position]), similarity) for position, similarity in self.selectTopK(values, k)])
+        return results
+
+    # Method to select the k highest similarities from one row of similarities
+    # Ties are broken by row order so that results are repeatable
+    def selectTopK(self, similarities, k):
+        if k <= 0:
+            return []
+        if k < len(similarities):
+            # Finds the kth highest similarity, then keeps every row at least that similar so that ties at the boundary are included before sorting
+            kthSimilarity = similarities[np.argpartition(-similarities, k - 1)[k - 1]]
+            candidates = np.flatnonzero(similarities >= kthSimilarity)
+        else:
+            candidates = np.arange(len(similarities))
+        candidates = candidates[np.lexsort((candidates, -similarities[candidates]))][:k]
+        return [(int(i), float(similarities[i])) for i in candidates if similarities[i] >= 0]
+
+# Defines a RecommendationIndex class that stores the vector of every book in the library so that recommendations can be calculated for a reader without vectorising every book again
+class RecommendationIndex():
+
+    # Constructor for the RecommendationIndex class
+    # Takes the filename of the SQLite database file as a parameter
+    # The index is built the first time it is used, and is then updated incrementally when books are added or deleted
+    def __init__(self, dbName):
+        self.db = Database(dbName)
+        self.lock = threading.Lock()
+        self.built = False
+        self.vectorizer = None
+        # Initialises an instance of SimilarityEngine which stores the sparse book vectors, where row i is the vector of the book with ID bookIDs[i]
+        self.similarityEngine = SimilarityEngine()
+        self.bookIDs = []
+        # Dictionary mapping a bookID to its row in the vectors matrix
+        self.rows = {}
+
+    # Method to retrieve the text that describes each book (genre, author names and publisher), one row per book that has not been decommissioned
+    # Takes an optional bookID as a parameter, to retrieve the row for a single book
+    def getBookDocuments(self, bookID=None):
+        self.db.connect()
+        query = """SELECT Book.BookID, Book.Genre, GROUP_CONCAT(Author.AuthorFirstName || '' || Author.AuthorLastName, ' '), LOWER(Publisher.PublisherName) FROM Book INNER JOIN AuthorBook ON Book.BookID = AuthorBook.BookID INNER JOIN Author ON AuthorBook.AuthorID = Author.AuthorID INNER JOIN Publisher ON Book.PublisherID = Publisher.PublisherID INNER JOIN BookAvailability ON Book.BookID = BookAvailability.BookID WHERE BookAvailability.Decommissioned = 0"""
+        params = ()
+        if bookID is not None:
+            query += " AND Book.BookID = ?"
+            params = (bookID, )
+        query += " GROUP BY Book.BookID ORDER BY Book.BookID"
+        self.db.execute(query, params)
+        rows = self.db.fetchAll()
+        self.db.close()
+        # Concatenates the genre, author names and publisher of each book into a single string separated by spaces
+        return [(row[0], ' '.join(str(value) for value in row[1:] if value is not None)) for row in rows]
+
+    # Method to build the index from scratch
+    # Fits the Count Vectorizer once on every book and stores the sparse vector of each book
+    # No similarities are calculated here, they are calculated for each reader's seed books when recommendations are requested
+    def build(self):
+        documents = self.getBookDocuments()
+        self.bookIDs = [document[0] for document in documents]
+        self.rows = {bookID: row for row, bookID in enumerate(self.bookIDs)}
+        if documents:
+            self.vectorizer = CountVectorizer()
+            self.similarityEngine.setVectors(self.vectorizer.fit_transform([document[1] for document in documents]))
+        self.built = True
+
+    # Method to build the index if it has not been built yet
+    def ensureBuilt(self):
+        if not self.built:
+            self.build()
+
+    # Method to add the vector of a new book to the index
+    # Words that are not in the vocabulary of the fitted Count Vectorizer are ignored until the index is next built
+    def addBook(self, bookID):
+        with self.lock:
+            # If the index has not been built yet the new book will be included when it is
+            if not self.built:
+                return
+            documents = self.getBookDocuments(bookID)
+            if not documents or bookID in self.rows:
+                return
+            if self.vectorizer is None:
+                self.build()
+                return
+            self.similarityEngine.appendVectors(self.vectorizer.transform([documents[0][1]]))
+            self.bookIDs.append(bookID)
+            self.rows[bookID] = len(self.bookIDs) - 1
+
+    # Method to remove the vector of a deleted book from the index
+    def deleteBook(self, bookID):
+        with self.lock:
+            if not self.built or bookID not in self.rows:
+                return
+            self.similarityEngine.removeRows([self.rows[bookID]])
+            self.bookIDs.remove(bookID)
+            self.rows = {otherBookID: row for row, otherBookID in enumerate(self.bookIDs)}
+
+    # Method to score every book against several seed books at once
+    # Takes a dictionary mapping each seed bookID to its weight, and the maximum number of recommendations to return
+    # The seed vectors are combined into one query vector weighted by each seed's weight, so each book's score is the weighted sum of its similarity to each seed, found with one sparse matrix multiplication
+    # Returns a list of (bookID, score) tuples, highest score first, that does not include the seed books
+    def getRecommendations(self, seedWeights, limit):
+        with self.lock:
+            self.ensureBuilt()
+            seeds = [(self.rows[bookID], weight) for bookID, weight in seedWeights.items() if bookID in self.rows]
+            if not seeds:
+                return []
+            rows = [seed[0] for seed in seeds]
+            weights = csr_matrix([[seed[1] for seed in seeds]])
+            query = weights @ self.similarityEngine.getRows(rows)
+            topK = self.similarityEngine.getTopK(query, limit, excludeRows=rows)[0]
+            return [(self.bookIDs[row], score) for row, score in topK if score > 0]
+
+# Defines an AutocompleteIndex class that suggests book titles and author names as a reader types, without querying the database
+class AutocompleteIndex():
+
+    # Constructor for the AutocompleteIndex class
+    # Takes the filename of the SQLite database file as a parameter
+    def __init__(self, dbName):
+        self.db = Database(dbName)
+        self.lock = threading.Lock()
+        # List of suggestions, where each suggestion is a tuple of its label, its type ('Book' or 'Author') and its bookID if it is a book
+        self.suggestions = []
+        # Sorted list of (key, suggestion index) tuples, with a key for the whole label and for each word in the label onwards, so that typing the start of any word finds the suggestion
+        self.keys = []
+        # Dictionary mapping each trigram (three letter sequence) to the set of suggestions containing it, used to find suggestions when the reader makes a typo
+        self.trigrams = {}
+
+    # Method to split text into the set of its trigrams, with spaces added at the start and end so that the first and last letters count
+    def getTrigrams(self, text):
+        text = "  " + " ".join(re.findall(r"\w+", text.lower())) + " "
+        return {text[i:i+3] for i in range(len(text) - 2)}
+
+    # Method to build the index from the titles of the books that have not been decommissioned and the names of all the authors
+    # The new index is built separately and then swapped in, so suggestions can still be made while it is being built
+    def build(self):
+        self.db.connect()
+        self.db.execute("""SELECT Book.Title, 'Book', Book.BookID FROM Book INNER JOIN BookAvailability ON Book.BookID = BookAvailability.BookID WHERE BookAvailability.Decommissioned = 0 UNION ALL SELECT AuthorFirstName || ' ' || AuthorLastName, 'Author', NULL FROM Author""")
+        suggestions = self.db.fetchAll()
+        self.db.close()
+        keys = []
+        trigrams = {}
+        for i, suggestion in enumerate(suggestions):
+            words = suggestion[0].lower().split()
+            for j in range(len(words)):
+                keys.append((" ".join(words[j:]), i))
+            for trigram in self.getTrigrams(suggestion[0]):
+                trigrams.setdefault(trigram, set()).add(i)
+        keys.sort()
+        with self.lock:
+            self.suggestions, self.keys, self.trigrams = suggestions, keys, trigrams
+
+    # Method to find suggestions for the text a reader has typed
+    # Suggestions whose title or name, or one of its words, starts with the text are found with a binary search of the sorted keys
+    # If there are not enough of these, suggestions that share the most trigrams with the text are added, so that small typos still find a match
+    # Returns a list of up to limit (label, type, bookID) tuples
+    def search(self, text, limit):
+        text = " ".join(text.lower().split())
+        if not text:
+            return []
+        with self.lock:
+            suggestions, keys, trigrams = self.suggestions, self.keys, self.trigrams
+        found = []
+        i = bisect.bisect_left(keys, (text, ))
+        while i < len(keys) and keys[i][0].startswith(text) and len(found) < limit:
+            if keys[i][1] not in found:
+                found.append(keys[i][1])
+            i += 1
+        if len(found) < limit:
+            textTrigrams = self.getTrigrams(text)
+            sharedTrigrams = Counter()
+            for trigram in textTrigrams:
+                sharedTrigrams.update(trigrams.get(trigram, ()))
+            scored = []
+            for index, shared in sharedTrigrams.items():
+                if index in found:
+                    continue
+                # The similarity is the fraction of the text's trigrams found in the suggestion, so a partly typed title with a typo still matches, and shorter suggestions are preferred when they are equally similar
+                similarity = shared / len(textTrigrams)
+                if similarity >= AUTOCOMPLETEMINSIMILARITY:
+                    scored.append((-similarity, len(suggestions[index][0]), index))
+            found += [score[2] for score in sorted(scored)[:limit - len(found)]]
+        return [suggestions[index] for index in found]
+
+# Defines a PopularityEngine class that keeps a count of the loans of each book on each day, used to find the most popular and trending books
+# The counts are updated when a loan is made, so finding popular books only sums the counts for the days in the time window instead of counting every loan
+class PopularityEngine():
+
+    # Constructor for the PopularityEngine class
+    # Takes the filename of the SQLite database file as a parameter
+    # Initialises an instance of TTLCache to store the popular and trending books
+    def __init__(self, dbName):
+        self.db = Database(dbName)
+        self.cache = TTLCache(32, POPULARITYCACHETTL)
+
+    # Method to add a loan to the book's count for the day the loan started, using the Database object passed as a parameter so that it is part of the same transaction as the loan
+    def recordLoan(self, db, bookID, loanStartDate):
+        query = """INSERT INTO BookDailyLoans (BookID, LoanDate, LoanCount) VALUES (?, ?, 1) ON CONFLICT (BookID, LoanDate) DO UPDATE SET LoanCount = LoanCount + 1"""
+        params = (bookID, loanStartDate)
+        db.execute(query, params)
+
+    # Method to retrieve books that have not been decommissioned along with their status and cover image, ordered by a score calculated from BookDailyLoans by the subquery passed as a parameter
+    # Returns a list of up to limit tuples containing the bookID, book status, cover image and score of each book
+    def getRankedBooks(self, scoreQuery, params, limit):
+        self.db.connect()
+        query = f"""SELECT Book.BookID, CASE 
+        WHEN BookAvailability.AvailableCopies > 0 THEN 'Available'
+        ELSE 'On Loan'
+    END AS BookStatus,
+    Book.CoverImageURL, Scores.Score FROM ({scoreQuery}) AS Scores INNER JOIN Book ON Scores.BookID = Book.BookID INNER JOIN BookAvailability ON Book.BookID = BookAvailability.BookID WHERE BookAvailability.Decommissioned = 0 AND Scores.Score > 0 ORDER BY Scores.Score DESC, Book.BookID LIMIT ?"""
+        self.db.execute(query, params + (limit, ))
+        books = self.db.fetchAll()
+        self.db.close()
+        return books
+
+    # Method to retrieve the most popular books in the library, which are the books loaned most in the last number of days, e.g. 7, 30 or 365
+    # Returns a list of up to limit tuples containing the bookID, book status, cover image and number of loans of each book, most popular first
+    def getPopularBooks(self, days, limit):
+        key = ('Popular', days, limit)
+        popularBooks = self.cache.get(key)
+        if popularBooks is None:
+            # Groups by +BookID so that SQLite searches BookDailyLoansDateIndex for the date range instead of scanning the whole table in BookID order to avoid sorting
+            scoreQuery = """SELECT BookID, SUM(LoanCount) AS Score FROM BookDailyLoans WHERE LoanDate > ? GROUP BY +BookID"""
+            params = (date.today() - datetime.timedelta(days=days), )
+            popularBooks = self.getRankedBooks(scoreQuery, params, limit)
+            self.cache.set(key, popularBooks)
+        return popularBooks
+
+    # Method to retrieve the trending books in the library, which are the books whose number of loans in the last week has increased the most compared to the week before
+    # Returns a list of up to limit tuples containing the bookID, book status, cover image and increase in loans of each book, biggest increase first
+    def getTrendingBooks(self, limit):
+        key = ('Trending', limit)
+        trendingBooks = self.cache.get(key)
+        if trendingBooks is None:
+            scoreQuery = """SELECT BookID, SUM(CASE WHEN LoanDate > ? THEN LoanCount ELSE -LoanCount END) AS Score FROM BookDailyLoans WHERE LoanDate > ? GROUP BY +BookID"""
+            today = date.today()
+            params = (today - datetime.timedelta(days=7), today - datetime.timedelta(days=14))
+            trendingBooks = self.getRankedBooks(scoreQuery, params, limit)
+            self.cache.set(key, trendingBooks)
+        return trendingBooks
+
+    # Method to remove the cached popular and trending books so they are read again on the next request, called after a loan is made
+    def clear(self):
+        self.cache.clear()
+
+# Defines a BookshelfManager class that builds the bookshelves shared by every reader on the browse books page
+class BookshelfManager():
+
+    # Constructor for the BookshelfManager class
+    # Takes an instance of the PopularityEngine class as a parameter
+    # Takes the filename of the SQLite database file as a parameter
+    # Initialises an instance of TTLCache to store the shelves for a short time
+    def __init__(self, popularityEngine, dbName):
+        self.popularityEngine = popularityEngine
+        self.db = Database(dbName)
+        self.cache = TTLCache(1, SHELFCACHETTL)
+
+    # Method to retrieve every book that has not been decommissioned in one query, along with its availability
+    # The availability of each book is read from its BookAvailability row, instead of counting its copies once for every shelf
+    def getCatalogue(self):
+        self.db.connect()
+        query = """SELECT Book.BookID,
+            CASE
+                WHEN BookAvailability.AvailableCopies > 0 THEN 'Available'
+                ELSE 'On Loan'
+            END AS BookStatus,
+            Book.CoverImageURL, Book.Genre, Book.DateAdded
+        FROM Book
+        INNER JOIN BookAvailability ON Book.BookID = BookAvailability.BookID
+        WHERE BookAvailability.Decommissioned = 0
+        ORDER BY Book.BookID"""
+        self.db.execute(query)
+        catalogue = self.db.fetchAll()
+        self.db.close()
+        return catalogue
+
+    # Method to split the Genre field of a book into its separate genres, e.g. 'Dystopian/Young Adult' becomes ['dystopian', 'young adult']
+    def getGenres(self, genreField):
+        return [genre.strip().lower() for genre in genreField.split("/") if genre.strip()]
+
+    # Method to build the New and genre bookshelves from one pass over the catalogue, and the Popular and Trending bookshelves from the PopularityEngine
+    # Takes the earliest date a book can have been added to appear on the New shelf as a parameter
+    # The genres shown are the most common genres in the library rather than a fixed list
+    # Returns the list of new books and a list of (shelf title, list of books) tuples, where each book is a tuple of its bookID, status and cover image
+    def buildShelves(self, newSince):
+        catalogue = self.getCatalogue()
+        newBooks = []
+        genreBooks = {}
+        for bookID, status, coverImage, genreField, dateAdded in catalogue:
+            shelfBook = (bookID, status, coverImage)
+            if dateAdded is not None and dateAdded >= newSince:
+                newBooks.append(shelfBook)
+            for genre in set(self.getGenres(genreField)):
+                genreBooks.setdefault(genre, []).append(shelfBook)
+        bookshelves = [('Popular', self.popularityEngine.getPopularBooks(POPULARSHELFDAYS, POPULARSHELFSIZE)), ('Trending', self.popularityEngine.getTrendingBooks(POPULARSHELFSIZE))]
+        topGenres = sorted(genreBooks, key=lambda genre: (-len(genreBooks[genre]), genre))[:GENRESHELFCOUNT]
+        for genre in topGenres:
+            bookshelves.append((genre.title(), genreBooks[genre]))
+        return newBooks, bookshelves
+
+    # Method to get the shared bookshelves, from the cache if they were built recently
+    def getShelves(self, newSince):
+        shelves = self.cache.get(newSince)
+        if shelves is None:
+            shelves = self.buildShelves(newSince)
+            self.cache.set(newSince, shelves)
+        return shelves
+
+    # Method to remove the cached shelves so they are rebuilt on the next request, called when books are added or deleted
+    def clear(self):
+        self.cache.clear()
 
 # Defines a Book class
 class Book():
@@ -527,181 +1399,133 @@ class Book():
     # Constructor for the Book class
     # Takes the filename of the SQLite database file as a parameter
     # Takes an instance of the NotificationManager class as a parameter
-    def __init__(self, notificationManager, dbName):
+    # Takes an instance of the TTLCache class that stores readers' recommendations as a parameter
+    # Takes an instance of the PopularityEngine class as a parameter, which the BookshelfManager uses for the Popular and Trending bookshelves
+    # Initialises an instance of RecommendationIndex, an instance of AutocompleteIndex and an instance of BookshelfManager
+    def __init__(self, notificationManager, recommendationCache, popularityEngine, dbName):
         self.notificationManager = notificationManager
+        self.recommendationCache = recommendationCache
         self.db = Database(dbName)
-    
+        self.recommendationIndex = RecommendationIndex(dbName)
+        self.autocompleteIndex = AutocompleteIndex(dbName)
+        self.bookshelfManager = BookshelfManager(popularityEngine, dbName)
+        self.searchCursor = SearchCursor()
+        # Books can be sorted by their title, ISBN or the first of their authors' names, which is found by a subquery rather than by joining every author so that co-authored books appear only once
+        # Searches that match words in the BookSearch full-text index can also be sorted by relevance using the bm25 ranking function, which gives better matches lower scores
+        sortKeys = {"AuthorFirstName": "(SELECT IFNULL(MIN(Author.AuthorFirstName), '') FROM AuthorBook INNER JOIN Author ON AuthorBook.AuthorID = Author.AuthorID WHERE AuthorBook.BookID = Book.BookID)",
+                    "AuthorLastName": "(SELECT IFNULL(MIN(Author.AuthorLastName), '') FROM AuthorBook INNER JOIN Author ON AuthorBook.AuthorID = Author.AuthorID WHERE AuthorBook.BookID = Book.BookID)",
+                    "Title": "IFNULL(Book.Title, '')",
+                    "ISBN": "IFNULL(Book.ISBN, '')"}
+        self.searchQuery = QueryBuilder("BookID, Title, CoverImageURL", """SELECT Book.BookID, Book.Title, Book.CoverImageURL, {sortKey} AS SortKey, Book.BookID AS UniqueKey FROM Book INNER JOIN BookAvailability ON Book.BookID = BookAvailability.BookID WHERE BookAvailability.Decommissioned = 0""", sortKeys, "Title")
+        self.matchSearchQuery = QueryBuilder("BookID, Title, CoverImageURL", """SELECT Book.BookID, Book.Title, Book.CoverImageURL, {sortKey} AS SortKey, Book.BookID AS UniqueKey FROM Book INNER JOIN BookAvailability ON Book.BookID = BookAvailability.BookID INNER JOIN BookSearch ON BookSearch.rowid = Book.BookID WHERE BookSearch MATCH :match AND BookAvailability.Decommissioned = 0""", dict(sortKeys, Relevance="bm25(BookSearch)"), "Title")
+    
+    # Method to convert text entered by a reader into an FTS5 full-text query where every word must match the start of a word in the book
+    # Takes an optional column name as a parameter, to only match words in that column of the BookSearch table
+    # Returns None if the text contains no words
+    def getMatchExpression(self, text, column=None):
+        words = re.findall(r"\w+", text.lower())
+        if not words:
+            return None
+        # Each word is quoted so that FTS5 does not treat it as an operator, and followed by * to match it as a prefix
+        expression = " ".join(f'"{word}"*' for word in words)
+        if column:
+            return f"{column} : ({expression})"
+        return expression
+
     # Method that allows a reader to search for books by two methods
-    def searchBook(self, orderByField, orderByDirection, searchString=None, authorFirstName=None, authorLastName=None, bookTitle=None, bookISBN=None, bookGenre=None):
-        self.db.connect()
+    # Both methods search the BookSearch full-text index, and the results can be ordered by relevance using the bm25 ranking function
+    # Each book appears once, and the results are returned one page at a time, starting after the book in the cursor token if one is given
+    # Returns the page of books and the cursor token for the next page, or None if this is the last page
+    def searchBook(self, orderByField, orderByDirection, searchString=None, authorFirstName=None, authorLastName=None, bookTitle=None, bookISBN=None, bookGenre=None, after=None, pageSize=None):
+        pageSize = self.searchCursor.getPageSize(pageSize)
+        cursor = self.searchCursor.decode(after, 2)
         # The reader can specify whether they would like the results to be ordered by a particular field in a particular direction and these values will be passed as parameters to either query otherwise the results are ordered by title in ascending order by default
-        if not orderByDirection:
-                orderByDirection = "ASC"
-        if not orderByField:
-            orderByField = "Title"
-        # If the user has entered a search string, that is passed to an SQL query to retrieve all books whose title, genre, or author name matches that string
+        # If the user has entered a search string, all the words in it must match the title, genre, author names, ISBN or blurb of the book
         if searchString:
-            query = f"""
-            SELECT Book.BookID, Book.Title, Book.CoverImageURL FROM Book INNER JOIN AuthorBook ON Book.BookID = AuthorBook.BookID INNER JOIN Author ON AuthorBook.AuthorID = Author.AuthorID WHERE LOWER(Author.AuthorFirstName) LIKE ? OR LOWER(Author.AuthorLastName) LIKE ? OR LOWER(Book.Title) LIKE ? OR LOWER(Book.Genre) LIKE ? AND Book.BookID NOT IN (
-            SELECT BookID
-            FROM BookCopy
-            WHERE Status = 'Decommissioned'
-        ) ORDER BY {orderByField} {orderByDirection}
-            """
-            params = tuple([f"%{searchString.lower()}%"] * 4)
-            self.db.execute(query, params)
-            searchResults = self.db.fetchAll()
-            self.db.close()
-            print(searchResults)
-            return searchResults
+            matchExpressions = [self.getMatchExpression(searchString)]
         # Or the reader can also use advanced search functionality and search specifically by an author's first name, last name, book title, isbn or genre
         else:
-            query = f"SELECT Book.BookID, Book.Title, Book.CoverImageURL FROM Book INNER JOIN AuthorBook ON Book.BookID = AuthorBook.BookID INNER JOIN Author ON AuthorBook.AuthorID = Author.AuthorID WHERE 1=1"
-            params = ()
-            print(authorFirstName)
-            if authorFirstName:
-                print("Author First Name:", authorFirstName)
-                query += " AND LOWER(Author.AuthorFirstName) LIKE ?"
-                params += (f"%{authorFirstName.lower()}%", )
-            if authorLastName:
-                print("Author Last Name:", authorLastName)
-                query += " AND LOWER(Author.AuthorLastName) LIKE ?"
-                params += (f"%{authorLastName.lower()}%", )
-            if bookTitle:
-                query += " AND LOWER(Book.Title) LIKE ?"
-                params += (f"%{bookTitle.lower()}%", )
-            if bookISBN:
-                query += " AND LOWER(Book.ISBN) LIKE ?"
-                params += (f"%{bookISBN.lower()}%", )
-            if bookGenre:
-                query += " AND LOWER(Book.Genre) LIKE ?"
-                params += (f"%{bookGenre.lower()}%", )
-            query += f""" AND Book.BookID NOT IN (
-            SELECT BookID
-            FROM BookCopy
-            WHERE Status = 'Decommissioned' ) ORDER BY {orderByField} {orderByDirection}"""
-            
-            print(query)
-            print(params)
-            
-            self.db.execute(query, params)
-            searchResults = self.db.fetchAll()
-            self.db.close()
-            print(searchResults)
-            return searchResults
-    
-    # Method to retrieve new books to the library
-    # Takes in a date as a parameter, and returns any books added to the library after this date
-    def getNewBooks(self, date):
+            matchExpressions = []
+            for column, text in [("AuthorFirstNames", authorFirstName), ("AuthorLastNames", authorLastName), ("Title", bookTitle), ("ISBN", bookISBN), ("Genre", bookGenre)]:
+                if text:
+                    matchExpressions.append(self.getMatchExpression(text, column))
+        # If any text that was entered has no words, such as only punctuation, no book can match it, so there are no results rather than every book
+        if None in matchExpressions:
+            return [], None
+        # The statement for the chosen sort field and direction is built by the query builder, which only allows the sort fields and directions it knows
+        if matchExpressions:
+            query = self.matchSearchQuery.build(orderByField, orderByDirection)
+            params = self.matchSearchQuery.getParams({"match": " AND ".join(matchExpressions)}, cursor, pageSize + 1)
+        else:
+            query = self.searchQuery.build(orderByField, orderByDirection)
+            params = self.searchQuery.getParams({}, cursor, pageSize + 1)
         self.db.connect()
-        query = """
-        SELECT Book.BookID,
-            CASE
-                WHEN EXISTS (SELECT 1
-                    FROM BookCopy
-                    WHERE BookCopy.BookID = Book.BookID
-                    AND BookCopy.Status = 'Available') THEN 'Available'
-                ELSE 'On Loan'
-            END AS BookStatus,
-            Book.CoverImageURL
-        FROM Book
-        WHERE DateAdded >= ?
-        AND Book.BookID NOT IN (
-            SELECT BookID
-            FROM BookCopy
-            WHERE Status = 'Decommissioned'
-        );
-        """
-        params = (date, )
-        self.db.execute(query, params) 
-        newBooks = self.db.fetchAll()
+        self.db.execute(query, params)
+        searchResults = self.db.fetchAll()
         self.db.close()
-        return newBooks
-    
-    # Method to create and populate CSV file with the fields Title, Genre, AuthorName and PublisherName for all the books in the SQLite database
-    def generateBooksCSV(self):
-        self.db.connect()
-        query = "SELECT Book.Title, Book.Genre, Author.AuthorFirstName || '' || Author.AuthorLastName, Publisher.PublisherName FROM Book INNER JOIN AuthorBook ON Book.BookID = AuthorBook.BookID INNER JOIN Author ON AuthorBook.AuthorID = Author.AuthorID INNER JOIN Publisher ON Book.PublisherID = Publisher.PublisherID"
-        df = pd.read_sql(query, self.db.con)
-        headers = ["Title", "Genre", "AuthorName", "PublisherName"]
-        df.to_csv('librarybooks.csv', index=False, header=headers)
-    
-    # Method to build a recommendations algorithm
-    def recommender(self, bookTitle):
-        # Opens the created CSV file as a data frame, converts the Title and Publisher fields' data to lowercase
-        df = pd.read_csv('librarybooks.csv', on_bad_lines='skip', sep=",")
-        df['Title'] = df['Title'].str.lower()
-        df['PublisherName'] = df['PublisherName'].str.lower()
-        # Concatenates all the columns except the first index column into a single string separated by spaces
-        df['data'] = df[df.columns[1:]].apply(
-            lambda x: ' '.join(x.dropna().astype(str)),
-            axis=1
-        )
-        # Then creates a matrix using the Count Vectorizer object whcih counts the frequency of each value in the entire file and converts them into a vector representation
-        vectorizer = CountVectorizer()
-        vectorized = vectorizer.fit_transform(df['data'])
-        # Uses a cosine similarity function to find the angle between two vectors and applies this to every vector in vectorized, this will be based on the genre of the books their author, publisher or title
-        similarities = cosine_similarity(vectorized)
-        # Creates a new dataframe that has book title as the index and the title of all the other books as column with every value being the similarity between those two book titles
-        df = pd.DataFrame(similarities, columns=df['Title'], index=df['Title']).reset_index()
-        # Retrieves the top 6 most similar books to the parameter bookTitle and filters out bookTitle from this result
-        recommendations = pd.DataFrame(df.nlargest(6, bookTitle)['Title'])
-        recommendations = recommendations[recommendations['Title']!=bookTitle]
-        # Returns a list of recommendations
-        return recommendations['Title'].tolist()
+        return self.searchCursor.getPage(searchResults, pageSize, 2)
+
+    # Method to add or replace the row for a book in the BookSearch full-text index, using the current connection so that it is part of the same transaction
+    def refreshSearchIndex(self, bookID):
+        self.db.execute("DELETE FROM BookSearch WHERE rowid = ?", (bookID, ))
+        self.db.execute(BOOKSEARCHINSERT + " WHERE Book.BookID = ? GROUP BY Book.BookID", (bookID, ))
+
+    # Method to recalculate the BookAvailability row for a book, using the current connection so that it is part of the same transaction as the change to its copies
+    def refreshAvailability(self, bookID):
+        self.db.execute(BOOKAVAILABILITYREFRESH + " WHERE Book.BookID = ?", (bookID, ))
     
     # Method to retrieve recommended books for a reader based on their past history by applying the recommendation algorithm
+    # The recommendations are cached for each reader until they expire or until the reader loans or reviews a book
     def getRecommendedBooks(self, readerID):
+        recommendedBooks = self.recommendationCache.get(readerID)
+        if recommendedBooks is not None:
+            return recommendedBooks
+        recommendedBooks = self.calculateRecommendedBooks(readerID)
+        self.recommendationCache.set(readerID, recommendedBooks)
+        return recommendedBooks
+
+    # Method to calculate recommended books for a reader from their recent loans and reviews
+    def calculateRecommendedBooks(self, readerID):
         self.db.connect()
-        # Retrieves the book titles of the reader's 5 most recent loans and the book titles of the 5 highest rated reviews left by the reader where the ratings are 3 stars or above.
-        query = """SELECT Book.Title FROM Loan INNER JOIN Book ON Loan.BookID = Book.BookID WHERE Loan.ReaderID = ? ORDER BY LoanStartDate DESC"""
+        # Retrieves the books of the reader's 5 most recent loans and the books and ratings of the 5 highest rated reviews left by the reader where the ratings are 3 stars or above.
+        query = """SELECT Loan.BookID FROM Loan WHERE Loan.ReaderID = ? ORDER BY LoanStartDate DESC"""
         params = (readerID, )
         self.db.execute(query, params)
-        loanTitles = [result[0] for result in self.db.fetchMany(5)]  
-        query2 = """SELECT Book.Title FROM Review INNER JOIN Book ON Review.BookID = Book.BookID WHERE Review.Rating >= 3 AND Review.ReaderID = ? ORDER BY Review.Rating DESC"""
+        loanBookIDs = [result[0] for result in self.db.fetchMany(5)]
+        query2 = """SELECT Review.BookID, Review.Rating FROM Review WHERE Review.Rating >= 3 AND Review.ReaderID = ? ORDER BY Review.Rating DESC"""
         self.db.execute(query2, params)
-        reviewTitles = [result[0] for result in self.db.fetchMany(5)]
-        print(loanTitles, reviewTitles)
-        # Calls the generateBooksCSV function to create the CSV file, before calling the recommender function on each title and adding the recommended titles to a recommendations list if they are not already in it
-        self.generateBooksCSV()
-        recommendations = []
-        for title in loanTitles:
-            recs = self.recommender(title.lower())
-            for rec in recs:
-                if rec not in recommendations:
-                    recommendations.append(rec)
-                    
-        for title in reviewTitles:
-            recs = self.recommender(title.lower())
-            for rec in recs:
-                if rec not in recommendations:
-                    recommendations.append(rec)
+        reviewRatings = self.db.fetchMany(5)
+        # The connection is returned to the pool while the recommendation index is used, as the index may need a connection of its own to build itself
+        self.db.close()
+        # Loans and high ratings are different signals, so each seed book is given a weight, which is added up if a book is both loaned and reviewed
+        seedWeights = {}
+        for bookID in loanBookIDs:
+            seedWeights[bookID] = seedWeights.get(bookID, 0) + LOANSEEDWEIGHT
+        for bookID, rating in reviewRatings:
+            seedWeights[bookID] = seedWeights.get(bookID, 0) + REVIEWSEEDWEIGHT * int(rating) / 5
+        # Scores every book against all the seed books in one pass of the recommendation index
+        recommendations = self.recommendationIndex.getRecommendations(seedWeights, RECOMMENDATIONSHELFSIZE)
+        if not recommendations:
+            return []
         
-        recommendedBooks = [] 
-        # Retrieves book information for each recommended book 
-        for title in recommendations:
-            query3 = """SELECT Book.BookID,
-            CASE
-                WHEN EXISTS (SELECT 1
-                    FROM BookCopy
-                    WHERE BookCopy.BookID = Book.BookID
-                    AND BookCopy.Status = 'Available')
-                THEN 'Available'
-                ELSE 'On Loan'
-            END AS BookStatus,
-            Book.CoverImageURL
-            FROM Book
-            WHERE LOWER(Title) = ? AND Book.BookID NOT IN (
-                SELECT BookID
-                FROM BookCopy
-                WHERE Status = 'Decommissioned'
-            );"""
-            params3 = (title, )
-            self.db.execute(query3, params3)
-            book = self.db.fetchOne()
-            recommendedBooks.append(book)
+        # Retrieves book information for all the recommended books in a single query
+        self.db.connect()
+        placeholders = ", ".join("?" * len(recommendations))
+        query3 = f"""SELECT Book.BookID,
+        CASE
+            WHEN BookAvailability.AvailableCopies > 0 THEN 'Available'
+            ELSE 'On Loan'
+        END AS BookStatus,
+        Book.CoverImageURL
+        FROM Book
+        INNER JOIN BookAvailability ON Book.BookID = BookAvailability.BookID
+        WHERE Book.BookID IN ({placeholders}) AND BookAvailability.Decommissioned = 0;"""
+        params3 = tuple(recommendation[0] for recommendation in recommendations)
+        self.db.execute(query3, params3)
+        books = {row[0]: row for row in self.db.fetchAll()}
         self.db.close()
-        # Returns recommended books
+        # Returns recommended books ranked by score, where each tuple contains the bookID, book status, cover image and score
+        recommendedBooks = [books[bookID] + (score, ) for bookID, score in recommendations if bookID in books]
         return recommendedBooks
 
     # Method to get information about a given book
@@ -721,19 +1545,10 @@ class Book():
             WHERE Review.BookID = Book.BookID
         ) AS RatingAverage,
         CASE
-            WHEN EXISTS (
-                SELECT 1
-                FROM BookCopy
-                WHERE BookCopy.BookID = Book.BookID
-                AND BookCopy.Status = 'Available'
-            ) THEN 'Loan Book'
+            WHEN BookAvailability.AvailableCopies > 0 THEN 'Loan Book'
             ELSE 'Reserve Book'
         END AS BookStatus 
-    FROM Book INNER JOIN AuthorBook ON Book.BookID = AuthorBook.BookID INNER JOIN Author ON AuthorBook.AuthorID = Author.AuthorID INNER JOIN Publisher ON Book.PublisherID = Publisher.PublisherID WHERE Book.BookID = ? AND Book.BookID NOT IN (
-            SELECT BookID
-            FROM BookCopy
-            WHERE Status = 'Decommissioned'
-        );
+    FROM Book INNER JOIN BookAvailability ON Book.BookID = BookAvailability.BookID INNER JOIN AuthorBook ON Book.BookID = AuthorBook.BookID INNER JOIN Author ON AuthorBook.AuthorID = Author.AuthorID INNER JOIN Publisher ON Book.PublisherID = Publisher.PublisherID WHERE Book.BookID = ? AND BookAvailability.Decommissioned = 0;
         """
         params = (bookID, )
         self.db.execute(query, params)
@@ -741,93 +1556,61 @@ class Book():
         self.db.close()
         return bookInfo
     
-    # Method to return all the books in a library that are in a particular genre
-    # Takes book genre as a parameter and returns books whose Genre field contains that string
-    def getBookInGenre(self, genre):
-        self.db.connect()
-        query = query = """
-        SELECT Book.BookID,
-            CASE
-                WHEN EXISTS (SELECT 1
-                    FROM BookCopy
-                    WHERE BookCopy.BookID = Book.BookID
-                    AND BookCopy.Status = 'Available')
-                THEN 'Available'
-                ELSE 'On Loan'
-            END AS BookStatus,
-            Book.CoverImageURL
-        FROM Book
-        WHERE LOWER(Genre) LIKE ? AND Book.BookID NOT IN (
-            SELECT BookID
-            FROM BookCopy
-            WHERE Status = 'Decommissioned'
-        );
-        """
-        genre = "%" + genre + "%"
-        params = (genre, )
-        self.db.execute(query, params)
-        booksInGenre = self.db.fetchAll()
-        self.db.close()
-        return booksInGenre
-    
-    # Method to retrieve the most popular books in the library
-    def getPopularBooks(self):
-        self.db.connect()
-        # Query retrieves the number of loans for each book in the library and orders the results by loan count descending, so the most popular books are first
-        query = """SELECT Book.BookID, CASE 
-        WHEN EXISTS (
-            SELECT 1
-            FROM BookCopy
-            WHERE BookCopy.BookID = Loan.BookID
-            AND BookCopy.Status = 'Available'
-        ) THEN 'Available'
-        ELSE 'On Loan'
-    END AS BookStatus,
-    Book.CoverImageURL,
-    COUNT(*) AS LoanCount FROM Loan INNER JOIN 
-    Book ON Loan.BookID = Book.BookID WHERE strftime('%m', LoanStartDate) = strftime('%m', 'now') AND Book.BookID NOT IN (
-            SELECT BookID
-            FROM BookCopy
-            WHERE Status = 'Decommissioned'
-        ) GROUP BY Loan.BookID, BookStatus ORDER BY LoanCount DESC;"""
-        params = ()
-        self.db.execute(query, params)
-        popularBooks = self.db.fetchAll()
-        self.db.close()
-        return popularBooks
-    
     # Method to delete a book from the library, if physical copy is missing or has been overdue for a long time
     # This is rare, so the book is not fully deleted as it could be retrieved at a later date
+    # The book's copies, loans, reservations and notifications are changed in one transaction, and the connection is returned to the pool before the indexes and caches are rebuilt, as they check out connections of their own
     def deleteBook(self, bookID):
-        # The BookCopy status is updated to decommissioned so it will no longer appear in query results from the database and will in effect be inaccessible to readers
         self.db.connect()
-        query = """UPDATE BookCopy SET Status = 'Decommissioned' WHERE BookID = ?"""
-        params = (bookID, )
-        self.db.execute(query, params)
-        self.db.commit()
-        
-        # Any active loans for that book are cancelled, and the notifyLoanCancelled method of notificationManager is called, to notify readers of this
-        query2 = """SELECT LoanID, ReaderID FROM Loan WHERE BookID = ?"""
-        self.db.execute(query2, params)
-        loans = self.db.fetchAll()
-        if loans:
+        self.db.begin()
+        notifiedReaderIDs = set()
+        try:
+            # The BookCopy status is updated to decommissioned so it will no longer appear in query results from the database and will in effect be inaccessible to readers
+            query = """UPDATE BookCopy SET Status = 'Decommissioned' WHERE BookID = ?"""
+            params = (bookID, )
+            self.db.execute(query, params)
+            # The book is removed from the full-text search index and marked as decommissioned in its BookAvailability row
+            self.db.execute("DELETE FROM BookSearch WHERE rowid = ?", params)
+            self.refreshAvailability(bookID)
+            
+            # Any active loans for that book are cancelled, and the notifyLoanCancelled method of notificationManager is called, to notify readers of this
+            query2 = """SELECT LoanID, ReaderID FROM Loan WHERE BookID = ?"""
+            self.db.execute(query2, params)
+            loans = self.db.fetchAll()
             for loan in loans:
                 query3 = """UPDATE Loan SET LoanStatus = 'Cancelled' WHERE LoanID = ? AND LoanEndDate > DATE('now')"""
                 params3 = (loan[0], )
                 self.db.execute(query3, params3)
-                self.db.commit()
-                self.notificationManager.notifyLoanCancelled(loan[0], loan[1], bookID)
-        # Any reservations for that book are cancelled and the notifyReservationCancelled method of notificationManager is called to notify readers of this change       
-        query4 = "SELECT ReservationID, ReaderID FROM Reservation WHERE BookID = ?"
-        self.db.execute(query4, params)
-        reservations = self.db.fetchAll()
-        if reservations:
-            for reservation in reservations:
-                query5 = """UPDATE Reservation SET ReservationStatus = 'Cancelled' WHERE ReservationID = ?"""
-                params5 = (reservation[0], )
-                self.db.execute(query5, params5)
-                self.db.commit()
-                self.notificationManager.notifyReservationCancelled(reservation[0], reservation[1], bookID)
+                self.notificationManager.notifyLoanCancelled(loan[0], loan[1], bookID, self.db)
+                notifiedReaderIDs.add(loan[1])
+            # Any reservations for that book are cancelled and the notifyReservationCancelled method of notificationManager is called to notify readers of this change       
+            query4 = "SELECT ReservationID, ReaderID FROM Reservation WHERE BookID = ?"
+            self.db.execute(query4, params)
+            reservations = self.db.fetchAll()
+            if reservations:
+                for reservation in reservations:
+                    query5 = """UPDATE Reservation SET ReservationStatus = 'Cancelled' WHERE ReservationID = ?"""
+                    params5 = (reservation[0], )
+                    self.db.execute(query5, params5)
+                    self.notificationManager.notifyReservationCancelled(reservation[0], reservation[1], bookID, self.db)
+                    notifiedReaderIDs.add(reservation[1])
+                # The book no longer has any pending reservations
+                self.db.execute("UPDATE BookAvailability SET PendingReservations = 0 WHERE BookID = ?", params)
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            raise
+        finally:
+            self.db.close()
+        
+        # The book is removed from the recommendation index so it is no longer recommended to readers, and every reader's cached recommendations are removed
+        self.recommendationIndex.deleteBook(bookID)
+        self.recommendationCache.clear()
+        # The autocomplete suggestions and the bookshelves are rebuilt so the book is no longer shown
+        self.autocompleteIndex.build()
+        self.bookshelfManager.clear()
+        # The readers who were notified have a new notification, so their cached notification counts are removed
+        for readerID in notifiedReaderIDs:
+            self.notificationManager.countCache.invalidate(readerID)
     
     # Method to retrieve all existing author names in the database to populate the choices attribute of the author name field of the AddBookForm, to allow the librarian to choose an existing author as the author of a new book 
     def getAuthorOptions(self):
@@ -855,145 +1638,214 @@ class Book():
     # Method to add a new book to the library
     # Takes in parameters of title, genre ISBN13, year publisher, publisher and a list of bookAuthors which may contain more than one value if there are multiple author, the cover image link, the number of copies of the book being added to the library and the accession number of the aquisition
     def addBook(self, title, genre, isbn13, yearPublished, publisher, bookAuthors, blurb, minYearGroup, coverImageLink, numberOfCopies, accessionNumber):
+        # The book, its authors, publisher and copies are inserted in one transaction, and the connection is returned to the pool before the indexes and caches are rebuilt, as they check out connections of their own
         self.db.connect()
-        # For each author in bookAuthors, the author's name is queried from the database and if the author already exists in the database their authorID is fetched, if not they are inserted as a new author in the database and their row ID is fetched
-        authorIDs = []
-        for author in bookAuthors:
-            authorNames = author.split()
-            authorFirstName = ' '.join(authorNames[:-1])
-            authorLastName = authorNames[-1]
+        self.db.begin()
+        try:
+            # For each author in bookAuthors, the author's name is queried from the database and if the author already exists in the database their authorID is fetched, if not they are inserted as a new author in the database and their row ID is fetched
+            authorIDs = []
+            for author in bookAuthors:
+                authorNames = author.split()
+                authorFirstName = ' '.join(authorNames[:-1])
+                authorLastName = authorNames[-1]
+                
+                query = """SELECT AuthorID FROM Author WHERE AuthorFirstName = ? and AuthorLastName = ?"""
+                params = (authorFirstName, authorLastName)
+                self.db.execute(query, params)
+                existingAuthor = self.db.fetchOne()
+                
+                if existingAuthor:
+                    authorID = existingAuthor[0]
+                else:
+                    query2 = """INSERT INTO Author (AuthorFirstName, AuthorLastName) VALUES (?, ?)"""
+                    self.db.execute(query2, params)
+                    authorID = self.db.getLastRowID()
+                
+                authorIDs.append(authorID)
+                
+            # The publisher's name is queried and if it doesn't already exist in the database it is inserted and the row ID of that insertion is retrieved else the ID of the existing publisher record is returned
+            query3 = """SELECT PublisherID FROM Publisher WHERE PublisherName = ?"""
+            params3 = (publisher, )
+            self.db.execute(query3, params3)
+            existingPublisher = self.db.fetchOne()
+            if existingPublisher:
+                publisherID = existingPublisher[0]
+            else:
+                query4 = """INSERT INTO Publisher (PublisherName) VALUES (?)"""
+                self.db.execute(query4, params3)
+                publisherID = self.db.getLastRowID()
             
-            query = """SELECT AuthorID FROM Author WHERE AuthorFirstName = ? and AuthorLastName = ?"""
-            params = (authorFirstName, authorLastName)
-            self.db.execute(query, params)
-            existingAuthor = self.db.fetchOne()
+            # Inserts the book information into the book table
+            dateAdded = date.today()
+            query5 = """INSERT INTO Book (ISBN, Title, Genre, YearPublished, PublisherID, DateAdded, Blurb, MinYearGroup, CoverImageURL) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+            params5 = (isbn13, title, genre, yearPublished, publisherID, dateAdded, blurb, minYearGroup, coverImageLink)
+            self.db.execute(query5, params5)
+            bookID = self.db.getLastRowID()
             
-            if existingAuthor:
-                authorID = existingAuthor[0]
-            else:
-                query2 = """INSERT INTO Author (AuthorFirstName, AuthorLastName) VALUES (?, ?)"""
-                self.db.execute(query2, params)
-                authorID = self.db.getLastRowID()
-                self.db.commit()
+            # Inserts the author information into the AuthorBook linking table
+            for id in authorIDs:
+                query6 = """INSERT INTO AuthorBook (AuthorID, BookID) VALUES (?, ?)"""
+                params6 = (id, bookID)
+                self.db.execute(query6, params6)
             
-            authorIDs.append(authorID)
+            # Adds the book and its authors to the full-text search index
+            self.refreshSearchIndex(bookID)
             
-        # The publisher's name is queried and if it doesn't already exist in the database it is inserted and the row ID of that insertion is retrieved else the ID of the existing publisher record is returned
-        query3 = """SELECT PublisherID FROM Publisher WHERE PublisherName = ?"""
-        params3 = (publisher, )
-        self.db.execute(query3, params3)
-        existingPublisher = self.db.fetchOne()
-        if existingPublisher:
-            publisherID = existingPublisher[0]
-        else:
-            query4 = """INSERT INTO Publisher (PublisherName) VALUES (?)"""
-            self.db.execute(query4, params)
-            publisherID = self.db.getLastRowID()
-            self.db.commit()
-        
-        # Inserts the book information into the book table
-        dateAdded = date.today()
-        query5 = """INSERT INTO Book (ISBN, Title, Genre, YearPublished, PublisherID, DateAdded, Blurb, MinYearGroup, CoverImageURL) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"""
-        params5 = (isbn13, title, genre, yearPublished, publisherID, dateAdded, blurb, minYearGroup, coverImageLink)
-        self.db.execute(query5, params5)
-        bookID = self.db.getLastRowID()
-        self.db.commit()
-        
-        # Inserts the author information into the AuthorBook linking table
-        for id in authorIDs:
-            query6 = """INSERT INTO AuthorBook (AuthorID, BookID) VALUES (?, ?)"""
-            params6 = (id, bookID)
-            self.db.execute(query6, params6)
+            # Inserts a copy into the BookCopy table for that book for the number of copies added to the library, and creates the BookAvailability row for the book
+            for i in range(numberOfCopies):
+                query7 = """INSERT INTO BookCopy (CopyID, BookID, AccessionNumber, Status) VALUES (?, ?, ?, ?)"""
+                params7 = (i+1, bookID, accessionNumber, 'Available')
+                self.db.execute(query7, params7)
+            self.refreshAvailability(bookID)
             self.db.commit()
-        
-        # Inserts a copy into the BookCopy table for that book for the number of copies added to the library
-        for i in range(numberOfCopies):
-            query7 = """INSERT INTO BookCopy (CopyID, BookID, AccessionNumber, Status) VALUES (?, ?, ?, ?)"""
-            params7 = (i+1, bookID, accessionNumber, 'Available')
-            self.db.execute(query7, params7)
-            self.db.commit()
-        
-        self.db.close()
+        except sqlite3.Error:
+            self.db.rollback()
+            raise
+        finally:
+            self.db.close()
+        # The new book is added to the recommendation index so it can be recommended to readers, and every reader's cached recommendations are removed
+        self.recommendationIndex.addBook(bookID)
+        self.recommendationCache.clear()
+        # The autocomplete suggestions and the bookshelves are rebuilt to include the new book and any new authors
+        self.autocompleteIndex.build()
+        self.bookshelfManager.clear()
         return flash(f"You have successfully added {numberOfCopies} copies of {title} to the library.")       
 
+# Defines a LeaderboardManager class that keeps a count of the loans each reader takes out each month, used to show the readers with the most loans this month on the home page
+# The counts are updated when a loan is made, so showing the leaderboard only reads the top rows for the month instead of counting every loan
+class LeaderboardManager():
+
+    # Constructor for the LeaderboardManager class
+    # Takes the filename of the SQLite database file as a parameter
+    # Initialises an instance of TTLCache to store the leaderboard for each month
+    def __init__(self, dbName):
+        self.db = Database(dbName)
+        self.cache = TTLCache(12, LEADERBOARDCACHETTL)
+
+    # Method to add a loan to the reader's count for the month the loan started, using the Database object passed as a parameter so that it is part of the same transaction as the loan
+    def recordLoan(self, db, readerID, loanStartDate):
+        query = """INSERT INTO ReaderMonthlyLoans (ReaderID, YearMonth, LoanCount) VALUES (?, ?, 1) ON CONFLICT (ReaderID, YearMonth) DO UPDATE SET LoanCount = LoanCount + 1"""
+        params = (readerID, loanStartDate.strftime("%Y-%m"))
+        db.execute(query, params)
+
+    # Method to retrieve the readers with the most loans taken out this month, from the cache if it has not changed
+    # Returns list of tuples containing the readers' username, year group and number of loans, in descending order of number of loans
+    def getLeaderboard(self):
+        yearMonth = date.today().strftime("%Y-%m")
+        leaderboard = self.cache.get(yearMonth)
+        if leaderboard is not None:
+            return leaderboard
+        self.db.connect()
+        query = """SELECT Reader.ReaderUsername, CASE 
+          WHEN Reader.YearGroup = 0 THEN 'Staff'
+          WHEN Reader.YearGroup = 1 THEN 'Librarian'
+          ELSE 'Year ' || CAST(Reader.YearGroup AS TEXT)
+      END AS YearGroupLabel, ReaderMonthlyLoans.LoanCount FROM ReaderMonthlyLoans INNER JOIN Reader ON ReaderMonthlyLoans.ReaderID = Reader.ReaderID WHERE ReaderMonthlyLoans.YearMonth = ? ORDER BY ReaderMonthlyLoans.LoanCount DESC LIMIT ?"""
+        params = (yearMonth, LEADERBOARDSIZE)
+        self.db.execute(query, params)
+        leaderboard = self.db.fetchAll()
+        self.db.close()
+        self.cache.set(yearMonth, leaderboard)
+        return leaderboard
+
+    # Method to remove the cached leaderboards so they are read again on the next request, called after a loan is made
+    def clear(self):
+        self.cache.clear()
+
 # Defines a Loan class 
 class Loan():
     
     # Constructor for the Book class
     # Takes the filename of the SQLite database file as a parameter
     # Takes an instance of the NotificationManager class as a parameter
-    def __init__(self, notificationManager, dbName):
+    # Takes an instance of the TTLCache class that stores readers' recommendations as a parameter
+    # Takes an instance of the ReservationScheduler class as a parameter
+    # Takes an instance of the OverdueEngine class as a parameter
+    # Takes an instance of the LeaderboardManager class and an instance of the PopularityEngine class as parameters
+    def __init__(self, notificationManager, recommendationCache, reservationScheduler, overdueEngine, leaderboardManager, popularityEngine, dbName):
         self.notificationManager = notificationManager
+        self.overdueEngine = overdueEngine
+        self.leaderboardManager = leaderboardManager
+        self.popularityEngine = popularityEngine
+        self.recommendationCache = recommendationCache
+        self.reservationScheduler = reservationScheduler
         self.db = Database(dbName)
     
     # Method to allow the reader to loan a book
+    # The eligibility checks, the choice of copy and the change of its status all happen in one transaction that takes the write lock straight away, so two readers can never loan the same copy and the checkout is committed once
     def loanBook(self, readerID, bookID, bookTitle):
         self.db.connect()
-        # Retrieves the yeaar group of the reader
-        query = "SELECT YearGroup FROM Reader WHERE ReaderID = ?"
-        params = (readerID, )
-        self.db.execute(query, params)
-        yeargroup = self.db.fetchOne()[0]
-        
-        # Retrieves the minimum year group of that is allowed to read the book
-        query2 = "SELECT MinYearGroup FROM Book WHERE Book.BookID = ?"
-        params2 = (bookID, )
-        self.db.execute(query2, params2)
-        minyeargroup = self.db.fetchOne()[0]
-        
-        # Checks is the reader is old enough the read the book, if not displys a message on the screen
-        if (yeargroup < minyeargroup) and (yeargroup not in [0, 1]):
-            return flash("You are not old enough to loan this book.")
-        else:
+        self.db.begin()
+        try:
+            # Retrieves the year group of the reader, the minimum year group that is allowed to read the book and the number of active loans the reader has in one query
+            query = """SELECT Reader.YearGroup, Book.MinYearGroup, (SELECT COUNT(*) FROM Loan WHERE Loan.ReaderID = Reader.ReaderID AND Loan.LoanStatus = 'Active') FROM Reader, Book WHERE Reader.ReaderID = ? AND Book.BookID = ?"""
+            params = (readerID, bookID)
+            self.db.execute(query, params)
+            yeargroup, minyeargroup, activeLoans = self.db.fetchOne()
+            
+            # Checks is the reader is old enough the read the book, if not displys a message on the screen
+            if (yeargroup < minyeargroup) and (yeargroup not in [0, 1]):
+                self.db.rollback()
+                self.db.close()
+                return flash("You are not old enough to loan this book.")
             # Sets the allowance of books a reader is allowed to have out at any given time dependent on their year group, if that are in year 12 or 13 or are a staff member or librarian they have a bigger allowance
             if (yeargroup in [0, 1, 12, 13]):
                 allowance = 5
             else:
                 allowance = 3
-            
-            # Retrieves the number of active loans the reader has
-            query3 = """SELECT COUNT(*) FROM Loan WHERE Loan.ReaderID = ? AND Loan.LoanStatus = 'Active'"""
-            params3 = (readerID, )
-            self.db.execute(query3, params3)
-            activeLoans = self.db.fetchOne()[0]
-            
             # If the number of active loans equals or exceeds their allowance a message is displayed telling them they are not allowed to loan the book
             if activeLoans >= allowance:
+                self.db.rollback()
+                self.db.close()
                 return flash(f"You have reached the limit of {activeLoans} active loans.")
-            else: 
-                # If they are within their allowance, they are allowed to loan the book
-                # Retrieves an available book copy id for that book - there is always one available if this method has run
-                query4 = """SELECT BookCopy.CopyID FROM BookCopy WHERE BookCopy.BookID = ? AND BookCopy.Status = 'Available'"""
-                params4 = (bookID, )
-                self.db.execute(query4, params4)
-                copyID = self.db.fetchOne()[0]
-                
-                # Sets the start date of the loan to today's date and sets the end date as 2 weeks from today's date
-                dateNow = date.today()
-                dateTwoWeeks = date.today() + datetime.timedelta(14)
-                query5 = """INSERT INTO Loan (CopyID, BookID, ReaderID, LoanStartDate, LoanEndDate, LoanStatus) VALUES (?, ?, ?, ?, ?, ?)"""
-                params5 = (copyID, bookID, readerID, dateNow, dateTwoWeeks, 'Active') 
-                self.db.execute(query5, params5)
-                self.db.commit()
-                
-                # Updates the status of the book copy to 'On Loan'
-                query6 = """UPDATE BookCopy SET Status = 'On Loan' WHERE CopyID = ? AND BookID = ?"""
-                params6 = (copyID, bookID)
-                self.db.execute(query6, params6)
-                self.db.commit()
-                
-                # Method to display the due date to the reader in a clear format e.g. Book due on 9th May 2024
-                def addSuffix(myDate):
-                    date_suffix = ["th", "st", "nd", "rd"]
-
-                    if myDate % 10 in [1, 2, 3] and myDate not in [11, 12, 13]:
-                        return date_suffix[myDate % 10]
-                    else:
-                        return date_suffix[0]
-                suffix = addSuffix(int(dateTwoWeeks.strftime("%d").lstrip("0").replace(" 0", " ")))
-                dueDate = dateTwoWeeks.strftime("%d").lstrip("0").replace(" 0", " ") + suffix + " " + dateTwoWeeks.strftime("%B %Y")
-                username = session['username']
-                return flash(f"Hi {username}. You have successfully loaned {bookTitle}! It is due back on {dueDate}")
+            
+            # If they are within their allowance, they are allowed to loan the book
+            # Claims an available copy of the book by updating its status to 'On Loan' only if it is still available, and returns its copyID
+            query2 = """UPDATE BookCopy SET Status = 'On Loan' WHERE rowid = (SELECT rowid FROM BookCopy WHERE BookID = ? AND Status = 'Available' ORDER BY CopyID LIMIT 1) AND Status = 'Available' RETURNING CopyID"""
+            params2 = (bookID, )
+            self.db.execute(query2, params2)
+            claimedCopy = self.db.fetchOne()
+            # If every copy has been loaned since the reader opened the page, no loan is made
+            if claimedCopy is None:
+                self.db.rollback()
+                self.db.close()
+                return flash(f"Sorry, there are no copies of {bookTitle} available to loan. You can reserve it instead.")
+            copyID = claimedCopy[0]
+            
+            # Sets the start date of the loan to today's date and sets the end date as 2 weeks from today's date
+            dateNow = date.today()
+            dateTwoWeeks = date.today() + datetime.timedelta(LOANPERIODDAYS)
+            query3 = """INSERT INTO Loan (CopyID, BookID, ReaderID, LoanStartDate, LoanEndDate, LoanStatus) VALUES (?, ?, ?, ?, ?, ?)"""
+            params3 = (copyID, bookID, readerID, dateNow, dateTwoWeeks, 'Active') 
+            self.db.execute(query3, params3)
+            # Adds the loan to the reader's count for the leaderboard and the book's count for popular books
+            self.leaderboardManager.recordLoan(self.db, readerID, dateNow)
+            self.popularityEngine.recordLoan(self.db, bookID, dateNow)
+            # Updates the BookAvailability row of the book, and commits the whole checkout at once
+            self.db.execute(BOOKAVAILABILITYREFRESH + " WHERE Book.BookID = ?", (bookID, ))
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            self.db.close()
+            raise
+        self.db.close()
+        # The reader's loans have changed so their cached recommendations and the cached leaderboard are removed
+        self.recommendationCache.invalidate(readerID)
+        self.leaderboardManager.clear()
+        self.popularityEngine.clear()
+        
+        # Method to display the due date to the reader in a clear format e.g. Book due on 9th May 2024
+        def addSuffix(myDate):
+            date_suffix = ["th", "st", "nd", "rd"]
+
+            if myDate % 10 in [1, 2, 3] and myDate not in [11, 12, 13]:
+                return date_suffix[myDate % 10]
+            else:
+                return date_suffix[0]
+        suffix = addSuffix(int(dateTwoWeeks.strftime("%d").lstrip("0").replace(" 0", " ")))
+        dueDate = dateTwoWeeks.strftime("%d").lstrip("0").replace(" 0", " ") + suffix + " " + dateTwoWeeks.strftime("%B %Y")
+        username = session['username']
+        return flash(f"Hi {username}. You have successfully loaned {bookTitle}! It is due back on {dueDate}")
     
     # Method to retrieve all the loans for a reader
     # Dual purpose, if readerID is not provided it will retrieve all the loans of the reader currently using the system
@@ -1007,133 +1859,257 @@ class Loan():
             params = (session['readerID'], )
         self.db.execute(query, params)
         loans = self.db.fetchAll()
+        self.db.close()
         return loans
     
     # Method to return a loan, called when the reader presses return button on loan
-    def returnLoan(self, loanID, copyID, bookID):
+    # Ending the loan, handing the copy to the reader at the front of its reservation queue, moving the rest of the queue up and notifying that reader all happen in one transaction, so a failure part way through leaves the database unchanged
+    # The copy and book are read from the loan itself, so only the loan that is being returned can free a copy
+    # Returns an instance of ReturnResult describing what happened, or None if there is no loan with the loanID
+    def returnLoan(self, loanID):
         self.db.connect()
-        # Updates loan status to 'Ended'
-        query = """UPDATE Loan Set LoanStatus = ? WHERE LoanID = ?"""
-        params = ('Ended', loanID)
-        self.db.execute(query, params)
-        self.db.commit()
-        # Updates BookCopy status to 'Available'
-        query2 = """UPDATE BookCopy SET Status = ? WHERE CopyID = ? AND BookID = ?"""
-        params2 = ('Available', copyID, bookID)
-        self.db.execute(query2, params2)
-        self.db.commit()
-        
-        # Checks if there are any reservations for the book that just became available, an retrieves the reservation whose queue position is 1
-        query3 = """SELECT ReservationID FROM Reservation WHERE CopyID = ? AND BookID = ? ORDER BY QueuePosition ASC"""
-        params3 = (copyID, bookID)
-        self.db.execute(query3, params3)
-        reservationID = self.db.fetchOne()
-        
-        # If there is a reservation for the book, that reservation's status is changed from 'Pending' to 'Fulfilled' and the readerID of the reader who made that reservation is returned
-        if reservationID:
-            query4 = """UPDATE Reservation SET ReservationStatus = 'Fulfilled' WHERE ReservationID = ? RETURNING ReaderID"""
-            params4 = (reservationID[0], )
-            self.db.execute(query4, params4)
-            readerID = self.db.fetchOne()[0]
-            self.db.commit()
+        self.db.begin()
+        try:
+            # Updates loan status to 'Ended', only if the loan is still active so that returning a loan twice does not free the copy twice
+            query = """UPDATE Loan SET LoanStatus = 'Ended' WHERE LoanID = ? AND LoanStatus = 'Active' RETURNING CopyID, BookID"""
+            params = (loanID, )
+            self.db.execute(query, params)
+            endedLoan = self.db.fetchOne()
             
-            # A new loan is inserted into the table for the book that just became available that the reservation is for, with status 'Active'
-            dateNow = date.today()
-            dateTwoWeeks = date.today() + datetime.timedelta(14)
-            query5 = """INSERT INTO Loan (CopyID, BookID, ReaderID, LoanStartDate, LoanEndDate, LoanStatus) VALUES (?, ?, ?, ?, ?, ?)"""
-            params5 = (copyID, bookID, readerID, dateNow, dateTwoWeeks, 'Active')
-            self.db.execute(query5, params5)
-            self.db.commit()
-            params6 = ('On Loan', copyID, bookID)
-            self.db.execute(query2, params6)
+            # Retrieves the title of the book to be formatted into a message for the reader
+            query2 = "SELECT Book.Title, Loan.BookID FROM Loan INNER JOIN Book ON Loan.BookID = Book.BookID WHERE Loan.LoanID = ?"
+            self.db.execute(query2, params)
+            loanBook = self.db.fetchOne()
+            if loanBook is None:
+                self.db.rollback()
+                self.db.close()
+                return None
+            result = ReturnResult(loanBook[0])
+            if endedLoan is None:
+                self.db.rollback()
+                self.db.close()
+                return result
+            result.returned = True
+            copyID, bookID = endedLoan
+            params2 = (bookID, )
+            
+            # If there are any pending reservations for the book, the reservation at the front of its queue is fulfilled with the copy that was just returned, and the remaining reservations move up the queue
+            reservation = self.reservationScheduler.dequeue(self.db, bookID, copyID)
+            
+            if reservation:
+                result.reservationID, result.readerID = reservation
+                
+                # A new loan is inserted for the reader who made the reservation, and the copy stays 'On Loan' as it goes straight to them
+                dateNow = date.today()
+                dateTwoWeeks = date.today() + datetime.timedelta(LOANPERIODDAYS)
+                query6 = """INSERT INTO Loan (CopyID, BookID, ReaderID, LoanStartDate, LoanEndDate, LoanStatus) VALUES (?, ?, ?, ?, ?, ?)"""
+                params6 = (copyID, bookID, result.readerID, dateNow, dateTwoWeeks, 'Active')
+                self.db.execute(query6, params6)
+                result.newLoanID = self.db.getLastRowID()
+                self.leaderboardManager.recordLoan(self.db, result.readerID, dateNow)
+                self.popularityEngine.recordLoan(self.db, bookID, dateNow)
+                # The notification alerting the reader that their reservation is available is inserted in the same transaction
+                self.notificationManager.notifyReservationAvailable(result.reservationID, bookID, result.readerID, self.db)
+            else:
+                # Otherwise the copy becomes available to loan
+                query7 = """UPDATE BookCopy SET Status = 'Available' WHERE CopyID = ? AND BookID = ?"""
+                params7 = (copyID, bookID)
+                self.db.execute(query7, params7)
+            
+            # Updates the BookAvailability row of the book, and commits the whole return at once
+            self.db.execute(BOOKAVAILABILITYREFRESH + " WHERE Book.BookID = ?", params2)
             self.db.commit()
-            # The notifyReservationAvailable method of the notificationManager object is called which inserts a notification into the Notification table for that reader to alert them that their reservation is available
-            self.notificationManager.notifyReservationAvailable(reservationID[0], bookID, readerID)
-
-        # The book title of the loan just returned by the reader is returned to be formatted into a message for them
-        query5 = "SELECT Title FROM Book WHERE BookID = ?"
-        params7 = (bookID, )
-        self.db.execute(query5, params7)
-        title = self.db.fetchOne()[0]
-        return title
+        except sqlite3.Error:
+            self.db.rollback()
+            self.db.close()
+            raise
+        self.db.close()
+        # The returned loan may have been overdue, so the cached overdue loans are removed
+        self.overdueEngine.clear()
+        
+        if result.readerID is not None:
+            # The reader who made the reservation now has a new loan and a new notification, so their cached recommendations and notification count are removed
+            self.recommendationCache.invalidate(result.readerID)
+            self.notificationManager.countCache.invalidate(result.readerID)
+            self.leaderboardManager.clear()
+            self.popularityEngine.clear()
+        return result
+
+# Defines a ReturnResult class that describes the outcome of returning a loan
+class ReturnResult():
+    
+    # Constructor for the ReturnResult class
+    # Takes the title of the book that was returned as a parameter
+    # returned is False if the loan had already been returned, and reservationID, readerID and newLoanID are set if the copy was handed to the reader at the front of its reservation queue
+    def __init__(self, title):
+        self.title = title
+        self.returned = False
+        self.reservationID = None
+        self.readerID = None
+        self.newLoanID = None
+    
+    # Method to check whether the returned copy was handed to a reader who had reserved it
+    def isHandedOff(self):
+        return self.newLoanID is not None
+
+# Defines an OverdueEngine class that finds every overdue loan in the library, how many days overdue it is and its escalation tier
+# The overdue loans are found with one range query on the end date of active loans, which is cached for the notification sweep and streamed a batch at a time for overdue loan reports, as a report can be too large to hold in memory
+class OverdueEngine():
+
+    # Constructor for the OverdueEngine class
+    # Takes the filename of the SQLite database file as a parameter
+    # Initialises an instance of TTLCache to store the overdue loans for a short time
+    def __init__(self, dbName):
+        self.db = Database(dbName)
+        self.cache = TTLCache(1, OVERDUECACHETTL)
+
+    # Method to get the escalation tier of a loan, which is the highest tier in OVERDUETIERS it has reached, or None if it has not reached the first tier
+    def getTier(self, daysOverdue):
+        tier = None
+        for tierDays in OVERDUETIERS:
+            if daysOverdue >= tierDays:
+                tier = tierDays
+        return tier
+
+    # Method to retrieve all the overdue loans in the library from the database
+    # Returns a list of tuples containing the loanID, readerID, bookID, reader's full name, year group label, houseroom, loan start date, loan end date, book title, days overdue and escalation tier of each overdue loan, most overdue first
+    def findOverdueLoans(self, today):
+        self.db.connect()
+        query = OVERDUELOANSELECT + " WHERE Loan.LoanStatus = 'Active' AND Loan.LoanEndDate < ? ORDER BY Loan.LoanEndDate, Loan.LoanID"
+        params = (today, today)
+        self.db.execute(query, params)
+        overdueLoans = [row + (self.getTier(row[9]), ) for row in self.db.fetchAll()]
+        self.db.close()
+        return overdueLoans
+
+    # Method to get the overdue loans, from the cache if they were found recently
+    # The cache is keyed by today's date so the loans are found again when the day changes
+    def getOverdueLoans(self):
+        today = date.today()
+        overdueLoans = self.cache.get(today)
+        if overdueLoans is None:
+            overdueLoans = self.findOverdueLoans(today)
+            self.cache.set(today, overdueLoans)
+        return overdueLoans
+
+    # Method to iterate over the loans that are overdue by at least a number of days, using the Database object passed as a parameter
+    # The loans are fetched from the cursor a batch at a time rather than from the cache, and are ordered by reader so that each reader's loans can be handled together as they arrive
+    # Yields the same tuples as findOverdueLoans
+    def iterateOverdueLoans(self, db, minimumDays):
+        today = date.today()
+        query = OVERDUELOANSELECT + " WHERE Loan.LoanStatus = 'Active' AND Loan.LoanEndDate <= ? ORDER BY Loan.ReaderID, Loan.LoanEndDate, Loan.LoanID"
+        params = (today, today - datetime.timedelta(days=minimumDays))
+        db.execute(query, params)
+        for row in db.iterateRows(REPORTBATCHSIZE):
+            yield row + (self.getTier(row[9]), )
+
+    # Method to remove the cached overdue loans so they are found again on the next call, called when a loan is returned
+    def clear(self):
+        self.cache.clear()
 
 # Defines a NotificationManager class
 class NotificationManager():
     
+    # Takes an instance of the OverdueEngine class as a parameter
     # Takes the filename of the SQLite database file as a parameter
-    def __init__(self, dbName):
+    # Initialises an instance of TTLCache to store the number of unread notifications for each reader
+    def __init__(self, overdueEngine, dbName):
+        self.overdueEngine = overdueEngine
         self.db = Database(dbName)
+        self.countCache = TTLCache(NOTIFICATIONCOUNTCACHESIZE, NOTIFICATIONCOUNTCACHETTL)
         
     # Notifications will work as follows: when certain actions occur methods of this class will be triggered which will insert notifications for readers into the Notification table as Unread
     # When the reader next logs on or if they are currently logged in they will see a notificiation icon signifying they have unread notifications and once they have viewed them they will not be able to see them again
     
     # Method to notify when a reservation is available
-    def notifyReservationAvailable(self, reservationID, bookID, readerID):
-        self.db.connect()
+    # Takes an optional Database object as a parameter, whose open transaction the notification is inserted in, in which case committing it and removing the reader's cached notification count is left to the caller
+    def notifyReservationAvailable(self, reservationID, bookID, readerID, db=None):
         # Insert into notification the type of notification 'reservation', the intended readerID of the notifications and the reservationID and bookID
         query = """INSERT INTO Notification (NotificationType, Viewed, ReaderID, BookID, ReservationID) VALUES (?, ?, ?, ?, ?)"""
         params = ('Reservation', 0, readerID, bookID, reservationID)
-        self.db.execute(query, params)
-        self.db.commit()
-        self.db.close()
-    
-    # Method to notify a reader when a loan needs to be returned 1 day before
-    def notifyLoanToReturn(self, readerID):
+        if db is not None:
+            db.execute(query, params)
+            return
         self.db.connect()
-        # Retrieves all active loans for that reader whose end date is 1 day after the current date
-        query = """SELECT Loan.BookID, Loan.ReaderID, Loan.LoanID FROM Loan WHERE Loan.ReaderID = ? AND Loan.LoanStatus = 'Active' AND Loan.LoanEndDate = DATE('now', '+1 day')"""
-        params = (readerID, )
         self.db.execute(query, params)
-        loansToReturn = self.db.fetchAll()
-        # For each retrieved loan, a notification fo type 'Return Loan' is inserted into Notification
-        for loan in loansToReturn:
-            query2 = """INSERT INTO Notification (NotificationType, Viewed, ReaderID, BookID, LoanID) VALUES (?, ?, ?, ?, ?)"""
-            params2 = ('Return Loan', 0, loan[1], loan[0], loan[2])
-            self.db.execute(query2, params2)
-            self.db.commit()
+        self.db.commit()
         self.db.close()
+        self.countCache.invalidate(readerID)
     
     # Method to notify a reader their loan has been cancelled
-    def notifyLoanCancelled(self, loanID, readerID, bookID):
-        self.db.connect()
+    # Takes an optional Database object as a parameter, whose open transaction the notification is inserted in, in which case committing it and removing the reader's cached notification count is left to the caller
+    def notifyLoanCancelled(self, loanID, readerID, bookID, db=None):
         # A notification of type 'Cancelled Loan' is inserted into Notification
         query = """INSERT INTO Notification (NotificationType, Viewed, ReaderID, BookID, LoanID) VALUES (?, ?, ?, ?, ?)"""
         params = ('Cancelled Loan', 0, readerID, bookID, loanID)
+        if db is not None:
+            db.execute(query, params)
+            return
+        self.db.connect()
         self.db.execute(query, params)
         self.db.commit()
         self.db.close()
+        self.countCache.invalidate(readerID)
     
     # Method to notify a reader that their reservation has been cancelled
-    def notifyReservationCancelled(self, reservationID, readerID, bookID):
-        self.db.connect()
+    # Takes an optional Database object as a parameter, whose open transaction the notification is inserted in, in which case committing it and removing the reader's cached notification count is left to the caller
+    def notifyReservationCancelled(self, reservationID, readerID, bookID, db=None):
         # A notification of type 'Cancelled Reservation' is inserted into Notification
         query = """INSERT INTO Notification (NotificationType, Viewed, ReaderID, BookID, ReservationID) VALUES (?, ?, ?, ?, ?)"""
         params = ('Cancelled Reservation', 0, readerID, bookID, reservationID)
+        if db is not None:
+            db.execute(query, params)
+            return
+        self.db.connect()
         self.db.execute(query, params)
         self.db.commit()
         self.db.close()
-    
-    # A method to send overdue notifications to the reader periodically 
-    def overdueLoan(self, readerID):
+        self.countCache.invalidate(readerID)
+    
+    # Method to notify readers about all their loans that are due back tomorrow or have reached an overdue escalation tier, run once a day by the NotificationScheduler
+    # Each notification has a unique key made from its type, its loan and for overdue loans its tier, so running the sweep more than once on a day does not insert it twice, and a loan that was missed on the day it reached a tier is still notified
+    # The notifications are inserted with one executemany statement in one transaction
+    # Returns the number of notifications inserted
+    def sweepLoanNotifications(self):
+        tomorrow = date.today() + datetime.timedelta(days=1)
+        notifications = []
+        # A notification of type 'Overdue Loan' for each overdue loan at the highest tier it has reached
+        for overdueLoan in self.overdueEngine.getOverdueLoans():
+            loanID, readerID, bookID, tier = overdueLoan[0], overdueLoan[1], overdueLoan[2], overdueLoan[10]
+            notifications.append(('Overdue Loan', 0, readerID, bookID, loanID, f"Overdue Loan:{loanID}:{tier}"))
         self.db.connect()
-        # Gets today's date and calculates dates 1, 5, 10, 15 and 20 days before this date
-        today = date.today()
-        dueDates = [today - datetime.timedelta(days=days) for days in [1, 5, 10, 15, 20]]
-        # Retrieves all loans for that reader with an 'Active' status whose are overdue by 1, 5, 10, 15 or 20 days
-        query = """SELECT Loan.BookID, Loan.ReaderID, Loan.LoanID FROM Loan WHERE ReaderID = ? AND LoanStatus = 'Active' AND LoanEndDate IN (?, ?, ?, ?, ?)"""
-        params = (readerID, *dueDates)
-        self.db.execute(query, params)
-        overdueLoans = self.db.fetchAll()
-        # For each overdue loan a notification is inserted into Notification of type 'Overdue Loan'
-        for loan in overdueLoans:
-            query2 = """INSERT INTO Notification (NotificationType, Viewed, ReaderID, BookID, LoanID) VALUES (?, ?, ?, ?, ?)"""
-            params2 = ('Overdue Loan', 0, loan[1], loan[0], loan[2])
-            self.db.execute(query2, params2)
+        try:
+            # A notification of type 'Return Loan' for each active loan due back tomorrow
+            query = """SELECT Loan.LoanID, Loan.ReaderID, Loan.BookID FROM Loan WHERE Loan.LoanStatus = 'Active' AND Loan.LoanEndDate = ?"""
+            params = (tomorrow, )
+            self.db.execute(query, params)
+            for loanID, readerID, bookID in self.db.fetchAll():
+                notifications.append(('Return Loan', 0, readerID, bookID, loanID, f"Return Loan:{loanID}"))
+            self.db.begin()
+            query2 = """INSERT OR IGNORE INTO Notification (NotificationType, Viewed, ReaderID, BookID, LoanID, NotificationKey) VALUES (?, ?, ?, ?, ?, ?)"""
+            self.db.executeMany(query2, notifications)
+            insertedNotifications = self.db.getRowCount()
             self.db.commit()
-        self.db.close()
+        finally:
+            self.db.close()
+        for notification in notifications:
+            self.countCache.invalidate(notification[2])
+        return insertedNotifications
     
+    # Method to get the dictionary used to remember values for the rest of the current request, stored in Flask's g object, or None outside a request
+    def getRequestMemo(self):
+        if not has_request_context():
+            return None
+        if 'notificationMemo' not in g:
+            g.notificationMemo = {}
+        return g.notificationMemo
+
     # A method to retrieve all unread notifications for a reader   
+    # The notifications are only retrieved from the database once per request
     def getNotificationsForReader(self, readerID):
+        memo = self.getRequestMemo()
+        if memo is not None and ('notifications', readerID) in memo:
+            return memo[('notifications', readerID)]
         self.db.connect()
         # Retrieves unread notifications and associated information for each notfication, e.g. the book title of the overdue loan
         query = """SELECT Notification.NotificationID, Notification.NotificationType, Notification.BookID, Notification.ReservationID, Notification.LoanID, Book.Title, Loan.LoanEndDate, Book.CoverImageURL FROM Notification INNER JOIN Book ON Notification.BookID = Book.BookID LEFT JOIN Loan ON Notification.LoanID = Loan.LoanID WHERE Notification.ReaderID = ? AND Notification.Viewed = 0"""
@@ -1145,362 +2121,454 @@ class NotificationManager():
         notificationIDs = []
         for notification in notifications:
             notificationIDs.append(notification[0])
-        self.db.close()
+        if memo is not None:
+            memo[('notifications', readerID)] = (notifications, notificationIDs)
         return notifications, notificationIDs
 
-    # Method to mark notifications as viewed once they have been seen by the reader so that the reader only sees unread notifications
-    def markNotificationsAsViewed(self, notificationIDs):
+    # Method to retrieve the number of unread notifications for a reader, which is displayed on every page
+    # The count is cached for a short time, and is removed from the cache whenever a notification is added for the reader or their notifications are viewed
+    def countUnreadNotifications(self, readerID):
+        numNotifications = self.countCache.get(readerID)
+        if numNotifications is not None:
+            return numNotifications
         self.db.connect()
-        # For each notificationID the associated record's viewed field in the Notification table is updates to 1 signifying 'Read'
-        for id in notificationIDs:
-            query = """UPDATE Notification SET Viewed = 1 WHERE NotificationID = ?"""
-            params = (id, )
-            self.db.execute(query, params)
-            self.db.commit()
+        query = """SELECT COUNT(*) FROM Notification WHERE Notification.ReaderID = ? AND Notification.Viewed = 0"""
+        params = (readerID, )
+        self.db.execute(query, params)
+        numNotifications = self.db.fetchOne()[0]
         self.db.close()
+        self.countCache.set(readerID, numNotifications)
+        return numNotifications
 
-# Defines a Queue data structure
-class Queue(): 
-    
-    # Constructor of Queue class
-    # Initialises list to act as queue
-    def __init__(self):
-        self.queue = []
-        
-    # Method to add items to end of queue
-    def enqueue(self, item):
-        self.queue.append(item)
-
-    # Method to retrieve items from front of queue if the queue is not empty, else returns None instead of the item
-    def dequeue(self):
-        if self.isEmpty():
-            return None
-        return self.queue.pop(0)
-
-    # Method to check if queue is empty by returning the True or False based on what the condition evaluates to
-    def isEmpty(self):
-        return len(self.queue) == 0
-
-    # Method to get the number of items in the queue
-    def getSize(self):
-        return len(self.queue)
-    
-    # Method to clear the queue of items
-    def clear(self):
-        self.queue = []        
-
-# Defines a Priority Queue data structure that inherits behaviour from Queue
-class PriorityQueue(Queue):
-    
-    # Constructor of PriorityQueue class calls Queue constructor
-    def __init__(self):
-        super().__init__()
+    # Method to mark notifications as viewed once they have been seen by the reader so that the reader only sees unread notifications
+    # Takes the readerID of the reader who viewed the notifications and the list of their notificationIDs as parameters
+    # Every unread notification of the reader up to the newest one they have seen is marked as read with one query, notifications added after they were retrieved have larger IDs so stay unread
+    def markNotificationsAsViewed(self, readerID, notificationIDs):
+        if not notificationIDs:
+            return
+        self.db.connect()
+        query = """UPDATE Notification SET Viewed = 1 WHERE ReaderID = ? AND Viewed = 0 AND NotificationID <= ?"""
+        params = (readerID, max(notificationIDs))
+        self.db.execute(query, params)
+        self.db.commit()
+        self.db.close()
+        self.countCache.invalidate(readerID)
+        # The notifications remembered for this request are no longer unread
+        memo = self.getRequestMemo()
+        if memo is not None:
+            memo.pop(('notifications', readerID), None)
+
+# Defines a NotificationScheduler class that runs the daily loan notification sweep on a background thread, so that logging in does not wait for notifications to be created
+# The thread wakes up every interval seconds and runs the sweep if it has not run yet today
+class NotificationScheduler():
+
+    # Constructor for the NotificationScheduler class
+    # Takes an instance of the NotificationManager class and the number of seconds between checks as parameters
+    def __init__(self, notificationManager, interval):
+        self.notificationManager = notificationManager
+        self.interval = interval
+        self.lastSweepDate = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+
+    # Method to start the background thread if it is not already running
+    # The thread is a daemon thread so it does not stop the app from exiting
+    def start(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.stopEvent.clear()
+            self.thread = threading.Thread(target=self.run, name="NotificationScheduler", daemon=True)
+            self.thread.start()
+
+    # Method to ask the background thread to stop, it stops the next time it wakes up
+    def stop(self):
+        self.stopEvent.set()
+
+    # Method run by the background thread, which runs the sweep once a day until the scheduler is stopped
+    # An error in the sweep is logged and the sweep is tried again after the next interval
+    def run(self):
+        while not self.stopEvent.is_set():
+            today = date.today()
+            if self.lastSweepDate != today:
+                try:
+                    self.notificationManager.sweepLoanNotifications()
+                    self.lastSweepDate = today
+                except sqlite3.Error:
+                    app.logger.exception("The loan notification sweep failed.")
+            self.stopEvent.wait(self.interval)
+
+# Defines a ReservationScheduler class that keeps one reservation queue for each book, rather than one for each copy of the book
+# Whichever copy of a book is returned first is handed to the reservation at the front of the book's queue
+# The queue is the pending reservations for the book in ReservationBookOrderIndex order, so adding, removing and fulfilling a reservation each change one row of the index and take O(log n) time
+# The number of pending reservations in the book's BookAvailability row is changed by one at the same time, rather than being counted again
+# The methods that change a queue take a Database object as a parameter and run in its open transaction, which the caller commits
+class ReservationScheduler():
+
+    # Constructor for the ReservationScheduler class
+    # Takes the filename of the SQLite database file as a parameter
+    def __init__(self, dbName):
+        self.db = Database(dbName)
 
-    # Method that overrides enqueue method in Queue class
-    # Appends reservations to a queue and custom sorts them based on their queue position and then their priority
-    def enqueue(self, reservationID, queuePosition, priority):
-        self.queue.append([reservationID, queuePosition, priority])
-        self.queue = sorted(self.queue, key=lambda x: (x[1], x[2]))
-
-    # Method to override the dequeue method in the Queue class
-    # Removes an item from the back of the list for processing if the Queue is not empty
-    # Order items dequeued does not matter in this implementation
-    def dequeue(self):
-        if self.isEmpty():
+    # Method to choose the copy a new reservation is expected to be fulfilled with, which is the copy that is due back first
+    # Decommissioned copies are never chosen, and the CopyID is replaced by the copy actually handed to the reader when the reservation is fulfilled
+    def chooseCopy(self, db, bookID):
+        query = """SELECT BookCopy.CopyID FROM BookCopy LEFT JOIN Loan ON Loan.CopyID = BookCopy.CopyID AND Loan.BookID = BookCopy.BookID AND Loan.LoanStatus = 'Active' WHERE BookCopy.BookID = ? AND BookCopy.Status != 'Decommissioned' ORDER BY IFNULL(Loan.LoanEndDate, DATE('now')), BookCopy.CopyID LIMIT 1"""
+        db.execute(query, (bookID, ))
+        copy = db.fetchOne()
+        if copy is None:
+            return 1
+        return copy[0]
+
+    # Method to add a new reservation to the queue for a book
+    # A new reservation is made after every reservation already in the queue, so it goes behind every reservation with the same or a higher priority without any other reservation moving
+    # Returns the reservationID of the new reservation
+    def enqueue(self, db, bookID, readerID, priority):
+        copyID = self.chooseCopy(db, bookID)
+        query = """INSERT INTO Reservation (CopyID, BookID, ReaderID, ReservationStatus, Priority) VALUES (?, ?, ?, ?, ?)"""
+        params = (copyID, bookID, readerID, 'Pending', priority)
+        db.execute(query, params)
+        reservationID = db.getLastRowID()
+        self.changePendingReservations(db, bookID, 1)
+        return reservationID
+
+    # Method to remove a pending reservation from the queue for its book, giving it the status passed as a parameter
+    # Returns False if the reservation was no longer pending
+    def remove(self, db, reservationID, status):
+        query = """UPDATE Reservation SET ReservationStatus = ? WHERE ReservationID = ? AND ReservationStatus = 'Pending' RETURNING BookID"""
+        db.execute(query, (status, reservationID))
+        removedReservation = db.fetchOne()
+        if removedReservation is None:
+            return False
+        self.changePendingReservations(db, removedReservation[0], -1)
+        return True
+
+    # Method to fulfil the reservation at the front of the queue for a book with the copy that has just been returned
+    # The front of the queue is the first pending reservation for the book in ReservationBookOrderIndex
+    # Returns a tuple of the reservationID and readerID of the fulfilled reservation, or None if the book has no pending reservations
+    def dequeue(self, db, bookID, copyID):
+        query = f"""UPDATE Reservation SET ReservationStatus = 'Fulfilled', CopyID = ? WHERE ReservationID = (
+            SELECT ReservationID FROM Reservation WHERE BookID = ? AND ReservationStatus = 'Pending' ORDER BY {RESERVATIONQUEUEORDER} LIMIT 1
+        ) RETURNING ReservationID, ReaderID"""
+        db.execute(query, (copyID, bookID))
+        fulfilledReservation = db.fetchOne()
+        if fulfilledReservation is None:
             return None
-        return self.queue.pop() 
+        self.changePendingReservations(db, bookID, -1)
+        return fulfilledReservation
+
+    # Method to add the change passed as a parameter to the number of pending reservations in the BookAvailability row of a book
+    def changePendingReservations(self, db, bookID, change):
+        query = """UPDATE BookAvailability SET PendingReservations = PendingReservations + ? WHERE BookID = ?"""
+        db.execute(query, (change, bookID))
+
+    # Method to estimate the date each pending reservation for a book will be fulfilled
+    # Each copy is free on the due date of its active loan, or today if it is available or overdue. Reservations are given the copy that is free first in queue order, and that copy is then free again one loan period later
+    # Returns a dictionary mapping each reservationID to its estimated date
+    def estimateWaitTimes(self, bookID):
+        self.db.connect()
+        query = """SELECT MAX(IFNULL(Loan.LoanEndDate, DATE('now')), DATE('now')) FROM BookCopy LEFT JOIN Loan ON Loan.CopyID = BookCopy.CopyID AND Loan.BookID = BookCopy.BookID AND Loan.LoanStatus = 'Active' WHERE BookCopy.BookID = ? AND BookCopy.Status != 'Decommissioned' GROUP BY BookCopy.CopyID"""
+        params = (bookID, )
+        self.db.execute(query, params)
+        freeDates = [datetime.datetime.strptime(row[0], "%Y-%m-%d").date() for row in self.db.fetchAll()]
+        query2 = f"""SELECT ReservationID FROM Reservation WHERE BookID = ? AND ReservationStatus = 'Pending' ORDER BY {RESERVATIONQUEUEORDER}"""
+        self.db.execute(query2, params)
+        reservationIDs = [row[0] for row in self.db.fetchAll()]
+        self.db.close()
+        estimates = {}
+        if not freeDates:
+            return estimates
+        heapq.heapify(freeDates)
+        for reservationID in reservationIDs:
+            freeDate = heapq.heappop(freeDates)
+            estimates[reservationID] = freeDate
+            heapq.heappush(freeDates, freeDate + datetime.timedelta(LOANPERIODDAYS))
+        return estimates
 
 # Defines a Reservation class
 class Reservation():
 
     # Constructor for the Reservation class
+    # Takes an instance of the ReservationScheduler class as a parameter
     # Takes the filename of the SQLite database file as a parameter
-    # Initialises an instance of PriorityQueue()
-    def __init__(self, dbName):
+    def __init__(self, reservationScheduler, dbName):
+        self.reservationScheduler = reservationScheduler
         self.db = Database(dbName)
-        self.reservationQueue = PriorityQueue()
     
     # Method to allow a reader to reserve a book
+    # The reservation is added to the queue for the book in one transaction that is committed once
     def reserveBook(self, readerID, bookID):
         self.db.connect()
-        # Retrieves the copyID for the specified book that has the least number of reservations
-        query = """SELECT IFNULL(
-        (SELECT Reservation.CopyID FROM Reservation WHERE Reservation.BookID = ? GROUP BY CopyID ORDER BY COUNT(*) ASC LIMIT 1), 1) AS CopyID"""
-        params = (bookID, )
-        self.db.execute(query, params)
-        copyID = self.db.fetchOne()[0]
-        
-        # Calls the getReservationsForQueue method to populate the reservationQueue with the existing reservations for that book
-        self.getReservationsForQueue(bookID, copyID)
-        
-        # Retrieves the priority of the readerID making the reservation - if they are not in year 12 or 13 or staff or a librarian then they are priority 2 else 1
-        query2 = """SELECT CASE WHEN YearGroup BETWEEN 2 AND 10 THEN 2 ELSE 1 END AS Priority FROM Reader WHERE ReaderID = ?"""
-        params2 = (readerID, )
-        self.db.execute(query2, params2)
-        priority = self.db.fetchOne()[0]
-        # Calls the findNewReservationPositions method to retrieve the new queue positions of all the reservations now that a new reservation has been made
-        self.findNewReservationPositions(priority)
-        status = 'Pending'
-        # Calls the updateReservationsTable method to insert the new reservation into the database and update the queue positions of the existing reservations in the database
-        self.updateReservationsTable(bookID, copyID, readerID, status, priority)
-        # Empty the reservationQueue for the next method call
-        self.reservationQueue.clear()
-    
-    # Method to populate the reservationQueue with the existing reservations for that book
-    def getReservationsForQueue(self, bookID, copyID):
-        self.db.connect()
-        # Retrieve all reservations for specified book
-        query = """SELECT ReservationID, QueuePosition, Priority FROM Reservation WHERE Reservation.BookID = ? AND Reservation.CopyID = ? AND Reservation.ReservationStatus = 'Pending' ORDER BY Reservation.QueuePosition ASC"""
-        params = (bookID, copyID)
-        self.db.execute(query, params)
-        reservations = self.db.fetchAll()
-        # Enqueue each reservation to queue
-        for reservation in reservations:
-            self.reservationQueue.enqueue(reservation[0], reservation[1], reservation[2])
-
-    # Method to retrieve the new queue positions of all the reservations now that a new reservation has been made
-    def findNewReservationPositions(self, newReservationPriority):
-        queueLength = self.reservationQueue.getSize()
-        i = 0
-        # While the queue is not empty and the current reservation has a lower priority than new reservation increment i
-        while i < queueLength and self.reservationQueue.queue[i][2] <= newReservationPriority:
-            i += 1
-        # Insert new reservation into queue
-        self.reservationQueue.queue.insert(i, [None, i+1, newReservationPriority])
-        # Update queue positions for all reservations
-        for idx, reservation in enumerate(self.reservationQueue.queue):
-            reservation[1] = idx+1
-
-    # Method to insert the new reservation into the database and update the queue positions of the existing reservations in the database
-    def updateReservationsTable(self, bookID, copyID, readerID, status, priority):
-        self.db.connect()
-        # Dequeue each reservation
-        while not self.reservationQueue.isEmpty():
-            reservation = self.reservationQueue.dequeue()
-            # If reservation is the new reservation insert new record into Reservation table
-            if reservation[0] == None:
-                query = """INSERT INTO Reservation (CopyID, BookID, ReaderID, ReservationStatus, QueuePosition, Priority) VALUES (?, ?, ?, ?, ?, ?)"""
-                params = (copyID, bookID, readerID, status, reservation[1], priority)
-                self.db.execute(query, params)
-                self.db.commit()
-            else:
-            # If existing reservation update its queue position
-                query = """UPDATE Reservation SET QueuePosition = ? WHERE ReservationID = ?"""
-                params = (reservation[1], reservation[0])
-                self.db.execute(query, params)
-                self.db.commit()
-                
-        self.db.close()
+        self.db.begin()
+        try:
+            # Retrieves the priority of the readerID making the reservation - if they are not in year 12 or 13 or staff or a librarian then they are priority 2 else 1
+            query = """SELECT CASE WHEN YearGroup BETWEEN 2 AND 10 THEN 2 ELSE 1 END AS Priority FROM Reader WHERE ReaderID = ?"""
+            params = (readerID, )
+            self.db.execute(query, params)
+            priority = self.db.fetchOne()[0]
+            # Adds the reservation to the queue, which also updates the number of pending reservations in the book's BookAvailability row
+            self.reservationScheduler.enqueue(self.db, bookID, readerID, priority)
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            raise
+        finally:
+            self.db.close()
     
     # Method to get all the pending reservations for a reader
     # Dual purpose - if no readerID is provided then retrieves the pending reservations for the current reader
     # If readerID provided then retrieves that reader's pending reservations for the librarian
+    # The position of each reservation in the queue for its book is worked out by numbering the pending reservations for the reader's books in queue order
+    # The estimated date each reservation will be available is added to the end of each reservation
     def getReservations(self, readerID=None):
         self.db.connect()
-        query = """SELECT Book.Title, Reservation.BookID, Reservation.ReservationStatus, Reservation.ReservationTimestamp, Reservation.QueuePosition, Reservation.ReservationID, Book.CoverImageURL FROM Reservation INNER JOIN Book ON Reservation.BookID = Book.BookID WHERE Reservation.ReservationStatus = 'Pending' AND Reservation.ReaderID = ?"""
+        query = f"""SELECT Book.Title, Queue.BookID, Queue.ReservationStatus, Queue.ReservationTimestamp, Queue.QueuePosition, Queue.ReservationID, Book.CoverImageURL FROM (
+            SELECT ReservationID, BookID, ReaderID, ReservationStatus, ReservationTimestamp, ROW_NUMBER() OVER (PARTITION BY BookID ORDER BY {RESERVATIONQUEUEORDER}) AS QueuePosition
+            FROM Reservation
+            WHERE ReservationStatus = 'Pending' AND BookID IN (SELECT BookID FROM Reservation WHERE ReaderID = :readerID AND ReservationStatus = 'Pending')
+        ) AS Queue INNER JOIN Book ON Queue.BookID = Book.BookID WHERE Queue.ReaderID = :readerID"""
         if readerID is not None:
-            params = (readerID, )
+            params = {"readerID": readerID}
         else:
-            params = (session['readerID'], )
+            params = {"readerID": session['readerID']}
         self.db.execute(query, params)
         reservations = self.db.fetchAll()
         self.db.close()
-        return reservations
+        estimates = {}
+        for bookID in set(reservation[1] for reservation in reservations):
+            estimates.update(self.reservationScheduler.estimateWaitTimes(bookID))
+        return [reservation + (estimates.get(reservation[5]), ) for reservation in reservations]
     
     # Method to cancel a reservation
+    # The reservation is removed from the queue for the book in one transaction that is committed once
     def cancelReservation(self, bookID, reservationID):
         self.db.connect()
-        # Updates reservation status to Fulfilled
-        query = """UPDATE Reservation SET ReservationStatus = 'Fulfilled' WHERE ReservationID = ?"""
-        params = (reservationID, )
-        self.db.execute(query, params)
-        self.db.commit()
-        # Returns the title of the book the reservation for so that it can be returned in a message to the reader
-        query2 = """SELECT Title FROM Book WHERE BookID = ?"""
-        params2 = (bookID, )
-        self.db.execute(query2, params2 )
-        title = self.db.fetchOne()[0]
+        self.db.begin()
+        try:
+            # Returns the title of the book the reservation for so that it can be returned in a message to the reader
+            query = """SELECT Title FROM Book WHERE BookID = ?"""
+            params = (bookID, )
+            self.db.execute(query, params)
+            title = self.db.fetchOne()[0]
+            # Updates reservation status to Fulfilled if it is still pending, which removes it from the queue and updates the number of pending reservations in the book's BookAvailability row
+            self.reservationScheduler.remove(self.db, reservationID, 'Fulfilled')
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            raise
+        finally:
+            self.db.close()
         return title
 
 # Defines a PDFManagement class that contains methods to allow for creation, edit
+# The class holds no state, so one instance can be shared by requests creating reports at the same time, and the buffer and canvas of each report are passed to its methods
 class PDFManagement():
     
     # Constructor for PDF Management class
-    # Initialises a buffer object to store a stream of bytes that can be treated like a file-object
-    # This buffer will be where report data for the PDF is stored
     def __init__(self):
-        self.buffer = BytesIO()
+        pass
     
-    # Method to create a canvas object so that any operations on Canvas will output to the buffer
+    # Method to create a new buffer and a canvas object that outputs to it, for one report
+    # The buffer is a spooled temporary file, which keeps small reports in memory and moves large reports to a file on disk, and the pages are compressed to keep them small
     # Defining the page size of the document as letter
+    # Returns the buffer and the canvas, and the buffer should be closed once the report has been saved
     def createCanvas(self):
-        self.c = canvas.Canvas(self.buffer, pagesize=letter)
+        buffer = tempfile.SpooledTemporaryFile(max_size=PDFSPOOLSIZE)
+        c = canvas.Canvas(buffer, pagesize=letter, pageCompression=1)
+        c.setFont(PDFFONT, PDFFONTSIZE)
+        return buffer, c
     
-    # Sets font of text as Helvetica and size 12 and writes text data at specified coordinates
-    def write(self, x, y, data):
-        self.c.setFont("Helvetica", 12)
-        self.c.drawString(x, y, data)
+    # Writes text data at specified coordinates on the canvas, using the font set for the page
+    def write(self, c, x, y, data):
+        c.drawString(x, y, data)
+
+    # Creates a new page on the canvas and sets its font, which is done once for each page as the canvas resets the font on every new page
+    def newPage(self, c):
+        c.showPage()
+        c.setFont(PDFFONT, PDFFONTSIZE)
     
     # Creates a new page on the canvas and adds a title at the specified coordinates on that page
-    def addPage(self, title):
-        self.c.showPage()
-        self.c.setFont("Helvetica", 12)
-        self.c.drawString(25, 750, title)
+    def addPage(self, c, title):
+        self.newPage(c)
+        c.drawString(25, 750, title)
     
-    # Method to save the changes to the canvas
-    def save(self):
-        self.c.save()
+    # Method to save the changes to the canvas into its buffer
+    def save(self, c):
+        c.save()
+
+    # Returns the number of bytes in the buffer
+    def getSize(self, buffer):
+        buffer.seek(0, 2)
+        return buffer.tell()
     
     # Returns the bytes content of the buffer
-    def getContent(self):
-        return self.buffer.getvalue()
-    
-    # Method to draw a table on the canvas with provided data
-    def drawTable(self, data, startX, startY, rowHeight, columnWidth):
-        for i, row in enumerate(data):
-            for j, cell in enumerate(row):
-                # Calculate coordinates to start writing at for each cell
-                x = startX + j * columnWidth
-                y = startY - i * rowHeight
-                # Convert cell data to string and write it at the specified coordinates
-                cell_text = str(cell)
-                self.write(x, y, cell_text)
+    def getContent(self, buffer):
+        buffer.seek(0)
+        return buffer.read()
+
+    # Method to copy the content of the buffer into a file-like object, such as a BLOB in the database, a chunk at a time
+    def copyTo(self, buffer, file):
+        buffer.seek(0)
+        while True:
+            chunk = buffer.read(PDFCHUNKSIZE)
+            if not chunk:
+                break
+            file.write(chunk)
+    
+    # Method to draw a table on the canvas with provided rows, which can be any iterable such as rows fetched from the database a batch at a time
+    # When the next row would be below the bottom margin the table continues on a new page, and the header row, if one is given, is written at the top of every page the table is on
+    # Returns the number of rows drawn, so that a message can be written if there were none
+    def drawTable(self, c, data, startX, startY, rowHeight, columnWidth, header=None):
+        y = None
+        rowCount = 0
+        for row in data:
+            # Start a new page when the page is full, and write the header at the top of each page the table is on
+            if y is not None and y < PDFBOTTOMMARGIN:
+                self.newPage(c)
+                y = None
+            if y is None:
+                y = startY
+                if header:
+                    self.drawRow(c, header, startX, y, columnWidth)
+                    y -= rowHeight
+            self.drawRow(c, row, startX, y, columnWidth)
+            y -= rowHeight
+            rowCount += 1
+        return rowCount
+
+    # Method to draw one row of a table on the canvas at the specified height
+    def drawRow(self, c, row, startX, y, columnWidth):
+        for j, cell in enumerate(row):
+            # Calculate coordinates to start writing at for each cell
+            x = startX + j * columnWidth
+            # Convert cell data to string and write it at the specified coordinates
+            cell_text = str(cell)
+            self.write(c, x, y, cell_text)
 
 # Defines a Report class
 class Report():
     
     # Constructor for the Report class
+    # Takes an instance of the OverdueEngine class as a parameter
     # Takes the filename of the SQLite database file as a parameter
     # Initialises an instance of the PDFManagement class to interact with to create report PDFs
-    def __init__(self, dbName):
+    def __init__(self, overdueEngine, dbName):
+        self.overdueEngine = overdueEngine
         self.db = Database(dbName)
         self.pdfManager = PDFManagement()
+        # The top readers reports order readers by their number of loans, most first
+        self.topReadersGenreTimeQuery = QueryBuilder("FullName, YearGroupLabel, LoanCount", """SELECT Reader.FirstName || ' ' || Reader.LastName AS FullName, CASE 
+          WHEN Reader.YearGroup = 0 THEN 'Staff'
+          WHEN Reader.YearGroup = 1 THEN 'Librarian'
+          ELSE 'Year ' || CAST(Reader.YearGroup AS TEXT)
+      END AS YearGroupLabel, COUNT(Loan.ReaderID) AS LoanCount, {sortKey} AS SortKey, Reader.ReaderID AS UniqueKey FROM Reader INNER JOIN Loan ON Reader.ReaderID = Loan.ReaderID INNER JOIN Book ON Loan.BookID = Book.BookID WHERE Book.Genre LIKE '%' || :genre || '%' AND LoanStartDate BETWEEN :startDate AND :endDate GROUP BY Reader.ReaderID""", {"LoanCount": "COUNT(Loan.ReaderID)"}, "LoanCount")
+        self.topReadersYearGroupQuery = QueryBuilder("FullName, LoanCount", """SELECT Reader.FirstName || ' ' || Reader.LastName AS FullName, COUNT(Loan.ReaderID) AS LoanCount, {sortKey} AS SortKey, Reader.ReaderID AS UniqueKey FROM Reader INNER JOIN Loan ON Reader.ReaderID = Loan.ReaderID WHERE Reader.YearGroup = :yearGroup AND LoanStartDate BETWEEN :startDate AND :endDate GROUP BY Reader.ReaderID""", {"LoanCount": "COUNT(Loan.ReaderID)"}, "LoanCount")
     
     # Method to create a Top Readers in X Genre in Y Time period Report
     def getTopReadersGenreTime(self, numberOfReaders, genre, startDate, endDate):
         # Write the title of the report at top of PDF canvas
         title = f"Top {numberOfReaders} Readers in {genre} between {startDate} and {endDate}"
-        self.pdfManager.createCanvas()
-        self.pdfManager.write(100, 750, title)
-        self.db.connect()
-        # Retrieve the readers who have read the most books in the specified genre between the specified time period
-        query = """SELECT Reader.FirstName || ' ' || Reader.LastName AS FullName, CASE 
-          WHEN Reader.YearGroup = 0 THEN 'Staff'
-          WHEN Reader.YearGroup = 1 THEN 'Librarian'
-          ELSE 'Year ' || CAST(Reader.YearGroup AS TEXT)
-      END AS YearGroupLabel, COUNT(Loan.ReaderID) AS LoanCount FROM Reader INNER JOIN Loan ON Reader.ReaderID = Loan.ReaderID INNER JOIN Book ON Loan.BookID = Book.BookID WHERE Book.Genre LIKE '%' || ? || '%' AND LoanStartDate BETWEEN ? AND ? GROUP BY Reader.ReaderID ORDER BY LoanCount DESC"""
-        params = (genre, startDate, endDate)
-        self.db.execute(query, params)
-        # Retrieve the reader name, year grou and number of loans for the number of readers specified
-        results = self.db.fetchMany(numberOfReaders)
-        # If there are no results write message to PDF and save changes
-        if not results:
-            self.pdfManager.write(100, 700, "No results.")
-            self.pdfManager.save()
-        # If there are results write the results into a table on the PDF and save changes
-        else:
-            results.insert(0, ("Name", "Year Group", "Number of Books Read"))
-            self.pdfManager.drawTable(results, 100, 730, 20, 100)
-            self.pdfManager.save()
-        
-        # Get the bytes content of the pdf
-        pdfContent = self.pdfManager.getContent()
-        # Insert a new report into the Report table with the title and content of the report
-        query2 = """INSERT INTO Report (ReportTitle, PDFContent) VALUES (?, ?)"""
-        params2 = (title, pdfContent)
-        self.db.execute(query2, params2)
-        # Return the reportID so that it can be used to retrieve a report
-        reportID = self.db.getLastRowID()
-        self.db.commit()
-        self.db.close()
+        buffer, c = self.pdfManager.createCanvas()
+        with buffer:
+            self.pdfManager.write(c, 100, 750, title)
+            self.db.connect()
+            # Retrieve the readers who have read the most books in the specified genre between the specified time period
+            query = self.topReadersGenreTimeQuery.build("LoanCount", "DESC", keyset=False)
+            params = {"genre": genre, "startDate": startDate, "endDate": endDate, "limit": numberOfReaders}
+            self.db.execute(query, params)
+            # Write the reader name, year group and number of loans for the number of readers specified into a table on the PDF as they are fetched
+            rowCount = self.pdfManager.drawTable(c, self.db.iterateRows(REPORTBATCHSIZE), 100, 730, 20, 100, header=("Name", "Year Group", "Number of Books Read"))
+            # If there are no results write message to PDF
+            if rowCount == 0:
+                self.pdfManager.write(c, 100, 700, "No results.")
+            # Save changes, insert a new report into the Report table with the title and content of the report and return the reportID so that it can be used to retrieve a report
+            self.pdfManager.save(c)
+            reportID = self.saveReport(title, buffer)
+            self.db.close()
         return reportID
 
     # Method to create a Top Readers in X Year Group in Y Time Period
     def getTopReadersYearGroup(self, numberOfReaders, yearGroup, startDate, endDate):
         # Write the title of the report at top of the page
         title = f"Top {numberOfReaders} Readers in Year {yearGroup} between {startDate} and {endDate}"
-        self.pdfManager.createCanvas()
-        self.pdfManager.write(100, 750, title)
-        self.db.connect()
-        # Retrieve the readers who have read the most books in the specified year group during the specified time period by checking the start date of their loans
-        query = """SELECT Reader.FirstName || ' ' || Reader.LastName AS FullName, COUNT(Loan.ReaderID) AS LoanCount FROM Reader INNER JOIN Loan ON Reader.ReaderID = Loan.ReaderID WHERE Reader.YearGroup = ? AND LoanStartDate BETWEEN ? AND ? GROUP BY Reader.ReaderID ORDER BY LoanCount DESC"""
-        params = (int(yearGroup), startDate, endDate)
-        self.db.execute(query, params)
-        # Retrieve the name, and number of loans read by each reader for the number of readers specified
-        results = self.db.fetchMany(numberOfReaders)
-        # If there are no results write this message to the PDF and save changes
-        if not results:
-            self.pdfManager.write(100, 700, "No results.")
-            self.pdfManager.save()
-        # If there are results write the results into a table in the PDF and save changes
-        else:
-            results.insert(0, ("Name", "Number of Books Read"))  
-            self.pdfManager.drawTable(results, 100, 730, 20, 100)
-            self.pdfManager.save()
-        
-        # Get the bytes content of canvas for PDF
-        pdfContent = self.pdfManager.getContent()
-        # Insert the title and content as a new report record in the Report table
-        query2 = """INSERT INTO Report (ReportTitle, PDFContent) VALUES (?, ?)"""
-        params2 = (title, pdfContent)
-        self.db.execute(query2, params2)
-        # Return the new report ID
-        reportID = self.db.getLastRowID()
-        self.db.commit()
-        self.db.close()
+        buffer, c = self.pdfManager.createCanvas()
+        with buffer:
+            self.pdfManager.write(c, 100, 750, title)
+            self.db.connect()
+            # Retrieve the readers who have read the most books in the specified year group during the specified time period by checking the start date of their loans
+            query = self.topReadersYearGroupQuery.build("LoanCount", "DESC", keyset=False)
+            params = {"yearGroup": int(yearGroup), "startDate": startDate, "endDate": endDate, "limit": numberOfReaders}
+            self.db.execute(query, params)
+            # Write the name, and number of loans read by each reader for the number of readers specified into a table in the PDF as they are fetched
+            rowCount = self.pdfManager.drawTable(c, self.db.iterateRows(REPORTBATCHSIZE), 100, 730, 20, 100, header=("Name", "Number of Books Read"))
+            # If there are no results write this message to the PDF
+            if rowCount == 0:
+                self.pdfManager.write(c, 100, 700, "No results.")
+            # Save changes, insert the title and content as a new report record in the Report table and return the new report ID
+            self.pdfManager.save(c)
+            reportID = self.saveReport(title, buffer)
+            self.db.close()
         return reportID
     
     # Method to generate a report for every reader who has overdue loans
     # Each new reader's report will be on a new page, so the librarian can print the report and send each report to each individual
+    # The overdue loans are fetched a batch at a time in order of reader, and each loan is written as it is fetched, so the report does not need to hold every overdue loan in memory
     def getOverdueLoanReports(self, days):
-        self.db.connect()
-        # Set the overdue date as the today's date subtracted by the number of days overdue
         today = date.today()
-        overduedate = today - datetime.timedelta(days=days)
-        # Retrieve all loans that are overdue by the specified number of days
-        query = """SELECT Reader.FirstName || ' ' || Reader.LastName AS FullName, CASE 
-          WHEN Reader.YearGroup = 0 THEN 'Staff'
-          WHEN Reader.YearGroup = 1 THEN 'Librarian'
-          ELSE 'Year ' || CAST(Reader.YearGroup AS TEXT)
-      END AS YearGroupLabel, Reader.Houseroom, Loan.LoanStartDate, Loan.LoanEndDate, Book.Title FROM Reader INNER JOIN Loan ON Reader.ReaderID = Loan.ReaderID INNER JOIN Book ON Loan.BookID = Book.BookID WHERE Loan.LoanStatus = 'Active' AND Loan.LoanEndDate = ?"""
-        params = (overduedate, )
-        self.db.execute(query, params)
-        # Retrieve the reader's name, year group, houseroom and loan details for each overdue loan
-        results = self.db.fetchAll()
-        # Organise the results into a dicitonary, where the reader's name is the key and the value is a list of lists containing information about each of their overdue loans
-        organisedResults = {}
-        for row in results:
-            name = row[0]
-            yeargroup = row[1]
-            houseroom = row[2]
-            loanstartdate = row[3]
-            loanenddate = row[4]
-            booktitle = row[5]
-            if name not in organisedResults:
-                organisedResults[name] = []
-            organisedResults[name].append([yeargroup, houseroom, loanstartdate, loanenddate, booktitle])
-        self.pdfManager.createCanvas()
-        # For each reader add a new page to the report and write their overdue loans onto it
-        for key, value in organisedResults.items():
-            self.pdfManager.addPage(f"Overdue Loan Notice for {key} {value[0][0]} {value[0][1]}")
-            for i, loan in enumerate(value):
-                self.pdfManager.write(25, 730 - (i*50), f"Their Loan for {loan[4]} made on the {loan[2]} and due on the {loan[3]} is {days} days overdue.")
-                
-            self.pdfManager.write(25, 200, "Please hand in the overdue books to the library as soon as possible.")
-            
-        # Save changes to canvas
-        self.pdfManager.save()
-        # Get bytes content of PDF   
-        pdfContent = self.pdfManager.getContent()
-        # Insert title and pdf content as new report in Report table
-        query2 = """INSERT INTO Report (ReportTitle, PDFContent) VALUES (?, ?)"""
-        today = date.today()
-        params2 = (f"Overdue Loans Report For {today}", pdfContent)
-        self.db.execute(query2, params2)
-        # Return reportID of new report
-        reportID = self.db.getLastRowID()
+        title = f"Overdue Loans Report For {today}"
+        buffer, c = self.pdfManager.createCanvas()
+        with buffer:
+            self.pdfManager.write(c, 25, 750, title)
+            self.db.connect()
+            # Retrieve the reader's name, year group, houseroom and loan details for each loan that is overdue by at least the specified number of days
+            readerID = None
+            for row in self.overdueEngine.iterateOverdueLoans(self.db, days):
+                name, yeargroup, houseroom, loanstartdate, loanenddate, booktitle, daysoverdue = row[3:10]
+                # When the loans of a new reader start, finish the previous reader's page and add a new page for the new reader
+                if row[1] != readerID:
+                    if readerID is not None:
+                        self.pdfManager.write(c, 25, 200, "Please hand in the overdue books to the library as soon as possible.")
+                    readerID = row[1]
+                    noticeTitle = f"Overdue Loan Notice for {name} {yeargroup} {houseroom}"
+                    self.pdfManager.addPage(c, noticeTitle)
+                    y = 730
+                # If the reader's loans do not fit above the closing message, continue them on another page with the same title
+                if y < 250:
+                    self.pdfManager.addPage(c, noticeTitle + " (continued)")
+                    y = 730
+                self.pdfManager.write(c, 25, y, f"Their Loan for {booktitle} made on the {loanstartdate} and due on the {loanenddate} is {daysoverdue} days overdue.")
+                y -= 50
+            # Finish the last reader's page, or write a message on the first page if no loans are overdue
+            if readerID is not None:
+                self.pdfManager.write(c, 25, 200, "Please hand in the overdue books to the library as soon as possible.")
+            else:
+                self.pdfManager.write(c, 25, 700, "No results.")
+            # Save changes to canvas
+            self.pdfManager.save(c)
+            # Insert title and pdf content as new report in Report table and return reportID of new report
+            reportID = self.saveReport(title, buffer)
+            self.db.close()
+        return reportID
+
+    # Method to insert the PDF saved in the buffer passed as a parameter as a new report in the Report table, using the current connection
+    # The report's content is copied into the database a chunk at a time from the buffer rather than being read into memory all at once
+    # On Python versions before 3.11, which cannot open BLOBs, the whole content is read from the buffer and inserted instead
+    # Returns the reportID of the new report
+    def saveReport(self, title, buffer):
+        if self.db.canOpenBlob():
+            query = """INSERT INTO Report (ReportTitle, PDFContent) VALUES (?, zeroblob(?))"""
+            params = (title, self.pdfManager.getSize(buffer))
+            self.db.execute(query, params)
+            reportID = self.db.getLastRowID()
+            with self.db.openBlob("Report", "PDFContent", reportID) as blob:
+                self.pdfManager.copyTo(buffer, blob)
+        else:
+            query = """INSERT INTO Report (ReportTitle, PDFContent) VALUES (?, ?)"""
+            params = (title, self.pdfManager.getContent(buffer))
+            self.db.execute(query, params)
+            reportID = self.db.getLastRowID()
         self.db.commit()
-        self.db.close()
         return reportID
 
     # Method to retrieve the bytes content of an existing report
@@ -1530,18 +2598,31 @@ class Report():
         params = ()
         self.db.execute(query, params)
         reportTitles = self.db.fetchAll()
+        self.db.close()
         return reportTitles
 
 # Initialise classes
 reader = Reader(DBNAME) 
 userManagement = UserManagement(reader, DBNAME)
 readingList = ReadingList(DBNAME)
-review = Review(DBNAME)
-notificationManager = NotificationManager(DBNAME)
-book = Book(notificationManager, DBNAME)
-loan = Loan(notificationManager, DBNAME)
-reservation = Reservation(DBNAME)
-report = Report(DBNAME)
+recommendationCache = TTLCache(RECOMMENDATIONCACHESIZE, RECOMMENDATIONCACHETTL)
+review = Review(recommendationCache, DBNAME)
+overdueEngine = OverdueEngine(DBNAME)
+notificationManager = NotificationManager(overdueEngine, DBNAME)
+notificationScheduler = NotificationScheduler(notificationManager, app.config["NOTIFICATION_SCHEDULER_INTERVAL"])
+popularityEngine = PopularityEngine(DBNAME)
+book = Book(notificationManager, recommendationCache, popularityEngine, DBNAME)
+reservationScheduler = ReservationScheduler(DBNAME)
+leaderboardManager = LeaderboardManager(DBNAME)
+loan = Loan(notificationManager, recommendationCache, reservationScheduler, overdueEngine, leaderboardManager, popularityEngine, DBNAME)
+reservation = Reservation(reservationScheduler, DBNAME)
+report = Report(overdueEngine, DBNAME)
+
+# Bring the database schema up to date before any requests are handled
+schemaMigrator = SchemaMigrator(MIGRATIONS, DBNAME)
+schemaMigrator.migrate()
+# Build the autocomplete suggestions for the search bar
+book.autocompleteIndex.build()
 
 # Defines a FlaskForm Class called RegistrationForm that will allow a user to input their details and register a new account
 class RegistrationForm(FlaskForm):
@@ -1586,10 +2667,15 @@ class SearchForm(FlaskForm):
     bookISBN = StringField("Book ISBN-13:")
     bookGenre = StringField("Genre:")
     searchString = StringField()
-    orderByField = SelectField(choices=[("AuthorFirstName", "Author First Name"), ("AuthorLastName", "Author Last Name"), ("Title", "Book Title"), ("ISBN", "ISBN")])
+    orderByField = SelectField(choices=[("Relevance", "Relevance"), ("AuthorFirstName", "Author First Name"), ("AuthorLastName", "Author Last Name"), ("Title", "Book Title"), ("ISBN", "ISBN")])
     orderByDirection = SelectField(choices=[("ASC", "Ascending"), ("DESC", "Descending")])
     search = SubmitField("Search")
 
+    # Method to retrieve the search fields that have been filled in, so that they can be put in the URL of the next page of results
+    def getSearchParams(self):
+        fields = ["searchString", "authorFirstName", "authorLastName", "bookTitle", "bookISBN", "bookGenre", "orderByField", "orderByDirection"]
+        return {field: self[field].data for field in fields if self[field].data}
+
 # Defines a FlaskForm class called ReaderSearchForm that allows a librarian to search the database for a reader
 class ReaderSearchForm(FlaskForm):
     readerName = StringField("Enter reader's name:", validators=[DataRequired()])
@@ -1651,7 +2737,7 @@ class TopReadersYearGroupForm(FlaskForm):
 
 # Defines a FlaskForm class called OverdueReportForm that allows a librarian to choose how many days overdue loans they would like to select to create overdue notices for
 class OverdueReportForm(FlaskForm):
-    days = IntegerField("Select Reports that are X days overdue:", validators=[DataRequired()])
+    days = IntegerField("Select Reports that are at least X days overdue:", validators=[DataRequired()])
     enter = SubmitField("Enter Information")
 
 # Defines a FlaskForm class called UpdateDetailsForm that allows a librarian to optionally change a certain account information for a reader
@@ -1668,13 +2754,22 @@ class UpdateDetailsForm(FlaskForm):
 # The Flask before_request decorator will run the view function before_request before each request
 @app.before_request
 # The before_request() view function checks if the request endpoint is 'logout' and if so it clears all the variables stored in the session when the user logs in
+# It also starts the background notification scheduler the first time the app handles a request, if it is enabled
 def before_request():
+    if app.config["NOTIFICATION_SCHEDULER_ENABLED"]:
+        notificationScheduler.start()
     if request.endpoint in ['logout']:
         session.pop('user_type', None)
         session.pop('username', None)
         session.pop('logged_in', None)
         session.pop('readerID', None)
 
+# The Flask teardown_request decorator will run the view function releaseConnections after every request, even if the request raised an error
+@app.teardown_request
+# The releaseConnections() view function returns any database connections the request did not close to the connection pool
+def releaseConnections(exception):
+    Database.releaseConnections()
+
 # The Flask context_processor will add variables to the context of all the templartes in the app, so they are not limited to the scope of one route
 @app.context_processor
 # The view function injectGlobalVariables returns a dictionary of two global variables - loggedIn a boolean value signfiying whether a reader is logged into the system and numNotifications which signifies the number of unread notifications for that reader
@@ -1683,8 +2778,7 @@ def injectGlobalVariables():
     # Checks if the readerID is in the session and if it is retrieves the number of notifications for that reader
     if 'readerID' in session:
         readerID = session['readerID']
-        notifications, _ = notificationManager.getNotificationsForReader(readerID)
-        numNotifications = len(notifications)
+        numNotifications = notificationManager.countUnreadNotifications(readerID)
     # Otherwise sets number of notifications to 0
     else:
         numNotifications = 0 
@@ -1730,8 +2824,6 @@ def login():
                 session['username'] = username
                 session['logged_in'] = True
                 session.pop('login_attempts', None)
-                notificationManager.notifyLoanToReturn(readerID)
-                notificationManager.overdueLoan(readerID)
                 return redirect(url_for('home'))
             # If unsuccessful log in, increment login attempts by 1 and render the login page route again
             else:
@@ -1746,8 +2838,6 @@ def login():
                 session["username"] = username
                 session['logged_in'] = True
                 session.pop('login_attempts', None)
-                notificationManager.overdueLoan(readerID)
-                notificationManager.notifyLoanToReturn(readerID)
                 return redirect(url_for('home'))
             # If unsuccessful log in, increment login attempts by 1 and render the login page route again
             else:
@@ -1812,8 +2902,8 @@ def home():
     if 'username' in session:
         username = session['username']
         userType = session['user_type']
-        # Call the getLeaderboard method to pass leaderboard as variable to template
-        leaderboard = reader.getLeaderboard()
+        # Call the getLeaderboard method of leaderboardManager to pass leaderboard as variable to template
+        leaderboard = leaderboardManager.getLeaderboard()
         # Get current month for leaderboard
         today = date.today()
         currentMonth = today.strftime("%B")
@@ -1827,37 +2917,34 @@ def home():
 # Browsebooks decorator and view function to handle GET and POST requests
 @app.route("/browsebooks", methods=["GET", "POST"])
 def browsebooks():
-    # Initialise an instance of SearchForm
-    searchForm = SearchForm()
-    # Initially set searchResults to empty string
+    # If the reader has followed the link to the next page of search results, the search and the cursor token for the page are in the URL, so the form is filled in from the URL
+    after = request.args.get("after")
+    pageSize = request.args.get("pageSize", type=int)
+    if after:
+        searchForm = SearchForm(request.args, meta={"csrf": False})
+    # Otherwise initialise an instance of SearchForm
+    else:
+        searchForm = SearchForm()
+    # Initially set searchResults to empty string and there to be no next page
     searchResults = ""
-    # Retrieve new books that were added to library database in last year
+    nextPage = None
+    # Retrieve new books that were added to library database in last year, and a list of tuples, where first value of each tuple is title of bookshelf and second value is list of books in that shelf, for the popular books and the most common genres
+    # These shelves are the same for every reader so are built together from one query and cached for a short time
     today = date.today()
     yearago = today - datetime.timedelta(days=365)
-    newBooks = book.getNewBooks(yearago.strftime("%Y-%m-%d"))
+    newBooks, bookshelves = book.bookshelfManager.getShelves(yearago.strftime("%Y-%m-%d"))
     # Retrieve personalised recommendations for reader
     readerID = session['readerID']
     recommendedBooks = book.getRecommendedBooks(readerID) 
-    print(recommendedBooks)  
-    # Retrieve popular books 
-    popularBooks = book.getPopularBooks()
-    # Retrieve books for each of the genres
-    genres = ["classic", "fiction", "dystopian"]
-    # Create a list of tuples, where first value of each tuple is title of bookshelf and second value is list of books in that shelf
-    bookshelves = [('Popular', popularBooks)]
-    for genre in genres: 
-        bookshelves.append((genre.capitalize(), book.getBookInGenre(genre)))
-    
-    if searchForm.validate_on_submit():
+    
+    if searchForm.validate_on_submit() or after:
         orderbyfield = searchForm.orderByField.data
         orderbydirection = searchForm.orderByDirection.data
         # If the reader has searched by searchString retrieve the input string
         if searchForm.searchString.data:
             searchString = searchForm.searchString.data
-            # Search for matching books and store in searchResults
-            searchResults = book.searchBook(orderbyfield, orderbydirection, searchString)
-            # Render browsebooks.html template and pass as template variables searchForm, searchResults, newBooks and bookshelves
-            return render_template("browsebooks.html", searchForm=searchForm, searchResults=searchResults, newBooks=newBooks, bookshelves=bookshelves)
+            # Search for a page of matching books and store in searchResults, along with the cursor token for the next page
+            searchResults, nextCursor = book.searchBook(orderbyfield, orderbydirection, searchString, after=after, pageSize=pageSize)
         else:
             # If reader has chosen to search by advanced search, retrieve data from form fields
             authorfirstname = searchForm.authorFirstName.data
@@ -1865,12 +2952,24 @@ def browsebooks():
             booktitle = searchForm.bookTitle.data
             bookisbn = searchForm.bookISBN.data
             bookgenre = searchForm.bookGenre.data
-            # Search for matching books and store in searchResults
-            searchResults = book.searchBook(orderbyfield, orderbydirection, authorfirstname, authorlastname, booktitle, bookisbn, bookgenre)
-            # Render browsebooks.html template and pass as template variables searchForm, searchResults, newBooks and bookshelves
-            return render_template("browsebooks.html", searchForm=searchForm, searchResults=searchResults, newBooks=newBooks, bookshelves=bookshelves)
-    
-    return render_template("browsebooks.html", searchForm=searchForm, searchResults=searchResults, newBooks=newBooks, recommendedBooks=recommendedBooks, bookshelves=bookshelves)
+            # Search for a page of matching books and store in searchResults, along with the cursor token for the next page
+            searchResults, nextCursor = book.searchBook(orderbyfield, orderbydirection, authorFirstName=authorfirstname, authorLastName=authorlastname, bookTitle=booktitle, bookISBN=bookisbn, bookGenre=bookgenre, after=after, pageSize=pageSize)
+        # If there are more results, create the link to the next page, which repeats the search from after the last book on this page
+        if nextCursor:
+            nextPage = url_for("browsebooks", after=nextCursor, pageSize=pageSize, **searchForm.getSearchParams())
+        # Render browsebooks.html template and pass as template variables searchForm, searchResults, nextPage, newBooks and bookshelves
+        return render_template("browsebooks.html", searchForm=searchForm, searchResults=searchResults, nextPage=nextPage, newBooks=newBooks, bookshelves=bookshelves)
+    
+    return render_template("browsebooks.html", searchForm=searchForm, searchResults=searchResults, nextPage=nextPage, newBooks=newBooks, recommendedBooks=recommendedBooks, bookshelves=bookshelves)
+
+# Autocomplete decorator and view function to handle GET requests
+# Takes the text typed into the search bar as the q query string parameter
+@app.route("/autocomplete")
+def autocomplete():
+    # Find suggestions for the typed text from the in-memory autocomplete index
+    suggestions = book.autocompleteIndex.search(request.args.get("q", ""), AUTOCOMPLETELIMIT)
+    # Return the suggestions as JSON
+    return jsonify(suggestions=[{"label": label, "type": suggestionType, "bookID": bookID} for label, suggestionType, bookID in suggestions])
 
 # Bookinfo decorator and view function to handle both GET and POST Requests
 # Takes route parameters of bookID
@@ -1967,13 +3066,20 @@ def cancelreservation(bookID, reservationID):
     return redirect(url_for("viewreservations"))
 
 # Returnloan decorator and view function to handle GET requests
-# Takes route parameters of loanID and copyID and bookID
-@app.route("/returnloan/<int:loanID>/<int:copyID>/<int:bookID>")
-def returnloan(loanID, copyID, bookID):
-    # Return reader's loan for bookID
-    title = loan.returnLoan(loanID, copyID, bookID)
+# Takes route parameter of loanID
+@app.route("/returnloan/<int:loanID>")
+def returnloan(loanID):
+    # Return reader's loan
+    result = loan.returnLoan(loanID)
+    if result is None:
+        abort(404)
     # Display success message and redirect user to viewloans route
-    flash(f"You have successfully returned {title}.")
+    if result.isHandedOff():
+        flash(f"You have successfully returned {result.title}. It will go to the next reader who reserved it.")
+    elif result.returned:
+        flash(f"You have successfully returned {result.title}.")
+    else:
+        flash(f"{result.title} has already been returned.")
     return redirect(url_for("viewloans"))
 
 # Viewnotifications decorator and view function to handle GET requests
@@ -1983,25 +3089,30 @@ def viewnotifications():
     # Retrieves all unread notifications for a reader
     notifications, notificationIDs = notificationManager.getNotificationsForReader(readerID)
     # Once unread notifications stored in notifications variable, all unread notifications for that reader are marked as Read
-    notificationManager.markNotificationsAsViewed(notificationIDs)
+    notificationManager.markNotificationsAsViewed(readerID, notificationIDs)
     # Render viewnotifications.html template and pass notifications as a template variable
     return render_template("viewnotifications.html", notifications=notifications)
  
 # Viewbooks decorator and view function to handle GET and POST requests 
 @app.route("/viewbooks", methods=["GET", "POST"])
 def viewbooks():
-    # Initialise an instance of searchForm
-    searchForm = SearchForm()
+    # If the librarian has followed the link to the next page of search results, fill in the form from the URL, otherwise initialise an instance of searchForm
+    after = request.args.get("after")
+    pageSize = request.args.get("pageSize", type=int)
+    if after:
+        searchForm = SearchForm(request.args, meta={"csrf": False})
+    else:
+        searchForm = SearchForm()
     searchResults = ""
-    if searchForm.validate_on_submit():
+    nextPage = None
+    if searchForm.validate_on_submit() or after:
         # Retrieve all form field data
         orderbyfield = searchForm.orderByField.data
         orderbydirection = searchForm.orderByDirection.data
         if searchForm.searchString.data:
             # Librarian can search for book by string
             searchString = searchForm.searchString.data
-            searchResults = book.searchBook(orderbyfield, orderbydirection, searchString)
-            return render_template("viewbooks.html", searchForm=searchForm, searchResults=searchResults)
+            searchResults, nextCursor = book.searchBook(orderbyfield, orderbydirection, searchString, after=after, pageSize=pageSize)
         else:
             # Librarian can search for book by specific fields
             authorfirstname = searchForm.authorFirstName.data
@@ -2009,11 +3120,13 @@ def viewbooks():
             booktitle = searchForm.bookTitle.data
             bookisbn = searchForm.bookISBN.data
             bookgenre = searchForm.bookGenre.data
-            searchResults = book.searchBook(orderbyfield, orderbydirection, authorfirstname, authorlastname, booktitle, bookisbn, bookgenre)
-            return render_template("viewbooks.html", searchForm=searchForm, searchResults=searchResults)
+            searchResults, nextCursor = book.searchBook(orderbyfield, orderbydirection, authorFirstName=authorfirstname, authorLastName=authorlastname, bookTitle=booktitle, bookISBN=bookisbn, bookGenre=bookgenre, after=after, pageSize=pageSize)
+        # If there are more results, create the link to the next page
+        if nextCursor:
+            nextPage = url_for("viewbooks", after=nextCursor, pageSize=pageSize, **searchForm.getSearchParams())
         
-    # Return render template viewbooks.html and pass as template variables searchForm and searchResults
-    return render_template("viewbooks.html", searchForm=searchForm, searchResults=searchResults)
+    # Return render template viewbooks.html and pass as template variables searchForm, searchResults and nextPage
+    return render_template("viewbooks.html", searchForm=searchForm, searchResults=searchResults, nextPage=nextPage)
 
 # Deletebook decorator and view function to handle GET requests
 # Takes route parameters of bookID and bookTitle
@@ -2093,16 +3206,24 @@ def accountdetails():
 # Manageaccounts decorator and view function to handle GET and POST requests
 @app.route("/manageaccounts", methods=["GET", "POST"])
 def manageaccounts():
-    # Initialise an instance of ReaderSearchForm
-    readerSearchForm = ReaderSearchForm()
+    # If the librarian has followed the link to the next page of search results, fill in the form from the URL, otherwise initialise an instance of ReaderSearchForm
+    after = request.args.get("after")
+    pageSize = request.args.get("pageSize", type=int)
+    if after:
+        readerSearchForm = ReaderSearchForm(request.args, meta={"csrf": False})
+    else:
+        readerSearchForm = ReaderSearchForm()
     readerSearchResults = ""
-    if readerSearchForm.validate_on_submit():
-        # Search for reader according to input data and fetch results
+    nextPage = None
+    if readerSearchForm.validate_on_submit() or (after and readerSearchForm.validate()):
+        # Search for a page of readers according to input data and fetch results, along with the cursor token for the next page
         name = readerSearchForm.readerName.data
-        readerSearchResults = reader.searchReader(name)
-        return render_template("manageaccounts.html", readerSearchForm=readerSearchForm, readerSearchResults=readerSearchResults)
-    # Render template for manageaccounts.html and pass readerSearchForm and readerSearchResults as variables
-    return render_template("manageaccounts.html", readerSearchForm=readerSearchForm, readerSearchResults=readerSearchResults)
+        readerSearchResults, nextCursor = reader.searchReader(name, after=after, pageSize=pageSize)
+        # If there are more results, create the link to the next page
+        if nextCursor:
+            nextPage = url_for("manageaccounts", after=nextCursor, pageSize=pageSize, readerName=name)
+    # Render template for manageaccounts.html and pass readerSearchForm, readerSearchResults and nextPage as variables
+    return render_template("manageaccounts.html", readerSearchForm=readerSearchForm, readerSearchResults=readerSearchResults, nextPage=nextPage)
 
 # Deletereader decorator and view function to handle GET requests
 # Takes route parameter of readerID
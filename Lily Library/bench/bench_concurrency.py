@@ -0,0 +1,78 @@
+# Benchmark of concurrent reads and writes against library.db with the default SQLite settings and with the SQLITE_PRAGMAS set in app.py
+# Each run works on its own copy of library.db in a temporary directory, so the real database is never changed
+# Run from the Lily Library directory with: python bench/bench_concurrency.py
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+import common
+
+# Defines the number of reader and writer threads and the number of seconds each run lasts
+READERS = 8
+WRITERS = 4
+DURATION = 5
+
+# Defines the settings before the database tuning layer was added, which are the sqlite3 defaults of a rollback journal and a 5 second timeout
+DEFAULTPRAGMAS = {"journal_mode": "DELETE", "synchronous": "FULL", "busy_timeout": 5000}
+
+# Function to open a connection with the given pragmas applied, in the same way as ConnectionPool.createConnection
+def connect(dbName, pragmas):
+    con = sqlite3.connect(dbName, timeout=pragmas.get("busy_timeout", 5000) / 1000, check_same_thread=False)
+    for pragma, value in pragmas.items():
+        con.execute(f"PRAGMA {pragma} = {value}")
+    return con
+
+# Function run by each reader thread, which repeatedly runs a query like the ones behind the bookshelves
+def read(dbName, pragmas, stop, counts, errors):
+    con = connect(dbName, pragmas)
+    while not stop.is_set():
+        try:
+            con.execute("SELECT Book.BookID, COUNT(Loan.LoanID) FROM Book LEFT JOIN Loan ON Loan.BookID = Book.BookID GROUP BY Book.BookID").fetchall()
+            counts["reads"] += 1
+        except sqlite3.OperationalError as error:
+            errors.append(str(error))
+    con.close()
+
+# Function run by each writer thread, which repeatedly inserts and commits a notification like a loan or return does
+def write(dbName, pragmas, stop, counts, errors):
+    con = connect(dbName, pragmas)
+    while not stop.is_set():
+        try:
+            con.execute("INSERT INTO Notification (NotificationType, Viewed, ReaderID) VALUES ('Benchmark', 1, 1)")
+            con.commit()
+            counts["writes"] += 1
+        except sqlite3.OperationalError as error:
+            con.rollback()
+            errors.append(str(error))
+    con.close()
+
+# Function to run the readers and writers together for DURATION seconds with the given pragmas
+# Returns the number of reads and writes completed per second and the list of error messages
+def run(pragmas):
+    dbName = common.copyDatabase(tempfile.mkdtemp())
+    connect(dbName, pragmas).close()
+    stop = threading.Event()
+    counts = {"reads": 0, "writes": 0}
+    errors = []
+    threads = [threading.Thread(target=read, args=(dbName, pragmas, stop, counts, errors)) for i in range(READERS)]
+    threads += [threading.Thread(target=write, args=(dbName, pragmas, stop, counts, errors)) for i in range(WRITERS)]
+    for thread in threads:
+        thread.start()
+    time.sleep(DURATION)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    shutil.rmtree(os.path.dirname(dbName))
+    return counts["reads"] / DURATION, counts["writes"] / DURATION, errors
+
+if __name__ == "__main__":
+    # The pragmas are read from app.py, which is imported from a temporary directory so that importing it does not migrate the real database
+    directory = tempfile.mkdtemp()
+    app = common.importApp(directory)
+    for label, pragmas in [("Before (default settings)", DEFAULTPRAGMAS), ("After (SQLITE_PRAGMAS)", app.app.config["SQLITE_PRAGMAS"])]:
+        reads, writes, errors = run(pragmas)
+        print(f"{label}: {reads:.0f} reads/s, {writes:.0f} writes/s, {len(errors)} errors {sorted(set(errors))}")
+    shutil.rmtree(directory)
@@ -0,0 +1,73 @@
+# Benchmark of the reservation queue operations on a popular title with thousands of holds
+# Times reserving, cancelling from the middle of the queue and fulfilling from the front of the queue for queues of different lengths
+# Each operation changes one row of the queue's index, so it should take O(log n) time. The benchmark fails if an operation grows faster than that between the shortest and longest queue
+# Works on a copy of library.db in a temporary directory, so the real database is never changed
+# Run from the Lily Library directory with: python bench/bench_reservations.py
+import math
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import time
+
+import common
+
+# Defines the queue lengths benchmarked and the number of operations timed for each
+QUEUELENGTHS = [100, 1000, 5000]
+OPERATIONS = 100
+
+# Defines how many times more an operation on the longest queue may take than O(log n) growth from the shortest queue allows, to leave room for timing noise
+# Growth in proportion to the queue length would be 50 times between 100 and 5000 holds, while O(log n) growth is less than 2 times
+LOGGROWTHTOLERANCE = 2
+
+# Function to add the given number of readers, alternately in year 9 and year 12 so that the queue has both priorities
+# Returns the list of readerIDs
+def addReadersOfBothPriorities(app, readers):
+    pairs = zip(common.addReaders(app, readers // 2, yearGroup=9), common.addReaders(app, readers // 2))
+    return [readerID for pair in pairs for readerID in pair]
+
+# Function to time one kind of operation, returning the median time of each in milliseconds, which is less affected than the average by an occasional slow operation
+def timeOperations(operation, arguments):
+    times = []
+    for argument in arguments:
+        start = time.perf_counter()
+        operation(argument)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+# Function to fulfil the reservation at the front of the queue, in the same way as a return does
+def fulfil(app, bookID):
+    db = app.Database(app.DBNAME)
+    db.connect()
+    db.begin()
+    app.reservationScheduler.dequeue(db, bookID, 1)
+    db.commit()
+    db.close()
+
+if __name__ == "__main__":
+    directory = tempfile.mkdtemp()
+    app = common.importApp(directory)
+
+    results = {}
+    for queueLength in QUEUELENGTHS:
+        bookID = common.addBook(app, 1)
+        readerIDs = addReadersOfBothPriorities(app, queueLength + OPERATIONS)
+        for readerID in readerIDs[:queueLength]:
+            app.reservation.reserveBook(readerID, bookID)
+        reserve = timeOperations(lambda readerID: app.reservation.reserveBook(readerID, bookID), readerIDs[queueLength:])
+        con = sqlite3.connect(app.DBNAME)
+        middle = [row[0] for row in con.execute("SELECT ReservationID FROM Reservation WHERE BookID = ? AND ReservationStatus = 'Pending' ORDER BY " + app.RESERVATIONQUEUEORDER + " LIMIT ? OFFSET ?", (bookID, OPERATIONS, queueLength // 2))]
+        con.close()
+        cancel = timeOperations(lambda reservationID: app.reservation.cancelReservation(bookID, reservationID), middle)
+        fulfilled = timeOperations(lambda i: fulfil(app, bookID), range(OPERATIONS))
+        results[queueLength] = {"reserve": reserve, "cancel": cancel, "fulfil": fulfilled}
+        print(f"{queueLength} holds: reserve {reserve:.3f} ms, cancel {cancel:.3f} ms, fulfil {fulfilled:.3f} ms")
+    shutil.rmtree(directory)
+
+    # Compare the time of each operation on the longest queue with the time on the shortest queue
+    shortest, longest = QUEUELENGTHS[0], QUEUELENGTHS[-1]
+    allowedGrowth = LOGGROWTHTOLERANCE * math.log(longest) / math.log(shortest)
+    for operation in results[shortest]:
+        growth = results[longest][operation] / results[shortest][operation]
+        print(f"{operation}: {growth:.2f} times the time with {longest} holds as with {shortest} holds, at most {allowedGrowth:.2f} allowed")
+        assert growth <= allowedGrowth, f"{operation} grows faster than O(log n) with the length of the queue"
@@ -0,0 +1,36 @@
+# Benchmark of Loan.returnLoan, timing returns that free the copy and returns that hand the copy to the reader at the front of the reservation queue
+# Works on a copy of library.db in a temporary directory, so the real database is never changed
+# Run from the Lily Library directory with: python bench/bench_returns.py
+import shutil
+import tempfile
+import time
+
+import common
+
+# Defines the number of loans returned in each part of the benchmark
+RETURNS = 500
+
+# Function to return every loan and time it, returning the number of returns per second
+def timeReturns(app, loanIDs):
+    start = time.perf_counter()
+    for loanID in loanIDs:
+        app.loan.returnLoan(loanID)
+    return len(loanIDs) / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    directory = tempfile.mkdtemp()
+    app = common.importApp(directory)
+
+    # Returns with no reservations, so each return makes its copy available
+    bookID = common.addBook(app, RETURNS)
+    loanIDs = [common.loanBook(app, readerID, bookID) for readerID in common.addReaders(app, RETURNS)]
+    print(f"Returns that free the copy: {timeReturns(app, loanIDs):.0f} returns/s")
+
+    # Returns of a book with a long reservation queue, so each return hands the copy to the reader at the front of the queue
+    bookID = common.addBook(app, RETURNS)
+    readerIDs = common.addReaders(app, RETURNS * 2)
+    loanIDs = [common.loanBook(app, readerID, bookID) for readerID in readerIDs[:RETURNS]]
+    for readerID in readerIDs[RETURNS:]:
+        app.reservation.reserveBook(readerID, bookID)
+    print(f"Returns that hand the copy to a reservation: {timeReturns(app, loanIDs):.0f} returns/s")
+    shutil.rmtree(directory)
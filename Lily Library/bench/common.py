@@ -0,0 +1,60 @@
+# Shared setup for the benchmarks and the tests
+# app.py migrates library.db in the working directory when it is imported, so it is imported from a directory holding a copy of library.db and the real database is never changed
+import os
+import sys
+import shutil
+import sqlite3
+
+APPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Function to copy library.db into a directory
+# Returns the path of the copy
+def copyDatabase(directory):
+    shutil.copy(os.path.join(APPDIR, "library.db"), directory)
+    return os.path.join(directory, "library.db")
+
+# Function to import the app module against a copy of library.db in a directory, with the background notification scheduler turned off
+# Returns the app module
+def importApp(directory):
+    copyDatabase(directory)
+    os.chdir(directory)
+    if APPDIR not in sys.path:
+        sys.path.insert(0, APPDIR)
+    import app
+    app.app.config["NOTIFICATION_SCHEDULER_ENABLED"] = False
+    return app
+
+# Function to add a new book with the given number of available copies and its BookAvailability row
+# Returns the bookID of the new book
+def addBook(app, copies, title="Test Book"):
+    con = sqlite3.connect(app.DBNAME)
+    cur = con.execute("INSERT INTO Book (ISBN, Title, Genre, YearPublished, PublisherID, DateAdded, Blurb, MinYearGroup) VALUES ('0000000000000', ?, 'Test', '2024', 1, DATE('now'), 'Test', 7)", (title, ))
+    bookID = cur.lastrowid
+    con.executemany("INSERT INTO BookCopy (CopyID, BookID, AccessionNumber, Status) VALUES (?, ?, ?, 'Available')", [(copyID, bookID, f"T{bookID}-{copyID}") for copyID in range(1, copies + 1)])
+    con.execute(app.BOOKAVAILABILITYREFRESH + " WHERE Book.BookID = ?", (bookID, ))
+    con.commit()
+    con.close()
+    return bookID
+
+# Function to add the given number of new readers in a year group, year 12 unless another is given
+# Returns the list of readerIDs of the new readers
+def addReaders(app, count, yearGroup=12):
+    con = sqlite3.connect(app.DBNAME)
+    readerIDs = []
+    for i in range(count):
+        cur = con.execute("INSERT INTO Reader (FirstName, LastName, ReaderUsername, ReaderSalt, SchoolEmailAddress, PersonalEmailAddress, DateOfBirth, YearGroup, Houseroom) VALUES ('Test', ?, ?, 'salt', 'test@school', 'test@home', '2008-01-01', ?, '12A')", (f"Reader{i}", f"test{i}", yearGroup))
+        readerIDs.append(cur.lastrowid)
+    con.commit()
+    con.close()
+    return readerIDs
+
+# Function to loan a book to a reader in a request context, as loanBook flashes a message to the reader
+# Returns the loanID of the reader's active loan of the book
+def loanBook(app, readerID, bookID):
+    with app.app.test_request_context():
+        app.session["username"] = f"reader{readerID}"
+        app.loan.loanBook(readerID, bookID, "Test Book")
+    con = sqlite3.connect(app.DBNAME)
+    loanID = con.execute("SELECT LoanID FROM Loan WHERE ReaderID = ? AND BookID = ? AND LoanStatus = 'Active'", (readerID, bookID)).fetchone()[0]
+    con.close()
+    return loanID
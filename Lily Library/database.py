@@ -5,6 +5,10 @@ con = sqlite3.connect('library.db')
 # The cursor object is initialised which will allow me to execute commands on the database,
 cur = con.cursor()
 
+# The database is switched to WAL (write-ahead logging) journal mode, so that readers do not block a writer and a writer does not block readers. This setting is stored in the database file, so it stays on for every connection the app makes.
+# The other pragmas the app uses (synchronous, cache_size, mmap_size, temp_store and busy_timeout) only last for one connection, so they are applied to every connection from the SQLITE_PRAGMAS setting in app.py.
+cur.execute("PRAGMA journal_mode = WAL")
+
 # This query will be executed and will create the Publisher table in the 'library.db' database
 
 cur.execute("""
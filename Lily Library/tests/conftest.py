@@ -0,0 +1,56 @@
+# Shared fixtures for the tests
+# The app module and test data are set up with the same functions as the benchmarks, from bench/common.py
+import os
+import sys
+import sqlite3
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench import common
+
+# Fixture that returns the app module, imported once for the test session against a copy of library.db
+@pytest.fixture(scope="session")
+def appModule(tmp_path_factory):
+    app = common.importApp(tmp_path_factory.mktemp("app"))
+    app.app.config["TESTING"] = True
+    yield app
+    app.Database.releaseConnections()
+
+# Fixture that returns the path of a new copy of library.db that has been migrated to the latest schema version
+@pytest.fixture
+def migratedDatabase(appModule, tmp_path):
+    dbName = common.copyDatabase(str(tmp_path))
+    appModule.SchemaMigrator(appModule.MIGRATIONS, dbName).migrate()
+    return dbName
+
+# Fixture that returns a plain sqlite3 connection to a migrated copy of library.db
+@pytest.fixture
+def connection(migratedDatabase):
+    con = sqlite3.connect(migratedDatabase)
+    yield con
+    con.close()
+
+# Fixture that returns a function to add a new book with the given number of available copies to the session database
+# Returns the bookID of the new book
+@pytest.fixture
+def addBook(appModule):
+    def add(copies, title="Test Book"):
+        return common.addBook(appModule, copies, title)
+    return add
+
+# Fixture that returns a function to add the given number of new readers in a year group, year 12 unless another is given, to the session database
+# Returns the list of readerIDs of the new readers
+@pytest.fixture
+def addReaders(appModule):
+    def add(count, yearGroup=12):
+        return common.addReaders(appModule, count, yearGroup)
+    return add
+
+# Fixture that returns a function to loan a book to a reader in the session database
+# Returns the loanID of the new loan
+@pytest.fixture
+def loanBook(appModule):
+    def loan(readerID, bookID):
+        return common.loanBook(appModule, readerID, bookID)
+    return loan
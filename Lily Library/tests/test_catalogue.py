@@ -0,0 +1,49 @@
+# Tests for adding books to and deleting books from the catalogue
+import sqlite3
+
+import pytest
+
+# Fixture that records the largest number of pooled connections the test's thread has checked out at the same time
+# A method that holds one connection while waiting for another can stall the pool when every connection is held by such a method
+@pytest.fixture
+def connectionsHeld(appModule, monkeypatch):
+    counts = {"held": 0, "most": 0}
+    acquire = appModule.ConnectionPool.acquire
+    release = appModule.ConnectionPool.release
+
+    def countedAcquire(self):
+        con = acquire(self)
+        counts["held"] += 1
+        counts["most"] = max(counts["most"], counts["held"])
+        return con
+
+    def countedRelease(self, con):
+        counts["held"] -= 1
+        release(self, con)
+
+    monkeypatch.setattr(appModule.ConnectionPool, "acquire", countedAcquire)
+    monkeypatch.setattr(appModule.ConnectionPool, "release", countedRelease)
+    return counts
+
+def test_deleteBookHoldsOneConnectionAtATime(appModule, addBook, addReaders, loanBook, connectionsHeld):
+    bookID = addBook(1)
+    readerID, reserverID = addReaders(2)
+    loanBook(readerID, bookID)
+    appModule.reservation.reserveBook(reserverID, bookID)
+    connectionsHeld["most"] = 0
+    appModule.book.deleteBook(bookID)
+    assert connectionsHeld["most"] == 1
+    con = sqlite3.connect(appModule.DBNAME)
+    assert con.execute("SELECT NotificationType FROM Notification WHERE BookID = ? ORDER BY NotificationID", (bookID, )).fetchall() == [("Cancelled Loan", ), ("Cancelled Reservation", )]
+    assert con.execute("SELECT Decommissioned, PendingReservations FROM BookAvailability WHERE BookID = ?", (bookID, )).fetchone() == (1, 0)
+    con.close()
+
+def test_addBookHoldsOneConnectionAtATime(appModule, connectionsHeld):
+    with appModule.app.test_request_context():
+        appModule.book.addBook("Connection Test", "Test", "9780000000002", "2024", "New Test Publisher", ["Test Author"], "Test", 7, "", 2, "C1")
+    assert connectionsHeld["most"] == 1
+    con = sqlite3.connect(appModule.DBNAME)
+    bookID = con.execute("SELECT BookID FROM Book WHERE Title = 'Connection Test'").fetchone()[0]
+    assert con.execute("SELECT AvailableCopies FROM BookAvailability WHERE BookID = ?", (bookID, )).fetchone()[0] == 2
+    assert con.execute("SELECT PublisherName FROM Publisher INNER JOIN Book ON Book.PublisherID = Publisher.PublisherID WHERE BookID = ?", (bookID, )).fetchone()[0] == "New Test Publisher"
+    con.close()
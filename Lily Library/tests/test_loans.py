@@ -0,0 +1,43 @@
+# Tests for loaning books
+import sqlite3
+import threading
+
+from flask import get_flashed_messages, session
+
+# Defines the number of readers that try to loan the last copy of a book at the same time
+RACINGREADERS = 8
+
+def test_onlyOneReaderLoansTheLastCopy(appModule, addBook, addReaders):
+    bookID = addBook(1)
+    readerIDs = addReaders(RACINGREADERS)
+    start = threading.Barrier(RACINGREADERS)
+    messages = {}
+    errors = []
+
+    # Function run by each thread, which loans the book for one reader as soon as every thread is ready
+    def loan(readerID):
+        try:
+            with appModule.app.test_request_context():
+                session["username"] = f"reader{readerID}"
+                start.wait()
+                appModule.loan.loanBook(readerID, bookID, "Test Book")
+                messages[readerID] = get_flashed_messages()
+                appModule.Database.releaseConnections()
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=loan, args=(readerID, )) for readerID in readerIDs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    con = sqlite3.connect(appModule.DBNAME)
+    assert con.execute("SELECT COUNT(*) FROM Loan WHERE BookID = ? AND LoanStatus = 'Active'", (bookID, )).fetchone()[0] == 1
+    assert con.execute("SELECT Status FROM BookCopy WHERE BookID = ?", (bookID, )).fetchall() == [("On Loan", )]
+    assert con.execute("SELECT AvailableCopies, OnLoanCopies FROM BookAvailability WHERE BookID = ?", (bookID, )).fetchone() == (0, 1)
+    con.close()
+    successes = [readerID for readerID, flashed in messages.items() if "successfully loaned" in flashed[0]]
+    assert len(successes) == 1
+    assert all("no copies" in flashed[0] for readerID, flashed in messages.items() if readerID not in successes)
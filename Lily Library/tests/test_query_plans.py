@@ -0,0 +1,27 @@
+# Regression tests that check the hot queries are answered by searching their index rather than scanning the table
+import pytest
+
+# Each case is the index that must be used and a query with the same predicates as the query in app.py that relies on it
+HOTQUERIES = [
+    ("LoanReaderStatusIndex", "SELECT COUNT(*) FROM Loan WHERE ReaderID = ? AND LoanStatus = 'Active'", (1, )),
+    ("NotificationReaderViewedIndex", "SELECT COUNT(*) FROM Notification WHERE ReaderID = ? AND Viewed = 0", (1, )),
+    ("ReservationBookOrderIndex", "SELECT ReservationID FROM Reservation WHERE BookID = ? AND ReservationStatus = 'Pending' ORDER BY Priority, ReservationTimestamp, ReservationID LIMIT 1", (1, )),
+    ("BookCopyBookStatusIndex", "SELECT COUNT(*) FROM BookCopy WHERE BookCopy.BookID = ? AND BookCopy.Status = 'Available'", (1, )),
+    ("ReviewBookIndex", "SELECT Rating FROM Review WHERE BookID = ?", (1, )),
+    ("LoanStatusEndDateIndex", "SELECT LoanID FROM Loan WHERE LoanStatus = 'Active' AND LoanEndDate < ?", ("2024-01-01", )),
+    ("BookDailyLoansDateIndex", "SELECT BookID, SUM(LoanCount) AS Score FROM BookDailyLoans WHERE LoanDate > ? GROUP BY +BookID", ("2024-01-01", )),
+    ("BookDailyLoansDateIndex", "SELECT BookID, SUM(CASE WHEN LoanDate > ? THEN LoanCount ELSE -LoanCount END) AS Score FROM BookDailyLoans WHERE LoanDate > ? GROUP BY +BookID", ("2024-01-08", "2024-01-01")),
+    ("ReaderMonthlyLoansRankIndex", "SELECT ReaderID, LoanCount FROM ReaderMonthlyLoans WHERE YearMonth = ? ORDER BY LoanCount DESC LIMIT 10", ("2024-01", )),
+]
+
+# Function to get the details of every step of the query plan of a query
+def getQueryPlan(connection, query, params):
+    return [row[3] for row in connection.execute("EXPLAIN QUERY PLAN " + query, params).fetchall()]
+
+@pytest.mark.parametrize("indexName, query, params", HOTQUERIES, ids=[f"{case[0]}-{number}" for number, case in enumerate(HOTQUERIES)])
+def test_hotQueryUsesIndex(connection, indexName, query, params):
+    plan = getQueryPlan(connection, query, params)
+    assert any(step.startswith("SEARCH") and f"INDEX {indexName}" in step for step in plan), plan
+
+def test_migrationsReachLatestVersion(appModule, connection):
+    assert connection.execute("PRAGMA user_version").fetchone()[0] == appModule.MIGRATIONS[-1][0]
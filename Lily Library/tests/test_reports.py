@@ -0,0 +1,53 @@
+# Tests for creating report PDFs
+import re
+import threading
+
+# Defines the number of librarians that create reports at the same time
+CONCURRENTREPORTS = 6
+
+# Function to get the number of pages in a PDF and check it is one complete document
+def getPageCount(pdf):
+    assert pdf.startswith(b"%PDF")
+    assert pdf.count(b"%%EOF") == 1
+    return len(re.findall(rb"/Type /Page\b", pdf))
+
+def test_concurrentReportsDoNotShareACanvas(appModule):
+    report = appModule.report
+    # Each kind of report is created once on its own first, to find the number of pages it should have
+    reports = [(report.getOverdueLoanReports, (0, )), (report.getTopReadersYearGroup, (10, 12, "2000-01-01", "2100-01-01"))]
+    expectedPages = [getPageCount(report.getExistingReport(createReport(*args))) for createReport, args in reports]
+    appModule.Database.releaseConnections()
+    start = threading.Barrier(CONCURRENTREPORTS)
+    reportIDs = {}
+    errors = []
+
+    # Function run by each thread, which creates one of the kinds of report as soon as every thread is ready
+    def create(number):
+        try:
+            createReport, args = reports[number % len(reports)]
+            start.wait()
+            reportIDs[number] = createReport(*args)
+            appModule.Database.releaseConnections()
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=create, args=(number, )) for number in range(CONCURRENTREPORTS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    for number, reportID in reportIDs.items():
+        assert getPageCount(report.getExistingReport(reportID)) == expectedPages[number % len(reports)]
+    appModule.Database.releaseConnections()
+
+def test_reportIsSavedWithoutOpeningBlobOnOlderPython(appModule, monkeypatch):
+    report = appModule.report
+    blobReport = report.getExistingReport(report.getTopReadersYearGroup(10, 12, "2000-01-01", "2100-01-01"))
+    # Python versions before 3.11 have no Connection.blobopen
+    monkeypatch.setattr(appModule.Database, "canOpenBlob", lambda self: False)
+    monkeypatch.setattr(appModule.Database, "openBlob", None)
+    insertedReport = report.getExistingReport(report.getTopReadersYearGroup(10, 12, "2000-01-01", "2100-01-01"))
+    assert getPageCount(insertedReport) == getPageCount(blobReport)
+    appModule.Database.releaseConnections()
@@ -0,0 +1,52 @@
+# Tests for the reservation queue of a book
+import sqlite3
+
+# Function to get the position in the queue shown to a reader for each of their pending reservations, by bookID
+def getPositions(appModule, readerID):
+    return {reservation[1]: reservation[4] for reservation in appModule.reservation.getReservations(readerID)}
+
+# Function to fulfil the reservation at the front of the queue for a book, in the same way as a return does
+# Returns the readerID of the fulfilled reservation
+def fulfil(appModule, bookID):
+    db = appModule.Database(appModule.DBNAME)
+    db.connect()
+    db.begin()
+    reservationID, readerID = appModule.reservationScheduler.dequeue(db, bookID, 1)
+    db.commit()
+    db.close()
+    return readerID
+
+# Function to check the number of pending reservations stored in the BookAvailability row of a book matches the number of pending reservations for it
+def assertPendingReservationsCounted(appModule, bookID, expected):
+    con = sqlite3.connect(appModule.DBNAME)
+    stored = con.execute("SELECT PendingReservations FROM BookAvailability WHERE BookID = ?", (bookID, )).fetchone()[0]
+    counted = con.execute("SELECT COUNT(*) FROM Reservation WHERE BookID = ? AND ReservationStatus = 'Pending'", (bookID, )).fetchone()[0]
+    con.close()
+    assert stored == counted == expected
+
+def test_queueIsOrderedByPriorityThenReservationTime(appModule, addBook, addReaders):
+    bookID = addBook(1)
+    lowerPriority = addReaders(2, yearGroup=9)
+    higherPriority = addReaders(2)
+    for readerID in (lowerPriority[0], higherPriority[0], lowerPriority[1], higherPriority[1]):
+        appModule.reservation.reserveBook(readerID, bookID)
+    queue = higherPriority + lowerPriority
+    assert [getPositions(appModule, readerID)[bookID] for readerID in queue] == [1, 2, 3, 4]
+    assertPendingReservationsCounted(appModule, bookID, 4)
+    assert [fulfil(appModule, bookID) for readerID in queue] == queue
+    assertPendingReservationsCounted(appModule, bookID, 0)
+
+def test_cancellingMovesLaterReservationsUp(appModule, addBook, addReaders):
+    bookID = addBook(1)
+    readerIDs = addReaders(3)
+    for readerID in readerIDs:
+        appModule.reservation.reserveBook(readerID, bookID)
+    con = sqlite3.connect(appModule.DBNAME)
+    reservationID = con.execute("SELECT ReservationID FROM Reservation WHERE BookID = ? AND ReaderID = ?", (bookID, readerIDs[0])).fetchone()[0]
+    con.close()
+    appModule.reservation.cancelReservation(bookID, reservationID)
+    appModule.reservation.cancelReservation(bookID, reservationID)
+    assertPendingReservationsCounted(appModule, bookID, 2)
+    assert getPositions(appModule, readerIDs[0]) == {}
+    assert [getPositions(appModule, readerID)[bookID] for readerID in readerIDs[1:]] == [1, 2]
+    assert fulfil(appModule, bookID) == readerIDs[1]
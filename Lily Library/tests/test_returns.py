@@ -0,0 +1,72 @@
+# Tests for returning loans
+import sqlite3
+
+import pytest
+
+# Function to read the rows a return changes for a book, so they can be compared before and after
+def getBookState(appModule, bookID):
+    con = sqlite3.connect(appModule.DBNAME)
+    state = (
+        con.execute("SELECT LoanID, CopyID, ReaderID, LoanStatus FROM Loan WHERE BookID = ? ORDER BY LoanID", (bookID, )).fetchall(),
+        con.execute("SELECT CopyID, Status FROM BookCopy WHERE BookID = ? ORDER BY CopyID", (bookID, )).fetchall(),
+        con.execute("SELECT ReservationID, ReservationStatus, CopyID FROM Reservation WHERE BookID = ? ORDER BY ReservationID", (bookID, )).fetchall(),
+        con.execute("SELECT * FROM BookAvailability WHERE BookID = ?", (bookID, )).fetchall(),
+        con.execute("SELECT COUNT(*) FROM Notification WHERE BookID = ?", (bookID, )).fetchall(),
+    )
+    con.close()
+    return state
+
+def test_returnFreesTheLoanedCopy(appModule, addBook, addReaders, loanBook):
+    bookID = addBook(2)
+    readerID, = addReaders(1)
+    loanID = loanBook(readerID, bookID)
+    result = appModule.loan.returnLoan(loanID)
+    assert result.returned and not result.isHandedOff()
+    loans, copies, reservations, availability, notifications = getBookState(appModule, bookID)
+    assert copies == [(1, "Available"), (2, "Available")]
+    assert appModule.loan.returnLoan(loanID).returned is False
+
+def test_returnHandsCopyToFirstReservation(appModule, addBook, addReaders, loanBook):
+    bookID = addBook(1)
+    readerID, firstReserver, secondReserver = addReaders(3)
+    loanID = loanBook(readerID, bookID)
+    appModule.reservation.reserveBook(firstReserver, bookID)
+    appModule.reservation.reserveBook(secondReserver, bookID)
+    result = appModule.loan.returnLoan(loanID)
+    assert result.isHandedOff() and result.readerID == firstReserver
+    loans, copies, reservations, availability, notifications = getBookState(appModule, bookID)
+    assert loans[-1][1:] == (1, firstReserver, "Active")
+    assert copies == [(1, "On Loan")]
+    assert [reservation[1:] for reservation in reservations] == [("Fulfilled", 1), ("Pending", 1)]
+
+def test_returnOfUnknownLoanReturnsNone(appModule):
+    assert appModule.loan.returnLoan(-1) is None
+
+# The return is interrupted at its last statement before the commit, which must leave every row as it was
+def test_failedReturnLeavesDatabaseUnchanged(appModule, addBook, addReaders, loanBook, monkeypatch):
+    bookID = addBook(1)
+    readerID, reserverID = addReaders(2)
+    loanID = loanBook(readerID, bookID)
+    appModule.reservation.reserveBook(reserverID, bookID)
+    before = getBookState(appModule, bookID)
+
+    def fail(*args, **kwargs):
+        raise sqlite3.OperationalError("injected failure")
+    monkeypatch.setattr(appModule.notificationManager, "notifyReservationAvailable", fail)
+    with pytest.raises(sqlite3.OperationalError):
+        appModule.loan.returnLoan(loanID)
+    assert getBookState(appModule, bookID) == before
+    monkeypatch.undo()
+    assert appModule.loan.returnLoan(loanID).isHandedOff()
+
+def test_returnRoute(appModule, addBook, addReaders, loanBook):
+    bookID = addBook(1)
+    readerID, = addReaders(1)
+    loanID = loanBook(readerID, bookID)
+    client = appModule.app.test_client()
+    with client.session_transaction() as clientSession:
+        clientSession["readerID"] = readerID
+        clientSession["username"] = f"reader{readerID}"
+        clientSession["logged_in"] = True
+    assert client.get(f"/returnloan/{loanID}").status_code == 302
+    assert client.get("/returnloan/999999").status_code == 404
@@ -0,0 +1,40 @@
+# Tests for searching books and readers
+import pytest
+
+@pytest.mark.parametrize("searchString", ["?!", "--", "\"'"])
+def test_punctuationOnlySearchHasNoResults(appModule, searchString):
+    assert appModule.book.searchBook("Title", "ASC", searchString) == ([], None)
+
+def test_punctuationOnlyAdvancedFieldHasNoResults(appModule):
+    assert appModule.book.searchBook("Title", "ASC", bookTitle="the", authorLastName="!!") == ([], None)
+
+def test_emptySearchListsEveryBook(appModule):
+    searchResults, nextCursor = appModule.book.searchBook("Title", "ASC", pageSize=appModule.MAXSEARCHPAGESIZE)
+    assert searchResults
+
+@pytest.mark.parametrize("values", [[[1], 2], [{"a": 1}, 2], [True, 2], ["Title", [2]], ["Title", 2 ** 63], ["x", 10 ** 30], ["Title", -2 ** 63 - 1]])
+def test_cursorWithInvalidSortValuesIsRejected(appModule, values):
+    searchCursor = appModule.SearchCursor()
+    assert searchCursor.decode(searchCursor.encode(values), 2) is None
+
+def test_cursorWithValidSortValuesIsAccepted(appModule):
+    searchCursor = appModule.SearchCursor()
+    assert searchCursor.decode(searchCursor.encode(["Title", 2]), 2) == ["Title", 2]
+    assert searchCursor.decode(searchCursor.encode([None, 2.5]), 2) == [None, 2.5]
+    assert searchCursor.decode(searchCursor.encode(["Title", 2 ** 63 - 1]), 2) == ["Title", 2 ** 63 - 1]
+
+@pytest.mark.parametrize("values", [[[1], 2], ["Title", 2 ** 63], ["x", 10 ** 30]])
+def test_searchWithInvalidCursorShowsFirstPage(appModule, values):
+    client = appModule.app.test_client()
+    with client.session_transaction() as session:
+        session["readerID"] = 1
+    after = appModule.SearchCursor().encode(values)
+    response = client.get("/browsebooks", query_string={"after": after, "searchString": "the", "orderByField": "Title", "orderByDirection": "ASC"})
+    assert response.status_code == 200
+
+@pytest.mark.parametrize("values", [["Smith John", 2 ** 63], ["x", 10 ** 30]])
+def test_readerSearchWithInvalidCursorShowsFirstPage(appModule, values):
+    client = appModule.app.test_client()
+    after = appModule.SearchCursor().encode(values)
+    response = client.get("/manageaccounts", query_string={"after": after, "readerName": "a"})
+    assert response.status_code == 200